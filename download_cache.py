@@ -0,0 +1,173 @@
+"""Local download cache of the RunPod worker.
+
+Files are stored under `cache_dir/<sha256 of the URL>/<file name>`, so a URL that was downloaded before
+(e.g. the same avatar video in consecutive jobs) is served from disk without touching the network. The
+total size is capped, the least recently used entries are evicted first (the modification time of a file
+is refreshed on every hit). Entries in use by a job are pinned and never evicted, so concurrent jobs of
+one worker cannot remove each other's inputs. `file://` URLs are copied into the cache like remote ones,
+which makes the cache testable offline.
+
+    cache = DownloadCache("/tmp/download_cache", max_bytes=10 * 1024**3)
+    with cache.use(["https://example.com/avatar.mp4", "https://example.com/speech.wav"]) as paths:
+        video_path, audio_path = paths
+        ...  # the files stay in the cache until the block exits
+"""
+
+import contextlib
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+
+def url_filename(url):
+    """The file name of a URL without its query parameters."""
+    filename = os.path.basename(urlparse(url).path)
+    if not filename or filename == "/":
+        filename = "downloaded_file"
+    return filename
+
+
+def pget_download(url, destination):
+    try:
+        subprocess.check_call(["pget", url, destination], close_fds=False)
+    except FileNotFoundError:
+        print("Error: pget command not found. Ensure it is installed and in PATH.")
+        raise Exception("pget not found. Cannot download files.")
+
+
+class DownloadCache:
+    def __init__(self, cache_dir, max_bytes, downloader=pget_download):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # Called as downloader(url, destination) for every URL that is not a file:// URL
+        self.downloader = downloader
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # One lock per URL, so the same URL requested twice at once is downloaded once
+        self._url_locks = {}
+        # Number of users of every pinned key, pinned entries are not evicted
+        self._pins = Counter()
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _url_lock(self, key):
+        with self._lock:
+            return self._url_locks.setdefault(key, threading.Lock())
+
+    @contextlib.contextmanager
+    def _pinned(self, keys):
+        with self._lock:
+            self._pins.update(keys)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins.subtract(keys)
+                for key in keys:
+                    if self._pins[key] <= 0:
+                        del self._pins[key]
+
+    def _fetch(self, url, destination):
+        parsed = urlparse(url)
+        if parsed.scheme == "file":
+            shutil.copyfile(url2pathname(parsed.path), destination)
+        else:
+            self.downloader(url, destination)
+
+    def get(self, url, evict=True):
+        """
+        Return the local path of `url`, downloading it only if it is not in the cache. The entry is only pinned
+        during the call, use `use` to keep it while a job reads it.
+        """
+        key = self.key(url)
+        with self._pinned([key]):
+            path = self._get(url, key)
+            if evict:
+                self.evict()
+        return path
+
+    def _get(self, url, key):
+        entry_dir = os.path.join(self.cache_dir, key)
+        path = os.path.join(entry_dir, url_filename(url))
+
+        with self._url_lock(key):
+            if os.path.isfile(path):
+                # The modification time orders the entries for eviction
+                os.utime(path)
+                with self._lock:
+                    self.hits += 1
+                print(f"Download cache hit for {url}")
+                return path
+
+            print(f"Downloading {url} to {path}")
+            # Download next to the cache and move the file in place, a failed download leaves no entry behind
+            partial_dir = tempfile.mkdtemp(prefix=".partial-", dir=self.cache_dir)
+            try:
+                partial_path = os.path.join(partial_dir, url_filename(url))
+                self._fetch(url, partial_path)
+                os.makedirs(entry_dir, exist_ok=True)
+                os.replace(partial_path, path)
+            finally:
+                shutil.rmtree(partial_dir, ignore_errors=True)
+            with self._lock:
+                self.misses += 1
+        return path
+
+    def get_all(self, urls):
+        """Download `urls` in parallel and return their local paths. None of them is evicted by this call."""
+        with self._pinned([self.key(url) for url in urls]):
+            with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+                paths = list(executor.map(lambda url: self.get(url, evict=False), urls))
+            self.evict()
+        return paths
+
+    @contextlib.contextmanager
+    def use(self, urls):
+        """`get_all`, with the entries pinned until the block exits, e.g. while a job renders from them."""
+        with self._pinned([self.key(url) for url in urls]):
+            yield self.get_all(urls)
+
+    def entries(self):
+        """(last use, size in bytes, key) of every cached entry."""
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if key.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            files = [os.path.join(entry_dir, filename) for filename in os.listdir(entry_dir)]
+            if not files:
+                continue
+            last_used = max(os.path.getmtime(file) for file in files)
+            entries.append((last_used, sum(os.path.getsize(file) for file in files), key))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used entries until the cache fits in `max_bytes`, except the keys in `keep` and
+        the pinned ones.
+        """
+        with self._lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in entries:
+                if total <= self.max_bytes:
+                    break
+                if key in keep or self._pins[key] > 0:
+                    continue
+                print(f"Evicting {key} ({size / 1024**2:.1f} MB) from the download cache")
+                shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+                total -= size
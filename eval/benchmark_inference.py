@@ -0,0 +1,207 @@
+"""Benchmark inference variants for throughput and lip-sync quality.
+
+Example:
+    python -m eval.benchmark_inference --variants baseline cpu_int8 --max_conf_drop 0.5
+    python -m eval.benchmark_inference --variants cpu_fp32 cpu_bf16 --max_conf_drop 0.5
+
+Every variant is a set of overrides of the scripts.inference arguments (see VARIANTS). Each one
+renders the demo clips, is timed (model loading is reported separately), and its outputs are
+scored with the SyncNet confidence. With --max_conf_drop the script exits with an error when a
+variant loses more confidence than allowed against the reference variant, so it can be used as a
+regression check.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from statistics import fmean
+
+import torch
+from omegaconf import OmegaConf
+
+from eval.eval_sync_conf import syncnet_eval
+from eval.syncnet import SyncNetEval
+from eval.syncnet_detect import SyncNetDetector
+from scripts.inference import get_device_and_dtype, get_parser, get_pipeline, main as inference_main
+
+VARIANTS = {
+    "baseline": {},
+    "fuse_qkv": {"fuse_qkv": True},
+    "attention_slicing": {"attention_slicing": True},
+    # Token merging in the spatial self-attention, ratios per resolution level
+    "tome_30": {"token_merging_ratios": [0.3]},
+    "tome_50": {"token_merging_ratios": [0.5, 0.3]},
+    "flat_layout": {"flat_layout": True},
+    "flat_layout_channels_last": {"flat_layout": True, "channels_last": True},
+    # Classifier-free guidance on the leading steps only
+    "cfg_end_50": {"guidance_end_fraction": 0.5},
+    "cfg_end_25": {"guidance_end_fraction": 0.25},
+    # Multistep solvers with fewer steps, compare against ddim_8 at the same cost
+    "ddim_8": {"inference_steps": 8},
+    "dpmsolver_6": {"scheduler": "dpmsolver++", "inference_steps": 6},
+    "dpmsolver_10": {"scheduler": "dpmsolver++", "inference_steps": 10},
+    "unipc_6": {"scheduler": "unipc", "inference_steps": 6},
+    "unipc_10": {"scheduler": "unipc", "inference_steps": 10},
+    # Denoise from the noised source faces, only the last fraction of the steps is run
+    "strength_70": {"strength": 0.7},
+    "strength_50": {"strength": 0.5},
+    "strength_30": {"strength": 0.3},
+    "partial_decode": {"partial_decode": True},
+    "deepcache": {"enable_deepcache": True},
+    "compile": {"compile_unet": True},
+    # CPU-only workers, these only take effect when CUDA is not available
+    "cpu_fp32": {"cpu_dtype": "fp32"},
+    "cpu_bf16": {"cpu_dtype": "bf16"},
+    "cpu_int8": {"cpu_dtype": "int8"},
+}
+
+
+def make_inference_args(args, variant, video_path, audio_path, video_out_path):
+    inference_args = get_parser().parse_args(
+        [
+            "--unet_config_path",
+            args.unet_config_path,
+            "--inference_ckpt_path",
+            args.inference_ckpt_path,
+            "--video_path",
+            video_path,
+            "--audio_path",
+            audio_path,
+            "--video_out_path",
+            video_out_path,
+            "--inference_steps",
+            str(args.inference_steps),
+            "--guidance_scale",
+            str(args.guidance_scale),
+            "--seed",
+            str(args.seed),
+            "--temp_dir",
+            os.path.join(args.output_dir, "temp"),
+        ]
+    )
+    for key, value in VARIANTS[variant].items():
+        setattr(inference_args, key, value)
+    return inference_args
+
+
+def run_variant(args, variant, config, syncnet, syncnet_detector):
+    results = []
+    load_time = None
+    for video_path, audio_path in zip(args.video_paths, args.audio_paths):
+        name = f"{os.path.splitext(os.path.basename(video_path))[0]}__{variant}.mp4"
+        video_out_path = os.path.join(args.output_dir, name)
+        inference_args = make_inference_args(args, variant, video_path, audio_path, video_out_path)
+        device, dtype = get_device_and_dtype(inference_args.cpu_dtype)
+
+        if load_time is None:
+            start = time.perf_counter()
+            get_pipeline(config, inference_args, dtype, device)
+            load_time = time.perf_counter() - start
+
+        if device == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        output_path, report = inference_main(config, inference_args, return_report=True)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+
+        av_offset, conf = syncnet_eval(
+            syncnet,
+            syncnet_detector,
+            output_path,
+            os.path.join(args.output_dir, "temp"),
+            detect_results_dir=os.path.join(args.output_dir, "detect_results"),
+        )
+        results.append(
+            {
+                "video_path": video_path,
+                "audio_path": audio_path,
+                "output_path": output_path,
+                "seconds": elapsed,
+                "frames_per_second": report["num_frames"] / elapsed,
+                "sync_conf": conf,
+                "av_offset": av_offset,
+                "report": report,
+            }
+        )
+        print(
+            f"[{variant}] {os.path.basename(video_path)}: {elapsed:.1f} s, "
+            f"{report['num_frames'] / elapsed:.2f} frames/s, sync confidence {conf:.2f}, offset {av_offset}"
+        )
+
+    return {
+        "variant": variant,
+        "overrides": VARIANTS[variant],
+        "device": device,
+        "load_seconds": load_time,
+        "frames_per_second": fmean(r["frames_per_second"] for r in results),
+        "sync_conf": fmean(r["sync_conf"] for r in results),
+        "clips": results,
+    }
+
+
+def main(args):
+    if len(args.video_paths) != len(args.audio_paths):
+        raise ValueError("--video_paths and --audio_paths must have the same length")
+    unknown = [variant for variant in args.variants if variant not in VARIANTS]
+    if unknown:
+        raise ValueError(f"Unknown variants {unknown}, choose from {list(VARIANTS)}")
+    reference = args.reference or args.variants[0]
+    variants = args.variants if reference in args.variants else [reference] + args.variants
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    config = OmegaConf.load(args.unet_config_path)
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    syncnet = SyncNetEval(device=device)
+    syncnet.loadParameters(args.syncnet_model_path)
+    syncnet_detector = SyncNetDetector(device=device, detect_results_dir=os.path.join(args.output_dir, "detect_results"))
+
+    summaries = {variant: run_variant(args, variant, config, syncnet, syncnet_detector) for variant in variants}
+
+    reference_summary = summaries[reference]
+    print(f"\n{'variant':<16}{'load s':>10}{'frames/s':>12}{'speedup':>10}{'sync conf':>12}{'conf drop':>12}")
+    failed = []
+    for variant, summary in summaries.items():
+        speedup = summary["frames_per_second"] / reference_summary["frames_per_second"]
+        conf_drop = reference_summary["sync_conf"] - summary["sync_conf"]
+        summary["speedup"] = speedup
+        summary["conf_drop"] = conf_drop
+        print(
+            f"{variant:<16}{summary['load_seconds']:>10.1f}{summary['frames_per_second']:>12.2f}"
+            f"{speedup:>9.2f}x{summary['sync_conf']:>12.2f}{conf_drop:>12.2f}"
+        )
+        if args.max_conf_drop is not None and conf_drop > args.max_conf_drop:
+            failed.append(variant)
+
+    if args.output_json is not None:
+        with open(args.output_json, "w") as f:
+            json.dump(summaries, f, indent=2)
+        print(f"\nResults saved to {args.output_json}")
+
+    if failed:
+        print(f"\nSync confidence dropped by more than {args.max_conf_drop} against {reference}: {failed}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--variants", type=str, nargs="+", default=["baseline"], help=f"From {list(VARIANTS)}")
+    parser.add_argument("--reference", type=str, default=None, help="Variant to compare against, the first by default")
+    parser.add_argument("--video_paths", type=str, nargs="+", default=["assets/demo1_video.mp4", "assets/demo2_video.mp4"])
+    parser.add_argument("--audio_paths", type=str, nargs="+", default=["assets/demo1_audio.wav", "assets/demo2_audio.wav"])
+    parser.add_argument("--unet_config_path", type=str, default="configs/unet/stage2_512.yaml")
+    parser.add_argument("--inference_ckpt_path", type=str, default="checkpoints/latentsync_unet.pt")
+    parser.add_argument("--syncnet_model_path", type=str, default="checkpoints/auxiliary/syncnet_v2.model")
+    parser.add_argument("--inference_steps", type=int, default=20)
+    parser.add_argument("--guidance_scale", type=float, default=1.5)
+    parser.add_argument("--seed", type=int, default=1247)
+    parser.add_argument("--output_dir", type=str, default="benchmark_results")
+    parser.add_argument("--max_conf_drop", type=float, default=None, help="Fail if the sync confidence drops more")
+    parser.add_argument("--output_json", type=str, default=None)
+    args = parser.parse_args()
+
+    main(args)
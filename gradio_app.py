@@ -1,8 +1,11 @@
 import gradio as gr
 from pathlib import Path
-from scripts.inference import main
+from scripts.inference import get_parser, main
+from latentsync.utils.progressive_writer import hls_playlist_path, list_hls_segments
 from omegaconf import OmegaConf
 import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 CONFIG_PATH = Path("configs/unet/stage2_512.yaml")
@@ -16,6 +19,7 @@ def process_video(
     inference_steps,
     seed,
     remove_background,
+    stream_output,
 ):
     # Create the temp directory if it doesn't exist
     output_dir = Path("./temp")
@@ -40,38 +44,59 @@ def process_video(
     )
 
     # Parse the arguments
-    args = create_args(video_path, audio_path, output_path, inference_steps, guidance_scale, seed, remove_background)
+    args = create_args(
+        video_path, audio_path, output_path, inference_steps, guidance_scale, seed, remove_background, stream_output
+    )
 
     try:
-        result = main(
-            config=config,
-            args=args,
-        )
+        if stream_output:
+            result = yield from stream_render(config, args, output_path)
+        else:
+            result = main(
+                config=config,
+                args=args,
+            )
         print("Processing completed successfully.")
         # Return the actual output path (could be background-removed version)
-        return result if result else output_path
+        yield gr.update(), result if result else output_path
     except Exception as e:
         print(f"Error during processing: {str(e)}")
         raise gr.Error(f"Error during processing: {str(e)}")
 
 
+def stream_render(config, args, output_path):
+    """Renders in a thread and yields its HLS segments to the preview as they are written, returns the output."""
+    playlist_path = hls_playlist_path(output_path)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        render = executor.submit(main, config=config, args=args)
+        num_streamed = 0
+        while True:
+            # Checked before listing, the segments closed when the render ends are streamed in this round
+            finished = render.done()
+            segments = list_hls_segments(playlist_path)
+            for segment in segments[num_streamed:]:
+                yield segment, gr.update()
+            num_streamed = len(segments)
+            if finished:
+                return render.result()
+            time.sleep(0.5)
+
+
 def create_args(
-    video_path: str, audio_path: str, output_path: str, inference_steps: int, guidance_scale: float, seed: int, remove_background: bool
+    video_path: str,
+    audio_path: str,
+    output_path: str,
+    inference_steps: int,
+    guidance_scale: float,
+    seed: int,
+    remove_background: bool,
+    stream_output: bool = False,
 ) -> argparse.Namespace:
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--inference_ckpt_path", type=str, required=True)
-    parser.add_argument("--video_path", type=str, required=True)
-    parser.add_argument("--audio_path", type=str, required=True)
-    parser.add_argument("--video_out_path", type=str, required=True)
-    parser.add_argument("--inference_steps", type=int, default=20)
-    parser.add_argument("--guidance_scale", type=float, default=1.5)
-    parser.add_argument("--temp_dir", type=str, default="temp")
-    parser.add_argument("--seed", type=int, default=1247)
-    parser.add_argument("--enable_deepcache", action="store_true")
-    parser.add_argument("--remove_background", action="store_true")
-
-    return parser.parse_args(
+    # The flags and defaults of scripts/inference.py, only the demo settings are given here
+    return get_parser().parse_args(
         [
+            "--unet_config_path",
+            CONFIG_PATH.absolute().as_posix(),
             "--inference_ckpt_path",
             CHECKPOINT_PATH.absolute().as_posix(),
             "--video_path",
@@ -91,6 +116,7 @@ def create_args(
             "--enable_deepcache",
         ]
         + (["--remove_background"] if remove_background else [])
+        + (["--progressive_output", "hls"] if stream_output else [])
     )
 
 
@@ -129,10 +155,13 @@ with gr.Blocks(title="LatentSync demo") as demo:
             with gr.Row():
                 seed = gr.Number(value=1247, label="Random Seed", precision=0)
                 remove_background = gr.Checkbox(label="Remove Background", value=False)
+                stream_output = gr.Checkbox(label="Stream While Rendering", value=False)
 
             process_btn = gr.Button("Process Video")
 
         with gr.Column():
+            # Plays the first segments while the rest renders (Stream While Rendering)
+            preview_output = gr.Video(label="Preview", streaming=True, autoplay=True)
             video_output = gr.Video(label="Output Video")
 
             gr.Examples(
@@ -153,8 +182,9 @@ with gr.Blocks(title="LatentSync demo") as demo:
             inference_steps,
             seed,
             remove_background,
+            stream_output,
         ],
-        outputs=video_output,
+        outputs=[preview_output, video_output],
     )
 
 if __name__ == "__main__":
@@ -19,7 +19,7 @@ import torch
 import random
 from ..utils.util import gather_video_paths_recursively
 from ..utils.image_processor import ImageProcessor
-from ..utils.audio import melspectrogram
+from ..utils.audio import melspectrogram_torch
 import math
 from pathlib import Path
 
@@ -52,8 +52,9 @@ class SyncNetDataset(Dataset):
 
     def read_audio(self, video_path: str):
         ar = AudioReader(video_path, ctx=cpu(self.worker_id), sample_rate=self.audio_sample_rate)
-        original_mel = melspectrogram(ar[:].asnumpy().squeeze(0))
-        return torch.from_numpy(original_mel)
+        # float64 keeps the result identical to the librosa implementation and to existing mel caches
+        original_mel = melspectrogram_torch(torch.from_numpy(ar[:].asnumpy().squeeze(0)).double())
+        return original_mel
 
     def crop_audio_window(self, original_mel, start_index):
         start_idx = int(80.0 * (start_index / float(self.video_fps)))
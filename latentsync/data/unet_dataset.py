@@ -20,7 +20,7 @@ import torch
 import random
 import cv2
 from ..utils.image_processor import ImageProcessor, load_fixed_mask
-from ..utils.audio import melspectrogram
+from ..utils.audio import melspectrogram_torch
 from decord import AudioReader, VideoReader, cpu
 import torch.nn.functional as F
 from pathlib import Path
@@ -58,8 +58,9 @@ class UNetDataset(Dataset):
 
     def read_audio(self, video_path: str):
         ar = AudioReader(video_path, ctx=cpu(self.worker_id), sample_rate=self.audio_sample_rate)
-        original_mel = melspectrogram(ar[:].asnumpy().squeeze(0))
-        return torch.from_numpy(original_mel)
+        # float64 keeps the result identical to the librosa implementation and to existing mel caches
+        original_mel = melspectrogram_torch(torch.from_numpy(ar[:].asnumpy().squeeze(0)).double())
+        return original_mel
 
     def crop_audio_window(self, original_mel, start_index):
         start_idx = int(80.0 * (start_index / float(self.video_fps)))
@@ -14,6 +14,9 @@ from diffusers.models.attention import FeedForward, AdaLayerNorm
 
 from einops import rearrange, repeat
 
+from ..utils.util import get_free_memory
+from .token_merging import compute_merge
+
 
 @dataclass
 class Transformer3DModelOutput(BaseOutput):
@@ -79,11 +82,17 @@ class Transformer3DModel(ModelMixin, ConfigMixin):
         else:
             self.proj_out = nn.Conv2d(inner_dim, in_channels, kernel_size=1, stride=1, padding=0)
 
-    def forward(self, hidden_states, encoder_hidden_states=None, timestep=None, return_dict: bool = True):
+    def forward(
+        self, hidden_states, encoder_hidden_states=None, timestep=None, return_dict: bool = True, video_length=None
+    ):
         # Input
-        assert hidden_states.dim() == 5, f"Expected hidden_states to have ndim=5, but got ndim={hidden_states.dim()}."
-        video_length = hidden_states.shape[2]
-        hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
+        flat = hidden_states.dim() == 4
+        if flat:
+            assert video_length is not None, "video_length is required for flattened (b f) c h w input"
+        else:
+            assert hidden_states.dim() == 5, f"Expected hidden_states to have ndim=5, but got ndim={hidden_states.dim()}."
+            video_length = hidden_states.shape[2]
+            hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
 
         batch, channel, height, weight = hidden_states.shape
         residual = hidden_states
@@ -105,19 +114,26 @@ class Transformer3DModel(ModelMixin, ConfigMixin):
                 encoder_hidden_states=encoder_hidden_states,
                 timestep=timestep,
                 video_length=video_length,
+                spatial_size=(height, weight),
             )
 
         # Output
+        # In the flattened layout the permuted tokens are already a channels_last tensor, so they are not copied
         if not self.use_linear_projection:
-            hidden_states = hidden_states.reshape(batch, height, weight, inner_dim).permute(0, 3, 1, 2).contiguous()
+            hidden_states = hidden_states.reshape(batch, height, weight, inner_dim).permute(0, 3, 1, 2)
+            if not flat:
+                hidden_states = hidden_states.contiguous()
             hidden_states = self.proj_out(hidden_states)
         else:
             hidden_states = self.proj_out(hidden_states)
-            hidden_states = hidden_states.reshape(batch, height, weight, inner_dim).permute(0, 3, 1, 2).contiguous()
+            hidden_states = hidden_states.reshape(batch, height, weight, inner_dim).permute(0, 3, 1, 2)
+            if not flat:
+                hidden_states = hidden_states.contiguous()
 
         output = hidden_states + residual
 
-        output = rearrange(output, "(b f) c h w -> b c f h w", f=video_length)
+        if not flat:
+            output = rearrange(output, "(b f) c h w -> b c f h w", f=video_length)
         if not return_dict:
             return (output,)
 
@@ -171,14 +187,30 @@ class BasicTransformerBlock(nn.Module):
         self.ff = FeedForward(dim, dropout=dropout, activation_fn=activation_fn)
         self.norm3 = nn.LayerNorm(dim)
 
+        # Token merging around the self-attention, see UNet3DConditionModel.set_token_merging
+        self.token_merge_ratio = 0.0
+        self.token_merge_mask = None
+
     def forward(
-        self, hidden_states, encoder_hidden_states=None, timestep=None, attention_mask=None, video_length=None
+        self,
+        hidden_states,
+        encoder_hidden_states=None,
+        timestep=None,
+        attention_mask=None,
+        video_length=None,
+        spatial_size=None,
     ):
         norm_hidden_states = (
             self.norm1(hidden_states, timestep) if self.use_ada_layer_norm else self.norm1(hidden_states)
         )
 
-        hidden_states = self.attn1(norm_hidden_states, attention_mask=attention_mask) + hidden_states
+        if self.token_merge_ratio > 0 and spatial_size is not None and attention_mask is None:
+            merge, unmerge = compute_merge(
+                norm_hidden_states, spatial_size, self.token_merge_ratio, merge_mask=self.token_merge_mask
+            )
+            hidden_states = unmerge(self.attn1(merge(norm_hidden_states))) + hidden_states
+        else:
+            hidden_states = self.attn1(norm_hidden_states, attention_mask=attention_mask) + hidden_states
 
         if self.attn2 is not None and encoder_hidden_states is not None:
             if encoder_hidden_states.dim() == 4:
@@ -214,6 +246,7 @@ class Attention(nn.Module):
     ):
         super().__init__()
         inner_dim = dim_head * heads
+        self.is_self_attention = cross_attention_dim is None
         cross_attention_dim = cross_attention_dim if cross_attention_dim is not None else query_dim
         self.upcast_attention = upcast_attention
         self.upcast_softmax = upcast_softmax
@@ -235,6 +268,110 @@ class Attention(nn.Module):
         self.to_out.append(nn.Linear(inner_dim, query_dim))
         self.to_out.append(nn.Dropout(dropout))
 
+        self.fused_projections = False
+
+        self.sliceable_head_dim = heads
+        self.slice_size = None
+        self.attention_memory_budget = None
+        # Measured once per forward by the UNet when no budget is set
+        self.forward_memory_budget = None
+
+    def set_attention_slice(self, slice_size, memory_budget=None):
+        """
+        Compute attention `slice_size` heads at a time, and split the queries into chunks so that the attention
+        scores of one chunk fit into `memory_budget` bytes (half of the free memory when not given, measured once per
+        UNet forward, see `forward_memory_budget`). The result is the same as the full attention. `slice_size=None`
+        disables slicing.
+        """
+        if slice_size is not None and not 1 <= slice_size <= self.sliceable_head_dim:
+            raise ValueError(f"slice_size must be between 1 and {self.sliceable_head_dim}, got {slice_size}")
+        self.slice_size = slice_size
+        self.attention_memory_budget = memory_budget
+
+    def get_memory_budget(self, device) -> int:
+        if self.attention_memory_budget is not None:
+            return self.attention_memory_budget
+        if self.forward_memory_budget is not None:
+            return self.forward_memory_budget
+        return get_free_memory(device) // 2
+
+    def query_chunk_size(self, query, key, num_heads, memory_budget=None):
+        if memory_budget is None:
+            memory_budget = self.get_memory_budget(query.device)
+        batch_size, _, query_length, _ = query.shape
+        # attention scores and their softmax, for every query of the chunk
+        bytes_per_query = 2 * batch_size * num_heads * key.shape[2] * query.element_size()
+        return max(1, min(query_length, memory_budget // bytes_per_query))
+
+    def compute_attention(self, query, key, value, attention_mask=None):
+        if self.slice_size is None or attention_mask is not None:
+            # Use PyTorch native implementation of FlashAttention-2
+            return F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask)
+
+        batch_size, heads, query_length, _ = query.shape
+        hidden_states = query.new_empty(batch_size, heads, query_length, value.shape[-1])
+        memory_budget = self.get_memory_budget(query.device)
+        for head_start in range(0, heads, self.slice_size):
+            head_slice = slice(head_start, head_start + self.slice_size)
+            chunk_size = self.query_chunk_size(query, key, min(self.slice_size, heads - head_start), memory_budget)
+            for query_start in range(0, query_length, chunk_size):
+                query_slice = slice(query_start, query_start + chunk_size)
+                hidden_states[:, head_slice, query_slice] = F.scaled_dot_product_attention(
+                    query[:, head_slice, query_slice], key[:, head_slice], value[:, head_slice]
+                )
+        return hidden_states
+
+    @torch.no_grad()
+    def fuse_projections(self):
+        """
+        Replace `to_q`, `to_k` and `to_v` with a single `to_qkv` projection holding the packed weights, so that
+        self-attention computes the query, key and value with one matmul. Cross-attention layers are left as is,
+        since their key and value are computed from a different input.
+        """
+        if self.fused_projections or not self.is_self_attention:
+            return
+
+        weight = torch.cat([self.to_q.weight, self.to_k.weight, self.to_v.weight])
+        has_bias = self.to_q.bias is not None
+        self.to_qkv = nn.Linear(
+            weight.shape[1], weight.shape[0], bias=has_bias, device=weight.device, dtype=weight.dtype
+        )
+        self.to_qkv.weight.copy_(weight)
+        if has_bias:
+            self.to_qkv.bias.copy_(torch.cat([self.to_q.bias, self.to_k.bias, self.to_v.bias]))
+
+        del self.to_q, self.to_k, self.to_v
+        self.fused_projections = True
+
+    @torch.no_grad()
+    def unfuse_projections(self):
+        if not self.fused_projections:
+            return
+
+        weights = self.to_qkv.weight.chunk(3)
+        biases = self.to_qkv.bias.chunk(3) if self.to_qkv.bias is not None else (None, None, None)
+        for name, weight, bias in zip(("to_q", "to_k", "to_v"), weights, biases):
+            linear = nn.Linear(
+                weight.shape[1], weight.shape[0], bias=bias is not None, device=weight.device, dtype=weight.dtype
+            )
+            linear.weight.copy_(weight)
+            if bias is not None:
+                linear.bias.copy_(bias)
+            setattr(self, name, linear)
+
+        del self.to_qkv
+        self.fused_projections = False
+
+    def project_qkv(self, hidden_states, encoder_hidden_states=None):
+        if self.fused_projections and encoder_hidden_states is None:
+            return self.to_qkv(hidden_states).chunk(3, dim=-1)
+
+        query = self.to_q(hidden_states)
+        encoder_hidden_states = encoder_hidden_states if encoder_hidden_states is not None else hidden_states
+        key = self.to_k(encoder_hidden_states)
+        value = self.to_v(encoder_hidden_states)
+        return query, key, value
+
     def split_heads(self, tensor):
         batch_size, seq_len, dim = tensor.shape
         tensor = tensor.reshape(batch_size, seq_len, self.heads, dim // self.heads)
@@ -251,13 +388,9 @@ class Attention(nn.Module):
         if self.group_norm is not None:
             hidden_states = self.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-        query = self.to_q(hidden_states)
-        query = self.split_heads(query)
-
-        encoder_hidden_states = encoder_hidden_states if encoder_hidden_states is not None else hidden_states
-        key = self.to_k(encoder_hidden_states)
-        value = self.to_v(encoder_hidden_states)
+        query, key, value = self.project_qkv(hidden_states, encoder_hidden_states)
 
+        query = self.split_heads(query)
         key = self.split_heads(key)
         value = self.split_heads(value)
 
@@ -267,8 +400,7 @@ class Attention(nn.Module):
                 attention_mask = F.pad(attention_mask, (0, target_length), value=0.0)
                 attention_mask = attention_mask.repeat_interleave(self.heads, dim=0)
 
-        # Use PyTorch native implementation of FlashAttention-2
-        hidden_states = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask)
+        hidden_states = self.compute_attention(query, key, value, attention_mask)
 
         hidden_states = self.concat_heads(hidden_states)
 
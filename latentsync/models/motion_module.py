@@ -67,7 +67,11 @@ class VanillaTemporalModule(nn.Module):
 
     def forward(self, input_tensor, temb, encoder_hidden_states, attention_mask=None, anchor_frame_idx=None):
         hidden_states = input_tensor
-        hidden_states = self.temporal_transformer(hidden_states, encoder_hidden_states, attention_mask)
+        # A flattened (b f) c h w input carries the number of frames in the batch of temb
+        video_length = hidden_states.shape[0] // temb.shape[0] if hidden_states.dim() == 4 else None
+        hidden_states = self.temporal_transformer(
+            hidden_states, encoder_hidden_states, attention_mask, video_length=video_length
+        )
 
         output = hidden_states
         return output
@@ -123,11 +127,12 @@ class TemporalTransformer3DModel(nn.Module):
         )
         self.proj_out = nn.Linear(inner_dim, in_channels)
 
-    def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None):
-        assert hidden_states.dim() == 5, f"Expected hidden_states to have ndim=5, but got ndim={hidden_states.dim()}."
-        video_length = hidden_states.shape[2]
-        hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
+    def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, video_length=None):
+        if hidden_states.dim() == 5:
+            return self.forward_video(hidden_states, encoder_hidden_states)
 
+        # Flattened (b f) c h w input
+        assert video_length is not None, "video_length is required for flattened (b f) c h w input"
         batch, channel, height, weight = hidden_states.shape
         residual = hidden_states
 
@@ -143,10 +148,57 @@ class TemporalTransformer3DModel(nn.Module):
 
         # output
         hidden_states = self.proj_out(hidden_states)
-        hidden_states = hidden_states.reshape(batch, height, weight, channel).permute(0, 3, 1, 2).contiguous()
+        hidden_states = hidden_states.reshape(batch, height, weight, channel).permute(0, 3, 1, 2)
+
+        # Adding the residual gives the output the memory format of the input, no copy is needed
+        output = residual + hidden_states
+
+        return output
+
+    def forward_video(self, hidden_states, encoder_hidden_states=None):
+        # b c f h w input. The per-frame GroupNorm and the move to a (b f) (h w) c token layout are done in one pass
+        # over the activation, and the output is written in the input layout by the residual addition, instead of
+        # rearranging to (b f) c h w and back and copying the tokens in and out of the channels-last layout.
+        batch, channel, video_length, height, weight = hidden_states.shape
+        residual = hidden_states
+
+        groups = self.norm.num_groups
+        grouped = hidden_states.view(batch, groups, channel // groups, video_length, height, weight)
+        var, mean = torch.var_mean(grouped, dim=(2, 4, 5), unbiased=False, keepdim=True)
+        scale = torch.rsqrt(var.float() + self.norm.eps)
+        shift = -mean.float() * scale
+        if self.norm.affine:
+            norm_weight = self.norm.weight.float().view(1, groups, channel // groups, 1, 1, 1)
+            norm_bias = self.norm.bias.float().view(1, groups, channel // groups, 1, 1, 1)
+            scale = scale * norm_weight
+            shift = shift * norm_weight + norm_bias
+
+        # (b, c, f, 1, 1) scale and shift, viewed like the input as b f h w c
+        expanded_shape = (batch, groups, channel // groups, video_length, 1, 1)
+        scale = scale.to(hidden_states.dtype).expand(expanded_shape).reshape(batch, channel, video_length, 1, 1)
+        shift = shift.to(hidden_states.dtype).expand(expanded_shape).reshape(batch, channel, video_length, 1, 1)
+        scale, shift, channels_last = (x.permute(0, 2, 3, 4, 1) for x in (scale, shift, hidden_states))
+        if torch.is_grad_enabled():
+            tokens = torch.addcmul(shift, channels_last, scale).reshape(batch * video_length, height * weight, channel)
+        else:
+            tokens = hidden_states.new_empty(batch, video_length, height, weight, channel)
+            torch.addcmul(shift, channels_last, scale, out=tokens)
+            tokens = tokens.view(batch * video_length, height * weight, channel)
+
+        hidden_states = self.proj_in(tokens)
+
+        # Transformer Blocks
+        for block in self.transformer_blocks:
+            hidden_states = block(
+                hidden_states, encoder_hidden_states=encoder_hidden_states, video_length=video_length
+            )
+
+        # output
+        hidden_states = self.proj_out(hidden_states)
+        hidden_states = hidden_states.view(batch, video_length, height, weight, channel).permute(0, 4, 1, 2, 3)
 
-        output = hidden_states + residual
-        output = rearrange(output, "(b f) c h w -> b c f h w", f=video_length)
+        # The residual comes first so that the output has its (contiguous b c f h w) layout
+        output = residual + hidden_states
 
         return output
 
@@ -256,10 +308,55 @@ class VersatileAttention(Attention):
             else None
         )
 
+        # Attend over the frames on strided views of the (b f) s c layout, instead of on rearranged copies
+        self.strided_attention = True
+
     def extra_repr(self):
         return f"(Module Info) Attention_Mode: {self.attention_mode}, Is_Cross_Attention: {self.is_cross_attention}"
 
+    def temporal_heads(self, tensor, video_length):
+        # (b f) s (heads d) -> (b, s * heads, f, d), a strided view when the tensor is contiguous
+        batch_frames, seq_len, dim = tensor.shape
+        tensor = tensor.reshape(batch_frames // video_length, video_length, seq_len * self.heads, dim // self.heads)
+        return tensor.transpose(1, 2)
+
     def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, video_length=None):
+        if self.attention_mode != "Temporal":
+            raise NotImplementedError
+        if (
+            not self.strided_attention
+            or encoder_hidden_states is not None
+            or attention_mask is not None
+            or self.group_norm is not None
+            or self.slice_size is not None
+        ):
+            return self.forward_rearranged(hidden_states, encoder_hidden_states, attention_mask, video_length)
+
+        # Self-attention over the frames of every token, computed on views of the (b f) s c layout: the spatial
+        # tokens and the heads are the batch dimension of the attention, the frames its sequence dimension
+        batch_frames, seq_len, channels = hidden_states.shape
+        if self.pos_encoder is not None:
+            pe = self.pos_encoder.pe[:, :video_length, None]  # (1, f, 1, c)
+            hidden_states = hidden_states.view(-1, video_length, seq_len, channels) + pe
+            hidden_states = self.pos_encoder.dropout(hidden_states).view(batch_frames, seq_len, channels)
+
+        query, key, value = self.project_qkv(hidden_states)
+        query, key, value = (self.temporal_heads(x, video_length) for x in (query, key, value))
+
+        hidden_states = F.scaled_dot_product_attention(query, key, value)
+
+        # (b, s * heads, f, d) -> (b f) s (heads d), the only copy of the attention output
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_frames, seq_len, -1)
+
+        # linear proj
+        hidden_states = self.to_out[0](hidden_states)
+
+        # dropout
+        hidden_states = self.to_out[1](hidden_states)
+
+        return hidden_states
+
+    def forward_rearranged(self, hidden_states, encoder_hidden_states=None, attention_mask=None, video_length=None):
         if self.attention_mode == "Temporal":
             s = hidden_states.shape[1]
             hidden_states = rearrange(hidden_states, "(b f) s c -> (b s) f c", f=video_length)
@@ -280,13 +377,9 @@ class VersatileAttention(Attention):
         if self.group_norm is not None:
             hidden_states = self.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-        query = self.to_q(hidden_states)
-        query = self.split_heads(query)
-
-        encoder_hidden_states = encoder_hidden_states if encoder_hidden_states is not None else hidden_states
-        key = self.to_k(encoder_hidden_states)
-        value = self.to_v(encoder_hidden_states)
+        query, key, value = self.project_qkv(hidden_states, encoder_hidden_states)
 
+        query = self.split_heads(query)
         key = self.split_heads(key)
         value = self.split_heads(value)
 
@@ -296,8 +389,7 @@ class VersatileAttention(Attention):
                 attention_mask = F.pad(attention_mask, (0, target_length), value=0.0)
                 attention_mask = attention_mask.repeat_interleave(self.heads, dim=0)
 
-        # Use PyTorch native implementation of FlashAttention-2
-        hidden_states = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask)
+        hidden_states = self.compute_attention(query, key, value, attention_mask)
 
         hidden_states = self.concat_heads(hidden_states)
 
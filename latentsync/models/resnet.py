@@ -1,5 +1,7 @@
 # Adapted from https://github.com/huggingface/diffusers/blob/main/src/diffusers/models/resnet.py
 
+from typing import Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -7,8 +9,48 @@ import torch.nn.functional as F
 from einops import rearrange
 
 
+def group_norm_silu(
+    x: torch.Tensor, norm: nn.GroupNorm, video_length: Optional[int] = None, silu: bool = True
+) -> torch.Tensor:
+    """
+    GroupNorm (optionally followed by SiLU) of a flattened (b f) c h w tensor.
+
+    With `video_length`, the statistics of every group are pooled over the frames of each video, which is what
+    `nn.GroupNorm` computes on a b c f h w tensor. The affine parameters are folded into a single scale and shift,
+    so the normalization and the SiLU are two elementwise passes that keep the memory format of the input.
+    Without `video_length`, every frame is normalized on its own, like `InflatedGroupNorm`.
+    """
+    if video_length is None:
+        x = norm(x)
+        return F.silu(x, inplace=True) if silu else x
+
+    batch_frames, channels, height, width = x.shape
+    batch, groups = batch_frames // video_length, norm.num_groups
+    # Splitting the batch and the channel dimensions is a view for both NCHW and channels_last tensors
+    grouped = x.view(batch, video_length, groups, channels // groups, height, width)
+    var, mean = torch.var_mean(grouped, dim=(1, 3, 4, 5), unbiased=False, keepdim=True)
+    scale = torch.rsqrt(var.float() + norm.eps)
+    shift = -mean.float() * scale
+    if norm.affine:
+        weight = norm.weight.float().view(1, 1, groups, channels // groups, 1, 1)
+        bias = norm.bias.float().view(1, 1, groups, channels // groups, 1, 1)
+        scale = scale * weight
+        shift = shift * weight + bias
+
+    # Per frame and channel scale and shift, the output keeps the memory format of x
+    expanded_shape = (batch, video_length, groups, channels // groups, 1, 1)
+    scale = scale.to(x.dtype).expand(expanded_shape).reshape(batch_frames, channels, 1, 1)
+    shift = shift.to(x.dtype).expand(expanded_shape).reshape(batch_frames, channels, 1, 1)
+    x = torch.addcmul(shift, x, scale)
+    return F.silu(x, inplace=True) if silu else x
+
+
 class InflatedConv3d(nn.Conv2d):
     def forward(self, x):
+        # Flattened (b f) c h w input, see UNet3DConditionModel.enable_flat_layout
+        if x.dim() == 4:
+            return super().forward(x)
+
         video_length = x.shape[2]
 
         x = rearrange(x, "b c f h w -> (b f) c h w")
@@ -20,6 +62,9 @@ class InflatedConv3d(nn.Conv2d):
 
 class InflatedGroupNorm(nn.GroupNorm):
     def forward(self, x):
+        if x.dim() == 4:
+            return super().forward(x)
+
         video_length = x.shape[2]
 
         x = rearrange(x, "b c f h w -> (b f) c h w")
@@ -62,7 +107,8 @@ class Upsample3D(nn.Module):
         # if `output_size` is passed we force the interpolation output
         # size and do not make use of `scale_factor=2`
         if output_size is None:
-            hidden_states = F.interpolate(hidden_states, scale_factor=[1.0, 2.0, 2.0], mode="nearest")
+            scale_factor = 2.0 if hidden_states.dim() == 4 else [1.0, 2.0, 2.0]
+            hidden_states = F.interpolate(hidden_states, scale_factor=scale_factor, mode="nearest")
         else:
             hidden_states = F.interpolate(hidden_states, size=output_size, mode="nearest")
 
@@ -166,6 +212,7 @@ class ResnetBlock3D(nn.Module):
         self.dropout = torch.nn.Dropout(dropout)
         self.conv2 = InflatedConv3d(out_channels, out_channels, kernel_size=3, stride=1, padding=1)
 
+        self.fused_silu = non_linearity in ("swish", "silu")
         if non_linearity == "swish":
             self.nonlinearity = lambda x: F.silu(x)
         elif non_linearity == "mish":
@@ -180,6 +227,9 @@ class ResnetBlock3D(nn.Module):
             self.conv_shortcut = InflatedConv3d(in_channels, out_channels, kernel_size=1, stride=1, padding=0)
 
     def forward(self, input_tensor, temb):
+        if input_tensor.dim() == 4:
+            return self.forward_flat(input_tensor, temb)
+
         hidden_states = input_tensor
 
         hidden_states = self.norm1(hidden_states)
@@ -222,6 +272,53 @@ class ResnetBlock3D(nn.Module):
 
         return output_tensor
 
+    def forward_flat(self, input_tensor, temb):
+        # Same computation as `forward` on a flattened (b f) c h w tensor, the frames of a video are consecutive
+        if temb is None:
+            raise ValueError("The flattened layout needs temb to recover the number of frames")
+        video_length = input_tensor.shape[0] // temb.shape[0]
+
+        def norm_act(hidden_states, norm, act=True):
+            # nn.GroupNorm on a 5D tensor pools the statistics over the frames, InflatedGroupNorm does not
+            stats_video_length = None if isinstance(norm, InflatedGroupNorm) else video_length
+            if self.fused_silu:
+                return group_norm_silu(hidden_states, norm, stats_video_length, silu=act)
+            hidden_states = group_norm_silu(hidden_states, norm, stats_video_length, silu=False)
+            return self.nonlinearity(hidden_states) if act else hidden_states
+
+        hidden_states = norm_act(input_tensor, self.norm1)
+        hidden_states = self.conv1(hidden_states)
+
+        if temb.dim() == 2:
+            temb = self.time_emb_proj(self.nonlinearity(temb))
+            temb = temb.repeat_interleave(video_length, dim=0)
+        else:
+            temb = temb.permute(0, 2, 1)
+            temb = self.time_emb_proj(self.nonlinearity(temb))
+            if self.double_len_linear is not None:
+                temb = self.double_len_linear(self.nonlinearity(temb))
+            temb = temb.reshape(-1, temb.shape[-1])
+        temb = temb[:, :, None, None]
+
+        if self.time_embedding_norm == "default":
+            hidden_states = hidden_states + temb
+            hidden_states = norm_act(hidden_states, self.norm2)
+        else:
+            hidden_states = norm_act(hidden_states, self.norm2, act=False)
+            scale, shift = torch.chunk(temb, 2, dim=1)
+            hidden_states = hidden_states * (1 + scale) + shift
+            hidden_states = self.nonlinearity(hidden_states)
+
+        hidden_states = self.dropout(hidden_states)
+        hidden_states = self.conv2(hidden_states)
+
+        if self.conv_shortcut is not None:
+            input_tensor = self.conv_shortcut(input_tensor)
+
+        output_tensor = (input_tensor + hidden_states) / self.output_scale_factor
+
+        return output_tensor
+
 
 class Mish(torch.nn.Module):
     def forward(self, hidden_states):
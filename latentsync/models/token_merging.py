@@ -0,0 +1,147 @@
+# Adapted from https://github.com/dbolya/tomesd/blob/main/tomesd/merge.py
+
+from typing import Callable, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+
+def do_nothing(x: torch.Tensor) -> torch.Tensor:
+    return x
+
+
+def resize_merge_mask(mask: torch.Tensor, height: int, width: int, device) -> torch.Tensor:
+    """
+    Downsample a (H, W) mask, 1 where tokens may be merged, to the token grid. Only tokens that lie entirely
+    inside the mergeable region are kept mergeable.
+    """
+    mask = mask.to(device=device, dtype=torch.float32)[None, None]
+    mask = F.interpolate(mask, size=(height, width), mode="area")[0, 0]
+    return mask.flatten() > 1 - 1e-3
+
+
+def bipartite_soft_matching_2d(
+    metric: torch.Tensor,
+    height: int,
+    width: int,
+    sx: int,
+    sy: int,
+    r: int,
+    merge_mask: Optional[torch.Tensor] = None,
+) -> Tuple[Callable, Callable]:
+    """
+    Partition the tokens into destinations (the top-left token of every sx x sy patch) and sources, and merge the
+    r sources that are most similar to a destination into it. Unlike tomesd, the destinations are not chosen at
+    random, so the result is deterministic and no random numbers are drawn.
+
+    Args:
+        metric: (B, N, C) tokens used to compute the similarity, N == height * width
+        merge_mask: optional (N,) bool tensor, tokens that are False are neither merged nor merged into
+    Returns:
+        The merge and unmerge functions.
+    """
+    B, N, _ = metric.shape
+
+    if r <= 0:
+        return do_nothing, do_nothing
+
+    gather = torch.gather
+
+    with torch.no_grad():
+        hsy, wsx = height // sy, width // sx
+
+        # For each sy x sx patch, the first token is the destination
+        idx_buffer_view = torch.zeros(hsy, wsx, sy * sx, device=metric.device, dtype=torch.int64)
+        idx_buffer_view[:, :, 0] = -1
+        idx_buffer_view = idx_buffer_view.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy * sy, wsx * sx)
+
+        # Tokens that do not fit into a whole patch are sources
+        if (hsy * sy) < height or (wsx * sx) < width:
+            idx_buffer = torch.zeros(height, width, device=metric.device, dtype=torch.int64)
+            idx_buffer[: (hsy * sy), : (wsx * sx)] = idx_buffer_view
+        else:
+            idx_buffer = idx_buffer_view
+
+        # Destinations first, then sources, both in raster order
+        rand_idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1, stable=True)
+        del idx_buffer, idx_buffer_view
+
+        num_dst = hsy * wsx
+        a_idx = rand_idx[:, num_dst:, :]  # src
+        b_idx = rand_idx[:, :num_dst, :]  # dst
+
+        def split(x):
+            C = x.shape[-1]
+            src = gather(x, dim=1, index=a_idx.expand(B, N - num_dst, C))
+            dst = gather(x, dim=1, index=b_idx.expand(B, num_dst, C))
+            return src, dst
+
+        # Cosine similarity between the sources and the destinations
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+
+        r = min(a.shape[1], r)
+        if merge_mask is not None:
+            src_mergeable = merge_mask[a_idx[0, :, 0]]
+            dst_mergeable = merge_mask[b_idx[0, :, 0]]
+            scores[:, :, ~dst_mergeable] = -torch.inf
+            scores[:, ~src_mergeable, :] = -torch.inf
+            r = min(r, int(src_mergeable.sum()) if dst_mergeable.any() else 0)
+            if r <= 0:
+                return do_nothing, do_nothing
+
+        # Find the most similar greedily
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+
+        unm_idx = edge_idx[..., r:, :]  # Unmerged tokens
+        src_idx = edge_idx[..., :r, :]  # Merged tokens
+        dst_idx = gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
+        src, dst = split(x)
+        n, t1, c = src.shape
+
+        unm = gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x: torch.Tensor) -> torch.Tensor:
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        _, _, c = unm.shape
+
+        src = gather(dst, dim=-2, index=dst_idx.expand(B, r, c))
+
+        # Combine back to the original shape
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(B, num_dst, c), src=dst)
+        out.scatter_(
+            dim=-2, index=gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=unm_idx).expand(B, unm_len, c), src=unm
+        )
+        out.scatter_(
+            dim=-2, index=gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=src_idx).expand(B, r, c), src=src
+        )
+
+        return out
+
+    return merge, unmerge
+
+
+def compute_merge(
+    hidden_states: torch.Tensor,
+    spatial_size: Tuple[int, int],
+    ratio: float,
+    merge_mask: Optional[torch.Tensor] = None,
+    stride: Tuple[int, int] = (2, 2),
+) -> Tuple[Callable, Callable]:
+    """Build the merge and unmerge functions that remove `ratio` of the tokens of a (B, H * W, C) frame."""
+    height, width = spatial_size
+    r = int(hidden_states.shape[1] * ratio)
+    if merge_mask is not None:
+        merge_mask = resize_merge_mask(merge_mask, height, width, hidden_states.device)
+    sx, sy = stride
+    return bipartite_soft_matching_2d(hidden_states, height, width, sx, sy, r, merge_mask)
@@ -7,6 +7,7 @@ import copy
 import torch
 import torch.nn as nn
 import torch.utils.checkpoint
+from einops import rearrange
 
 from diffusers.configuration_utils import ConfigMixin, register_to_config
 from diffusers.models import ModelMixin
@@ -22,9 +23,10 @@ from .unet_blocks import (
     get_down_block,
     get_up_block,
 )
-from .resnet import InflatedConv3d, InflatedGroupNorm
+from .resnet import InflatedConv3d, InflatedGroupNorm, group_norm_silu
+from .attention import Attention, BasicTransformerBlock
 
-from ..utils.util import zero_rank_log
+from ..utils.util import get_free_memory, zero_rank_log
 from .utils import zero_module
 
 
@@ -240,7 +242,89 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
 
         self.conv_out = zero_module(InflatedConv3d(block_out_channels[0], out_channels, kernel_size=3, padding=1))
 
-    def set_attention_slice(self, slice_size):
+        self.deepcache_interval = None
+        self.deepcache_branch_id = 0
+        self.reset_deepcache()
+
+        self.flat_layout = False
+        self.flat_layout_channels_last = False
+
+        # Sliced attention layers whose memory budget is measured at the start of every forward
+        self._measured_attention_layers = []
+
+    def enable_flat_layout(self, channels_last: bool = True):
+        r"""
+        Run inference in a flattened (b f) c h w layout. The input is flattened once before `conv_in` and restored
+        after `conv_out`, instead of every convolution, norm and transformer rearranging b c f h w back and forth.
+        GroupNorm and SiLU are fused into one scale/shift and one activation pass, with the same statistics as the
+        5D path (pooled over the frames for `nn.GroupNorm`, per frame for `InflatedGroupNorm`).
+
+        With `channels_last`, the weights and the activations use the channels_last memory format, which the
+        cuDNN and oneDNN convolutions prefer, and the output of the transformers is not copied back to NCHW.
+        The flattened layout is not used in training mode or when controlnet residuals are passed.
+        """
+        self.flat_layout = True
+        self.flat_layout_channels_last = channels_last
+        self.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+        self.reset_deepcache()
+
+    def disable_flat_layout(self):
+        if self.flat_layout_channels_last:
+            self.to(memory_format=torch.contiguous_format)
+        self.flat_layout = False
+        self.flat_layout_channels_last = False
+        self.reset_deepcache()
+
+    def enable_deepcache(self, cache_interval: int = 3, cache_branch_id: int = 0):
+        r"""
+        Enable DeepCache-style feature reuse (https://arxiv.org/abs/2312.00858) during inference.
+
+        Every `cache_interval`-th call runs the full UNet and caches the input of the up block that mirrors down
+        block `cache_branch_id`. The calls in between only run `conv_in`, the first `cache_branch_id + 1` down
+        blocks and the last `cache_branch_id + 1` up blocks, on top of the cached deep features. The cache holds the
+        whole batch, so it works with classifier-free guidance batching.
+
+        The step counter restarts when the timestep increases (a new denoising trajectory) and a full step is
+        run whenever the batch shape changes; call `reset_deepcache` to restart it explicitly.
+        """
+        if cache_interval < 1:
+            raise ValueError(f"cache_interval must be at least 1, got {cache_interval}")
+        if not 0 <= cache_branch_id < len(self.down_blocks) - 1:
+            raise ValueError(f"cache_branch_id must be between 0 and {len(self.down_blocks) - 2}, got {cache_branch_id}")
+        self.deepcache_interval = cache_interval
+        self.deepcache_branch_id = cache_branch_id
+        self.reset_deepcache()
+
+    def disable_deepcache(self):
+        self.deepcache_interval = None
+        self.reset_deepcache()
+
+    def reset_deepcache(self):
+        self._deepcache_step = 0
+        self._deepcache_timestep = None
+        self._deepcache_features = None
+        self._deepcache_input_shape = None
+
+    def _use_deepcache(self, sample: torch.Tensor, timesteps: torch.Tensor) -> bool:
+        if self.deepcache_interval is None or self.training:
+            return False
+
+        timestep = timesteps.max().item()
+        if self._deepcache_timestep is not None and timestep > self._deepcache_timestep:
+            self.reset_deepcache()
+        self._deepcache_timestep = timestep
+
+        cached_features = self._deepcache_features
+        use_cache = (
+            self._deepcache_step % self.deepcache_interval != 0
+            and cached_features is not None
+            and self._deepcache_input_shape == sample.shape
+            and cached_features.dtype == sample.dtype
+        )
+        self._deepcache_step += 1
+        return use_cache
+
+    def set_attention_slice(self, slice_size, memory_budget=None):
         r"""
         Enable sliced attention computation.
 
@@ -252,7 +336,11 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
                 When `"auto"`, halves the input to the attention heads, so attention will be computed in two steps. If
                 `"max"`, maxium amount of memory will be saved by running only one slice at a time. If a number is
                 provided, uses as many slices as `attention_head_dim // slice_size`. In this case, `attention_head_dim`
-                must be a multiple of `slice_size`.
+                must be a multiple of `slice_size`. `None` disables slicing.
+            memory_budget (`int`, *optional*):
+                Bytes the attention scores of one slice may take. The queries of each slice are split into chunks
+                that fit into it. Defaults to half of the free device memory, measured once at the start of every
+                forward and shared by all layers.
         """
         sliceable_head_dims = []
 
@@ -272,7 +360,7 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         if slice_size == "auto":
             # half the attention head size is usually a good trade-off between
             # speed and memory
-            slice_size = [dim // 2 for dim in sliceable_head_dims]
+            slice_size = [max(dim // 2, 1) for dim in sliceable_head_dims]
         elif slice_size == "max":
             # make smallest slice possible
             slice_size = num_slicable_layers * [1]
@@ -296,7 +384,7 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         # gets the message
         def fn_recursive_set_attention_slice(module: torch.nn.Module, slice_size: List[int]):
             if hasattr(module, "set_attention_slice"):
-                module.set_attention_slice(slice_size.pop())
+                module.set_attention_slice(slice_size.pop(), memory_budget)
 
             for child in module.children():
                 fn_recursive_set_attention_slice(child, slice_size)
@@ -305,6 +393,79 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         for module in self.children():
             fn_recursive_set_attention_slice(module, reversed_slice_size)
 
+        self._measured_attention_layers = []
+        if memory_budget is None:
+            self._measured_attention_layers = [
+                module for module in self.modules() if isinstance(module, Attention) and module.slice_size is not None
+            ]
+
+    def set_token_merging(self, ratios: Union[dict, list, None], merge_mask: Optional[torch.Tensor] = None):
+        r"""
+        Merge similar tokens before the spatial self-attention and split them back afterwards (ToMe,
+        https://arxiv.org/abs/2303.17604), so that the attention runs on fewer tokens.
+
+        Args:
+            ratios (`dict` or `list` or `None`):
+                Fraction of the tokens merged at every resolution level, as `{level: ratio}` or a list indexed by
+                level. Level 0 is the full latent resolution (the first down block and the last up block), every
+                next level halves it. Levels without a ratio are not merged. `None` disables token merging.
+            merge_mask (`torch.Tensor`, *optional*):
+                (H, W) mask that is 1 where tokens may be merged, e.g. the part of the face that is kept from the
+                reference frames. Tokens outside of it are left untouched.
+        """
+        if ratios is None:
+            ratios = {}
+        elif isinstance(ratios, (list, tuple)):
+            ratios = dict(enumerate(ratios))
+
+        num_levels = len(self.down_blocks)
+        for level, ratio in ratios.items():
+            if not 0 <= level < num_levels:
+                raise ValueError(f"Token merging level must be between 0 and {num_levels - 1}, got {level}")
+            if not 0 <= ratio < 1:
+                raise ValueError(f"Token merging ratio must be in [0, 1), got {ratio}")
+
+        blocks_per_level = [(level, block) for level, block in enumerate(self.down_blocks)]
+        blocks_per_level += [(num_levels - 1, self.mid_block)]
+        blocks_per_level += [(num_levels - 1 - i, block) for i, block in enumerate(self.up_blocks)]
+        for level, block in blocks_per_level:
+            if block is None:
+                continue
+            for module in block.modules():
+                if isinstance(module, BasicTransformerBlock):
+                    module.token_merge_ratio = ratios.get(level, 0.0)
+                    module.token_merge_mask = merge_mask
+
+    def fuse_qkv_projections(self):
+        r"""
+        Pack the query, key and value projections of every self-attention layer (spatial `attn1` and the temporal
+        motion module attention) into one linear layer, so each of them runs a single GEMM instead of three.
+        Checkpoints saved without fusion can still be loaded afterwards, `load_state_dict` converts the keys.
+        """
+        for module in self.modules():
+            if isinstance(module, Attention):
+                module.fuse_projections()
+
+    def unfuse_qkv_projections(self):
+        for module in self.modules():
+            if isinstance(module, Attention):
+                module.unfuse_projections()
+
+    def _convert_qkv_state_dict(self, state_dict):
+        # Match the q/k/v layout of the checkpoint to the (un)fused layout of this model
+        for name, module in self.named_modules():
+            if not isinstance(module, Attention) or not module.is_self_attention:
+                continue
+            for param in ("weight", "bias"):
+                separate_keys = [f"{name}.{proj}.{param}" for proj in ("to_q", "to_k", "to_v")]
+                fused_key = f"{name}.to_qkv.{param}"
+                if module.fused_projections and all(key in state_dict for key in separate_keys):
+                    state_dict[fused_key] = torch.cat([state_dict.pop(key) for key in separate_keys])
+                elif not module.fused_projections and fused_key in state_dict:
+                    for key, value in zip(separate_keys, state_dict.pop(fused_key).chunk(3)):
+                        state_dict[key] = value
+        return state_dict
+
     def _set_gradient_checkpointing(self, module, value=False):
         if isinstance(module, (CrossAttnDownBlock3D, DownBlock3D, CrossAttnUpBlock3D, UpBlock3D)):
             module.gradient_checkpointing = value
@@ -340,6 +501,12 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         # on the fly if necessary.
         default_overall_up_factor = 2**self.num_upsamplers
 
+        if self._measured_attention_layers:
+            # One measurement per forward instead of one per attention slice
+            memory_budget = get_free_memory(sample.device) // 2
+            for module in self._measured_attention_layers:
+                module.forward_memory_budget = memory_budget
+
         # upsample size should be forwarded when sample is not a multiple of `default_overall_up_factor`
         forward_upsample_size = False
         upsample_size = None
@@ -378,7 +545,8 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         # timesteps does not contain any weights and will always return f32 tensors
         # but time_embedding might actually be running in fp16. so we need to cast here.
         # there might be better ways to encapsulate this.
-        t_emb = t_emb.to(dtype=self.dtype)
+        # The dtype of the first parameter, `self.dtype` walks the modules in a way torch.compile cannot trace
+        t_emb = t_emb.to(dtype=self.conv_in.weight.dtype)
         emb = self.time_embedding(t_emb)
 
         if self.class_embedding is not None:
@@ -391,12 +559,34 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
             class_emb = self.class_embedding(class_labels).to(dtype=self.dtype)
             emb = emb + class_emb
 
+        use_deepcache = (
+            down_block_additional_residuals is None
+            and mid_block_additional_residual is None
+            and self._use_deepcache(sample, timesteps)
+        )
+        # index of the first up block that is run on cached steps
+        deepcache_up_block_id = len(self.up_blocks) - 1 - self.deepcache_branch_id
+        input_shape = sample.shape
+
+        flat_layout = (
+            self.flat_layout
+            and not self.training
+            and down_block_additional_residuals is None
+            and mid_block_additional_residual is None
+        )
+        if flat_layout:
+            video_length = sample.shape[2]
+            sample = rearrange(sample, "b c f h w -> (b f) c h w")
+            if self.flat_layout_channels_last:
+                sample = sample.contiguous(memory_format=torch.channels_last)
+
         # pre-process
         sample = self.conv_in(sample)
 
         # down
+        down_blocks = self.down_blocks[: self.deepcache_branch_id + 1] if use_deepcache else self.down_blocks
         down_block_res_samples = (sample,)
-        for downsample_block in self.down_blocks:
+        for downsample_block in down_blocks:
             if hasattr(downsample_block, "has_cross_attention") and downsample_block.has_cross_attention:
                 sample, res_samples = downsample_block(
                     hidden_states=sample,
@@ -419,21 +609,32 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
                     down_block_additional_residual = down_block_additional_residual.unsqueeze(2)
                 down_block_res_samples[i] = down_block_res_samples[i] + down_block_additional_residual
 
-        # mid
-        sample = self.mid_block(
-            sample, emb, encoder_hidden_states=encoder_hidden_states, attention_mask=attention_mask
-        )
+        if use_deepcache:
+            # The downsampled output of the last shallow block only feeds the skipped deep branch
+            down_block_res_samples = down_block_res_samples[:-1]
+            sample = self._deepcache_features
+        else:
+            # mid
+            sample = self.mid_block(
+                sample, emb, encoder_hidden_states=encoder_hidden_states, attention_mask=attention_mask
+            )
 
-        # support controlnet
-        if mid_block_additional_residual is not None:
-            if mid_block_additional_residual.dim() == 4:  # boardcast
-                mid_block_additional_residual = mid_block_additional_residual.unsqueeze(2)
-            sample = sample + mid_block_additional_residual
+            # support controlnet
+            if mid_block_additional_residual is not None:
+                if mid_block_additional_residual.dim() == 4:  # boardcast
+                    mid_block_additional_residual = mid_block_additional_residual.unsqueeze(2)
+                sample = sample + mid_block_additional_residual
 
         # up
         for i, upsample_block in enumerate(self.up_blocks):
             is_final_block = i == len(self.up_blocks) - 1
 
+            if i < deepcache_up_block_id and use_deepcache:
+                continue
+            if i == deepcache_up_block_id and self.deepcache_interval is not None and not self.training:
+                self._deepcache_features = sample
+                self._deepcache_input_shape = input_shape
+
             res_samples = down_block_res_samples[-len(upsample_block.resnets) :]
             down_block_res_samples = down_block_res_samples[: -len(upsample_block.resnets)]
 
@@ -461,16 +662,22 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
                 )
 
         # post-process
-        sample = self.conv_norm_out(sample)
-        sample = self.conv_act(sample)
-        sample = self.conv_out(sample)
+        if flat_layout:
+            stats_video_length = None if isinstance(self.conv_norm_out, InflatedGroupNorm) else video_length
+            sample = group_norm_silu(sample, self.conv_norm_out, stats_video_length)
+            sample = self.conv_out(sample)
+            sample = rearrange(sample, "(b f) c h w -> b c f h w", f=video_length).contiguous()
+        else:
+            sample = self.conv_norm_out(sample)
+            sample = self.conv_act(sample)
+            sample = self.conv_out(sample)
 
         if not return_dict:
             return (sample,)
 
         return UNet3DConditionOutput(sample=sample)
 
-    def load_state_dict(self, state_dict, strict=True):
+    def load_state_dict(self, state_dict, strict=True, assign=False):
         # If the loaded checkpoint's in_channels or out_channels are different from config
         if state_dict["conv_in.weight"].shape[1] != self.config.in_channels:
             del state_dict["conv_in.weight"]
@@ -489,10 +696,15 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         for key in keys_to_remove:
             del state_dict[key]
 
-        return super().load_state_dict(state_dict=state_dict, strict=strict)
+        state_dict = self._convert_qkv_state_dict(state_dict)
+
+        return super().load_state_dict(state_dict=state_dict, strict=strict, assign=assign)
 
     @classmethod
-    def from_pretrained(cls, model_config: dict, ckpt_path: str, device="cpu"):
+    def from_pretrained(cls, model_config: dict, ckpt_path: str, device="cpu", dtype=None):
+        if ckpt_path.endswith(".safetensors"):
+            return cls.from_safetensors(model_config, ckpt_path, device=device, dtype=dtype)
+
         unet = cls.from_config(model_config).to(device)
         if ckpt_path != "":
             zero_rank_log(logger, f"Load from checkpoint: {ckpt_path}")
@@ -509,4 +721,42 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         else:
             resume_global_step = 0
 
+        if dtype is not None:
+            unet = unet.to(dtype=dtype)
+
+        return unet, resume_global_step
+
+    @classmethod
+    def from_safetensors(cls, model_config: dict, ckpt_path: str, device="cpu", dtype=None):
+        """
+        Build the model on the meta device and assign the tensors of a (memory-mapped) safetensors checkpoint,
+        as written by `tools/convert_unet_to_safetensors.py`. No random initialization is run and the weights are
+        not copied again, so loading is faster and needs about one copy of the weights in host memory.
+        """
+        from safetensors import safe_open
+        from safetensors.torch import load_file
+
+        zero_rank_log(logger, f"Load from checkpoint: {ckpt_path}")
+        with safe_open(ckpt_path, framework="pt") as f:
+            metadata = f.metadata() or {}
+        resume_global_step = int(metadata.get("global_step", 0))
+        if resume_global_step:
+            zero_rank_log(logger, f"resume from global_step: {resume_global_step}")
+
+        with torch.device("meta"):
+            unet = cls.from_config(model_config)
+
+        state_dict = load_file(ckpt_path, device=str(device))
+        if dtype is not None:
+            state_dict = {
+                key: value.to(dtype) if value.is_floating_point() else value for key, value in state_dict.items()
+            }
+        unet.load_state_dict(state_dict, strict=False, assign=True)
+        del state_dict
+
+        # Without random initialization, every tensor has to come from the checkpoint
+        missing = [name for name, tensor in list(unet.named_parameters()) + list(unet.named_buffers()) if tensor.is_meta]
+        if missing:
+            raise RuntimeError(f"Checkpoint {ckpt_path} does not match the model config, missing tensors: {missing}")
+
         return unet, resume_global_step
@@ -150,6 +150,11 @@ def get_up_block(
     raise ValueError(f"{up_block_type} does not exist.")
 
 
+def flat_video_length(hidden_states, temb):
+    # A flattened (b f) c h w tensor carries the number of frames in the batch of temb
+    return hidden_states.shape[0] // temb.shape[0] if hidden_states.dim() == 4 else None
+
+
 class UNetMidBlock3DCrossAttn(nn.Module):
     def __init__(
         self,
@@ -251,6 +256,7 @@ class UNetMidBlock3DCrossAttn(nn.Module):
                 hidden_states,
                 encoder_hidden_states=encoder_hidden_states,
                 return_dict=False,
+                video_length=flat_video_length(hidden_states, temb),
             )[0]
 
             if motion_module is not None:
@@ -391,7 +397,11 @@ class CrossAttnDownBlock3D(nn.Module):
                     )
             else:
                 hidden_states = resnet(hidden_states, temb)
-                hidden_states = attn(hidden_states, encoder_hidden_states=encoder_hidden_states).sample
+                hidden_states = attn(
+                    hidden_states,
+                    encoder_hidden_states=encoder_hidden_states,
+                    video_length=flat_video_length(hidden_states, temb),
+                ).sample
 
                 if motion_module is not None:
                     hidden_states = motion_module(hidden_states, temb, encoder_hidden_states=encoder_hidden_states)
@@ -654,7 +664,11 @@ class CrossAttnUpBlock3D(nn.Module):
                     )
             else:
                 hidden_states = resnet(hidden_states, temb)
-                hidden_states = attn(hidden_states, encoder_hidden_states=encoder_hidden_states).sample
+                hidden_states = attn(
+                    hidden_states,
+                    encoder_hidden_states=encoder_hidden_states,
+                    video_length=flat_video_length(hidden_states, temb),
+                ).sample
 
                 if motion_module is not None:
                     hidden_states = motion_module(hidden_states, temb, encoder_hidden_states=encoder_hidden_states)
@@ -1,10 +1,13 @@
 # Adapted from https://github.com/guoyww/AnimateDiff/blob/main/animatediff/pipelines/pipeline_animation.py
 
+import contextlib
+import copy
 import inspect
 import math
 import os
 import shutil
-from typing import Callable, List, Optional, Union
+import time
+from typing import Callable, List, Optional, Tuple, Union
 import subprocess
 
 import numpy as np
@@ -16,6 +19,7 @@ from packaging import version
 
 from diffusers.configuration_utils import FrozenDict
 from diffusers.models import AutoencoderKL
+from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
 from diffusers.pipelines import DiffusionPipeline
 from diffusers.schedulers import (
     DDIMScheduler,
@@ -24,6 +28,7 @@ from diffusers.schedulers import (
     EulerDiscreteScheduler,
     LMSDiscreteScheduler,
     PNDMScheduler,
+    UniPCMultistepScheduler,
 )
 from diffusers.utils import deprecate, logging
 
@@ -31,8 +36,19 @@ from einops import rearrange
 import cv2
 
 from ..models.unet import UNet3DConditionModel
-from ..utils.util import read_video, read_audio, write_video, check_ffmpeg_installed
+from ..utils.util import (
+    read_video,
+    read_audio,
+    write_video,
+    open_video_writer,
+    check_ffmpeg_installed,
+    detect_silent_frames,
+    detect_silent_windows,
+    get_free_memory,
+)
 from ..utils.image_processor import ImageProcessor, load_fixed_mask
+from ..utils.progressive_writer import ProgressiveVideoWriter
+from ..utils.render_checkpoint import RenderCheckpoint, file_digest, get_rng_state, set_rng_state
 from ..whisper.audio2feature import Audio2Feature
 import tqdm
 import soundfile as sf
@@ -43,6 +59,10 @@ logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 class LipsyncPipeline(DiffusionPipeline):
     _optional_components = []
 
+    # Rough peak activation size of the VAE, in elements per pixel of one frame: the decoder runs 128 to 512
+    # channel feature maps at full and half resolution
+    VAE_ELEMENTS_PER_PIXEL = 1024
+
     def __init__(
         self,
         vae: AutoencoderKL,
@@ -55,6 +75,7 @@ class LipsyncPipeline(DiffusionPipeline):
             EulerDiscreteScheduler,
             EulerAncestralDiscreteScheduler,
             DPMSolverMultistepScheduler,
+            UniPCMultistepScheduler,
         ],
     ):
         super().__init__()
@@ -118,12 +139,110 @@ class LipsyncPipeline(DiffusionPipeline):
 
         self.set_progress_bar_config(desc="Steps")
 
+        self.vae_micro_batching = False
+        self.vae_memory_budget = None
+        # Shared by the pipelines of concurrent jobs to batch their UNet steps, see UNetStepBatcher
+        self.unet_batcher = None
+
+    def fork(self, scheduler=None) -> "LipsyncPipeline":
+        """
+        A pipeline on the same models for a concurrent job. `__call__` keeps per-call state on the pipeline (the
+        image processor, the scheduler timesteps and multistep history), so every job needs its own instance.
+        """
+        pipeline = LipsyncPipeline(
+            vae=self.vae,
+            audio_encoder=self.audio_encoder,
+            unet=self.unet,
+            scheduler=scheduler if scheduler is not None else copy.deepcopy(self.scheduler),
+        )
+        pipeline.vae_micro_batching = self.vae_micro_batching
+        pipeline.vae_memory_budget = self.vae_memory_budget
+        pipeline.unet_batcher = self.unet_batcher
+        return pipeline
+
+    def run_unet(self, sample: torch.Tensor, timestep, encoder_hidden_states: Optional[torch.Tensor]) -> torch.Tensor:
+        if self.unet_batcher is not None:
+            return self.unet_batcher(sample, timestep, encoder_hidden_states)
+        return self.unet(sample, timestep, encoder_hidden_states=encoder_hidden_states).sample
+
     def enable_vae_slicing(self):
         self.vae.enable_slicing()
 
     def disable_vae_slicing(self):
         self.vae.disable_slicing()
 
+    def enable_vae_micro_batching(self, memory_budget: Optional[int] = None):
+        """
+        Encode and decode the frames in micro-batches whose estimated activation memory fits `memory_budget` bytes
+        (half of the free memory of the device, measured at every call, when None). When a single frame does not
+        fit, the frames are encoded and decoded one at a time with VAE tiling.
+        """
+        self.vae_micro_batching = True
+        self.vae_memory_budget = memory_budget
+
+    def disable_vae_micro_batching(self):
+        self.vae_micro_batching = False
+        self.vae_memory_budget = None
+
+    def get_vae_micro_batch_size(self, height: int, width: int, dtype: torch.dtype) -> Optional[int]:
+        """Frames per VAE call at this pixel resolution, 0 if one frame exceeds the budget, None if unbounded."""
+        if not self.vae_micro_batching:
+            return None
+        memory_budget = self.vae_memory_budget
+        if memory_budget is None:
+            memory_budget = get_free_memory(self._execution_device) // 2
+        frame_cost = self.VAE_ELEMENTS_PER_PIXEL * height * width * torch.finfo(dtype).bits // 8
+        return memory_budget // frame_cost
+
+    def run_vae(self, fn: Callable, inputs: torch.Tensor, height: int, width: int) -> torch.Tensor:
+        # Apply the VAE function `fn` to the (f, c, h, w) `inputs`, in micro-batches when enabled
+        batch_size = self.get_vae_micro_batch_size(height, width, inputs.dtype)
+        if batch_size is None or batch_size >= inputs.shape[0]:
+            return fn(inputs)
+        if batch_size > 0:
+            return torch.cat([fn(chunk) for chunk in inputs.split(batch_size)])
+
+        use_tiling = self.vae.use_tiling
+        self.vae.enable_tiling()
+        try:
+            return torch.cat([fn(chunk) for chunk in inputs.split(1)])
+        finally:
+            if not use_tiling:
+                self.vae.disable_tiling()
+
+    def vae_encode(self, images: torch.Tensor, generator=None) -> torch.Tensor:
+        posterior = self.vae_encode_posterior(images)
+        return self.sample_vae_posterior(posterior, images.shape[-2], images.shape[-1], generator=generator)
+
+    def vae_encode_posterior(self, images: torch.Tensor) -> torch.Tensor:
+        """The parameters (mean and log variance) of the VAE posterior of `images`, see `sample_vae_posterior`."""
+        return self.run_vae(
+            lambda x: self.vae.encode(x).latent_dist.parameters,
+            images,
+            images.shape[-2],
+            images.shape[-1],
+        )
+
+    def sample_vae_posterior(self, posterior: torch.Tensor, height: int, width: int, generator=None) -> torch.Tensor:
+        """
+        Sample the latents of `height` x `width` frames from their posterior parameters. The noise is drawn per VAE
+        micro-batch, in the order encoding and sampling each micro-batch in turn draws it, so a posterior can be
+        computed once and sampled with several random states.
+        """
+        batch_size = self.get_vae_micro_batch_size(height, width, posterior.dtype)
+        if batch_size is None or batch_size >= posterior.shape[0]:
+            return DiagonalGaussianDistribution(posterior).sample(generator=generator)
+        chunks = posterior.split(max(batch_size, 1))
+        return torch.cat([DiagonalGaussianDistribution(chunk).sample(generator=generator) for chunk in chunks])
+
+    def vae_decode(self, latents: torch.Tensor) -> torch.Tensor:
+        return self.run_vae(
+            lambda x: self.vae.decode(x).sample,
+            latents,
+            latents.shape[-2] * self.vae_scale_factor,
+            latents.shape[-1] * self.vae_scale_factor,
+        )
+
     @property
     def _execution_device(self):
         if self.device != torch.device("meta") or not hasattr(self.unet, "_hf_hook"):
@@ -140,7 +259,43 @@ class LipsyncPipeline(DiffusionPipeline):
     def decode_latents(self, latents):
         latents = latents / self.vae.config.scaling_factor + self.vae.config.shift_factor
         latents = rearrange(latents, "b c f h w -> (b f) c h w")
-        decoded_latents = self.vae.decode(latents).sample
+        decoded_latents = self.vae_decode(latents)
+        return decoded_latents
+
+    def get_decode_region(self, masks: torch.Tensor, margin: int) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Latent (top, bottom, left, right) box that covers every pixel where `masks` < 1, the pixels that are
+        taken from the decoded frames, grown by `margin` latents on each side. None if there is no such pixel.
+        """
+        region = (masks < 1).flatten(0, 1).any(dim=0)  # (h, w)
+        rows = torch.nonzero(region.any(dim=1)).flatten()
+        cols = torch.nonzero(region.any(dim=0)).flatten()
+        if len(rows) == 0:
+            return None
+        scale = self.vae_scale_factor
+        height, width = region.shape[0] // scale, region.shape[1] // scale
+        top = max(int(rows[0]) // scale - margin, 0)
+        bottom = min(math.ceil((int(rows[-1]) + 1) / scale) + margin, height)
+        left = max(int(cols[0]) // scale - margin, 0)
+        right = min(math.ceil((int(cols[-1]) + 1) / scale) + margin, width)
+        return top, bottom, left, right
+
+    def decode_latents_partial(self, latents, pixel_values, masks, margin: int = 8):
+        """
+        Decode only the latents around the region that `paste_surrounding_pixels_back` takes from the decoded
+        frames, and fill the rest with `pixel_values`. The margin covers most of the receptive field of the VAE
+        decoder; its mid-block attention is global, so the result is close to but not bit-identical with
+        `decode_latents` (see tools/validate_partial_decode.py).
+        """
+        region = self.get_decode_region(masks, margin)
+        if region is None:
+            return pixel_values.to(device=latents.device, dtype=latents.dtype)
+        top, bottom, left, right = region
+        decoded_crop = self.decode_latents(latents[:, :, :, top:bottom, left:right])
+
+        scale = self.vae_scale_factor
+        decoded_latents = pixel_values.to(device=decoded_crop.device, dtype=decoded_crop.dtype).clone()
+        decoded_latents[:, :, top * scale : bottom * scale, left * scale : right * scale] = decoded_crop
         return decoded_latents
 
     def prepare_extra_step_kwargs(self, generator, eta):
@@ -191,7 +346,7 @@ class LipsyncPipeline(DiffusionPipeline):
         return latents
 
     def prepare_mask_latents(
-        self, mask, masked_image, height, width, dtype, device, generator, do_classifier_free_guidance
+        self, mask, masked_image, height, width, dtype, device, generator, do_classifier_free_guidance, posterior=None
     ):
         # resize the mask to latents shape as we concatenate the mask to the latents
         # we do that before converting to dtype to avoid breaking in case we're using cpu_offload
@@ -202,7 +357,11 @@ class LipsyncPipeline(DiffusionPipeline):
         masked_image = masked_image.to(device=device, dtype=dtype)
 
         # encode the mask image into latents space so we can concatenate it to the latents
-        masked_image_latents = self.vae.encode(masked_image).latent_dist.sample(generator=generator)
+        if posterior is None:
+            masked_image_latents = self.vae_encode(masked_image, generator=generator)
+        else:
+            # Encoded before, for another random state
+            masked_image_latents = self.sample_vae_posterior(posterior, height, width, generator=generator)
         masked_image_latents = (masked_image_latents - self.vae.config.shift_factor) * self.vae.config.scaling_factor
 
         # aligning device to prevent device errors when concating it with the latent model input
@@ -219,15 +378,43 @@ class LipsyncPipeline(DiffusionPipeline):
         )
         return mask, masked_image_latents
 
-    def prepare_image_latents(self, images, device, dtype, generator, do_classifier_free_guidance):
-        images = images.to(device=device, dtype=dtype)
-        image_latents = self.vae.encode(images).latent_dist.sample(generator=generator)
+    def prepare_image_latents(self, images, device, dtype, generator, do_classifier_free_guidance, posterior=None):
+        if posterior is None:
+            images = images.to(device=device, dtype=dtype)
+            image_latents = self.vae_encode(images, generator=generator)
+        else:
+            height, width = images.shape[-2:]
+            image_latents = self.sample_vae_posterior(posterior, height, width, generator=generator)
         image_latents = (image_latents - self.vae.config.shift_factor) * self.vae.config.scaling_factor
         image_latents = rearrange(image_latents, "f c h w -> 1 c f h w")
         image_latents = torch.cat([image_latents] * 2) if do_classifier_free_guidance else image_latents
 
         return image_latents
 
+    def prepare_timesteps(self, num_inference_steps: int, strength: float, device) -> torch.Tensor:
+        """Set the timesteps of the scheduler and return the ones that are run, the last `strength` of them."""
+        self.scheduler.set_timesteps(num_inference_steps, device=device)
+        init_timestep = min(int(num_inference_steps * strength), num_inference_steps)
+        if init_timestep == 0:
+            raise ValueError(f"strength {strength} leaves no step to run out of {num_inference_steps}")
+        t_start = (num_inference_steps - init_timestep) * self.scheduler.order
+        if hasattr(self.scheduler, "set_begin_index"):
+            self.scheduler.set_begin_index(t_start)
+        return self.scheduler.timesteps[t_start:]
+
+    @staticmethod
+    def get_num_guided_steps(guidance_end_step: Optional[Union[int, float]], num_steps: int) -> int:
+        """Number of leading denoising steps that use classifier-free guidance."""
+        if guidance_end_step is None:
+            return num_steps
+        if isinstance(guidance_end_step, float):
+            if not 0.0 <= guidance_end_step <= 1.0:
+                raise ValueError(f"A fractional guidance_end_step must be in [0, 1], got {guidance_end_step}")
+            return round(guidance_end_step * num_steps)
+        if guidance_end_step < 0:
+            raise ValueError(f"guidance_end_step must not be negative, got {guidance_end_step}")
+        return min(guidance_end_step, num_steps)
+
     def set_progress_bar_config(self, **kwargs):
         if not hasattr(self, "_progress_bar_config"):
             self._progress_bar_config = {}
@@ -271,6 +458,8 @@ class LipsyncPipeline(DiffusionPipeline):
             x1, y1, x2, y2 = boxes[index]
             height = int(y2 - y1)
             width = int(x2 - x1)
+            # Resized in the dtype of the warp that pastes it back (fp32 when the pipeline runs in bf16)
+            face = face.to(self.image_processor.restorer.warp_dtype)
             face = torchvision.transforms.functional.resize(
                 face, size=(height, width), interpolation=transforms.InterpolationMode.BICUBIC, antialias=True
             )
@@ -309,6 +498,68 @@ class LipsyncPipeline(DiffusionPipeline):
 
         return video_frames, faces, boxes, affine_matrices
 
+    def denoise_window(
+        self,
+        latents: torch.Tensor,
+        mask_latents: torch.Tensor,
+        masked_image_latents: torch.Tensor,
+        ref_latents: torch.Tensor,
+        audio_embeds: Optional[torch.Tensor],
+        timesteps: torch.Tensor,
+        guidance_scale: float,
+        num_guided_steps: int,
+        do_classifier_free_guidance: bool,
+        extra_step_kwargs: dict,
+        callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
+        callback_steps: Optional[int] = 1,
+    ) -> torch.Tensor:
+        """
+        Run the denoising steps `timesteps` on the latents of a window. Any number of windows can be stacked on
+        the batch dimension; with classifier-free guidance the conditions hold the unconditional inputs of all of
+        them, then the audio-conditioned ones.
+        """
+        num_denoising_steps = len(timesteps) // self.scheduler.order
+        num_warmup_steps = len(timesteps) - num_denoising_steps * self.scheduler.order
+        batching = self.unet_batcher.participant() if self.unet_batcher is not None else contextlib.nullcontext()
+        with self.progress_bar(total=num_denoising_steps) as progress_bar, batching:
+            do_guidance = do_classifier_free_guidance
+            for j, t in enumerate(timesteps):
+                if do_guidance and j == num_guided_steps:
+                    # Drop the unconditional half, the remaining steps run at half the batch size
+                    do_guidance = False
+                    if audio_embeds is not None:
+                        audio_embeds = audio_embeds.chunk(2)[1]
+                    mask_latents = mask_latents.chunk(2)[1]
+                    masked_image_latents = masked_image_latents.chunk(2)[1]
+                    ref_latents = ref_latents.chunk(2)[1]
+
+                # expand the latents if we are doing classifier free guidance
+                unet_input = torch.cat([latents] * 2) if do_guidance else latents
+
+                unet_input = self.scheduler.scale_model_input(unet_input, t)
+
+                # concat latents, mask, masked_image_latents in the channel dimension
+                unet_input = torch.cat([unet_input, mask_latents, masked_image_latents, ref_latents], dim=1)
+
+                # predict the noise residual
+                noise_pred = self.run_unet(unet_input, t, audio_embeds)
+
+                # perform guidance
+                if do_guidance:
+                    noise_pred_uncond, noise_pred_audio = noise_pred.chunk(2)
+                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_audio - noise_pred_uncond)
+
+                # compute the previous noisy sample x_t -> x_t-1
+                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+
+                # call the callback, if provided
+                if j == len(timesteps) - 1 or ((j + 1) > num_warmup_steps and (j + 1) % self.scheduler.order == 0):
+                    progress_bar.update()
+                    if callback is not None and j % callback_steps == 0:
+                        callback(j, t, latents)
+
+        return latents
+
     @torch.no_grad()
     def __call__(
         self,
@@ -329,8 +580,42 @@ class LipsyncPipeline(DiffusionPipeline):
         generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         callback_steps: Optional[int] = 1,
+        skip_silence: bool = False,
+        silence_threshold_db: float = -40.0,
+        guidance_end_step: Optional[Union[int, float]] = None,
+        strength: float = 1.0,
+        partial_decode: bool = False,
+        partial_decode_margin: int = 8,
+        checkpoint_dir: Optional[str] = None,
+        progressive_output: Optional[str] = None,
+        segment_seconds: float = 2.0,
         **kwargs,
     ):
+        """
+        Lip-syncs `video_path` to `audio_path` and writes the result to `video_out_path`.
+
+        With `skip_silence`, windows whose audio is silent throughout (see `detect_silent_frames`) skip
+        diffusion and keep the source frames. Returns a report with the number and fraction of skipped frames.
+
+        `guidance_end_step` stops classifier-free guidance after that many denoising steps (an int) or after that
+        fraction of the steps (a float in [0, 1]); the remaining steps run the UNet on the audio-conditioned half
+        only. By default every step is guided.
+
+        With `strength` < 1, each window starts from the latents of the source faces noised to an intermediate
+        timestep instead of pure noise, and only the last `strength` fraction of the steps is run.
+
+        With `partial_decode`, the VAE only decodes the latents around the mouth region of the mask, plus
+        `partial_decode_margin` latents on each side (see `decode_latents_partial`).
+
+        With `checkpoint_dir`, the restored frames of every finished window and the RNG state are saved to that
+        job directory (see `RenderCheckpoint`). Called again with the same directory, the render continues from
+        the first unfinished window and the output is identical to an uninterrupted run.
+
+        With `progressive_output` ("fmp4" or "hls"), the frames are encoded as the windows finish, in fragments or
+        segments of `segment_seconds` with their audio (see `ProgressiveVideoWriter`), instead of once at the end.
+        The report then holds `seconds_to_first_frames`, the time until the first frames reached the encoder.
+        """
+        call_start = time.perf_counter()
         is_train = self.unet.training
         self.unet.eval()
 
@@ -339,7 +624,11 @@ class LipsyncPipeline(DiffusionPipeline):
         # 0. Define call parameters
         device = self._execution_device
         mask_image = load_fixed_mask(height, mask_image_path)
-        self.image_processor = ImageProcessor(height, device="cuda", mask_image=mask_image)
+        # AlignRestore keeps its default dtype (fp16 on the GPU, fp32 on the CPU) unless the pipeline runs in bf16
+        restorer_dtype = weight_dtype if weight_dtype == torch.bfloat16 else None
+        self.image_processor = ImageProcessor(
+            height, device=str(device), mask_image=mask_image, detect_faces=True, restorer_dtype=restorer_dtype
+        )
         self.set_progress_bar_config(desc=f"Sample frames: {num_frames}")
 
         # 1. Default height and width to unet
@@ -355,8 +644,10 @@ class LipsyncPipeline(DiffusionPipeline):
         do_classifier_free_guidance = guidance_scale > 1.0
 
         # 3. set timesteps
-        self.scheduler.set_timesteps(num_inference_steps, device=device)
-        timesteps = self.scheduler.timesteps
+        if not 0.0 < strength <= 1.0:
+            raise ValueError(f"strength must be in (0, 1], got {strength}")
+        timesteps = self.prepare_timesteps(num_inference_steps, strength, device)
+        num_guided_steps = self.get_num_guided_steps(guidance_end_step, len(timesteps))
 
         # 4. Prepare extra step kwargs.
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
@@ -369,109 +660,472 @@ class LipsyncPipeline(DiffusionPipeline):
 
         video_frames, faces, boxes, affine_matrices = self.loop_video(whisper_chunks, video_frames)
 
-        synced_video_frames = []
+        if skip_silence:
+            silent_frames = detect_silent_frames(
+                audio_samples,
+                len(whisper_chunks),
+                video_fps=video_fps,
+                audio_sample_rate=audio_sample_rate,
+                threshold_db=silence_threshold_db,
+                audio_context=self.audio_encoder.audio_feat_length,
+            )
+            silent_windows = detect_silent_windows(silent_frames, num_frames)
+        else:
+            silent_windows = None
 
-        num_channels_latents = self.vae.config.latent_channels
+        num_inferences = math.ceil(len(whisper_chunks) / num_frames)
+        output_frames = video_frames[: len(whisper_chunks)].copy()
 
-        # Prepare latent variables
-        all_latents = self.prepare_latents(
-            len(whisper_chunks),
-            num_channels_latents,
-            height,
-            width,
-            weight_dtype,
-            device,
-            generator,
-        )
+        # The audio of the output is known before the first window, the progressive writer muxes it as it goes
+        audio_samples_remain_length = int(output_frames.shape[0] / video_fps * audio_sample_rate)
+        audio_samples = audio_samples[:audio_samples_remain_length].cpu().numpy()
 
-        num_inferences = math.ceil(len(whisper_chunks) / num_frames)
-        for i in tqdm.tqdm(range(num_inferences), desc="Doing inference..."):
-            if self.unet.add_audio_layer:
-                audio_embeds = torch.stack(whisper_chunks[i * num_frames : (i + 1) * num_frames])
-                audio_embeds = audio_embeds.to(device, dtype=weight_dtype)
-                if do_classifier_free_guidance:
-                    null_audio_embeds = torch.zeros_like(audio_embeds)
-                    audio_embeds = torch.cat([null_audio_embeds, audio_embeds])
-            else:
-                audio_embeds = None
-            inference_faces = faces[i * num_frames : (i + 1) * num_frames]
-            latents = all_latents[:, :, i * num_frames : (i + 1) * num_frames]
-            ref_pixel_values, masked_pixel_values, masks = self.image_processor.prepare_masks_and_masked_images(
-                inference_faces, affine_transform=False
-            )
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+        os.makedirs(temp_dir, exist_ok=True)
+        sf.write(os.path.join(temp_dir, "audio.wav"), audio_samples, audio_sample_rate)
 
-            # 7. Prepare mask latent variables
-            mask_latents, masked_image_latents = self.prepare_mask_latents(
-                masks,
-                masked_pixel_values,
+        progressive_writer = None
+        if progressive_output is not None:
+            progressive_writer = ProgressiveVideoWriter(
+                video_out_path,
+                os.path.join(temp_dir, "audio.wav"),
+                width=output_frames.shape[2],
+                height=output_frames.shape[1],
+                fps=video_fps,
+                output_format=progressive_output,
+                segment_seconds=segment_seconds,
+            )
+        try:
+            synced_frame_indices = []
+
+            num_channels_latents = self.vae.config.latent_channels
+
+            checkpoint = None
+            checkpoint_state = None
+            start_rng = get_rng_state(generator)
+            if checkpoint_dir is not None:
+                # The seed the initial latents are drawn from, a rerun of the job with another seed is a new render
+                seed_generator = generator[0] if isinstance(generator, list) else generator
+                seed = seed_generator.initial_seed() if seed_generator is not None else torch.initial_seed()
+                checkpoint = RenderCheckpoint(
+                    checkpoint_dir,
+                    {
+                        "video": file_digest(video_path),
+                        "audio": file_digest(audio_path),
+                        "seed": seed,
+                        "num_frames": len(whisper_chunks),
+                        "window_size": num_frames,
+                        "resolution": height,
+                        "num_inference_steps": num_inference_steps,
+                        "guidance_scale": guidance_scale,
+                        "guidance_end_step": guidance_end_step,
+                        "strength": strength,
+                        "scheduler": type(self.scheduler).__name__,
+                        "skip_silence": skip_silence,
+                        "partial_decode": partial_decode,
+                        "weight_dtype": str(weight_dtype),
+                    },
+                )
+                checkpoint_state = checkpoint.load_state()
+                if checkpoint_state is None:
+                    checkpoint.save_state(0, start_rng, None)
+                else:
+                    # Draw the same initial latents as the interrupted run
+                    start_rng = checkpoint_state["start_rng"]
+                    set_rng_state(start_rng, generator)
+
+            # Prepare latent variables
+            all_latents = self.prepare_latents(
+                len(whisper_chunks),
+                num_channels_latents,
                 height,
                 width,
                 weight_dtype,
                 device,
                 generator,
-                do_classifier_free_guidance,
             )
 
-            # 8. Prepare image latents
-            ref_latents = self.prepare_image_latents(
-                ref_pixel_values,
-                device,
-                weight_dtype,
-                generator,
-                do_classifier_free_guidance,
-            )
+            first_window = 0
+            if checkpoint_state is not None and checkpoint_state["rng"] is not None:
+                first_window = checkpoint_state["next_window"]
+                set_rng_state(checkpoint_state["rng"], generator)
+                print(f"Resuming from window {first_window} of {num_inferences}")
+
+            for i in tqdm.tqdm(range(num_inferences), desc="Doing inference..."):
+                start, end = i * num_frames, min((i + 1) * num_frames, len(whisper_chunks))
+                if progressive_writer is not None:
+                    # The windows before this one are final, whichever way they were finished
+                    if progressive_writer.num_frames == 0 and start > 0:
+                        seconds_to_first_frames = time.perf_counter() - call_start
+                    progressive_writer.write(output_frames[progressive_writer.num_frames : start])
+                if silent_windows is not None and silent_windows[i]:
+                    # Nothing to lip-sync, the source frames are kept as they are
+                    continue
+                synced_frame_indices.extend(range(start, end))
+
+                if i < first_window:
+                    # Finished before the render was interrupted
+                    output_frames[start:end] = checkpoint.load_window(i)
+                    continue
+
+                if self.unet.add_audio_layer:
+                    audio_embeds = torch.stack(whisper_chunks[i * num_frames : (i + 1) * num_frames])
+                    audio_embeds = audio_embeds.to(device, dtype=weight_dtype)
+                    if do_classifier_free_guidance:
+                        null_audio_embeds = torch.zeros_like(audio_embeds)
+                        audio_embeds = torch.cat([null_audio_embeds, audio_embeds])
+                else:
+                    audio_embeds = None
+                inference_faces = faces[i * num_frames : (i + 1) * num_frames]
+                latents = all_latents[:, :, i * num_frames : (i + 1) * num_frames]
+                ref_pixel_values, masked_pixel_values, masks = self.image_processor.prepare_masks_and_masked_images(
+                    inference_faces, affine_transform=False
+                )
+
+                # 7. Prepare mask latent variables
+                mask_latents, masked_image_latents = self.prepare_mask_latents(
+                    masks,
+                    masked_pixel_values,
+                    height,
+                    width,
+                    weight_dtype,
+                    device,
+                    generator,
+                    do_classifier_free_guidance,
+                )
+
+                # 8. Prepare image latents
+                ref_latents = self.prepare_image_latents(
+                    ref_pixel_values,
+                    device,
+                    weight_dtype,
+                    generator,
+                    do_classifier_free_guidance,
+                )
+
+                # Each window starts a new denoising trajectory, multistep schedulers keep the previous model outputs
+                self.unet.reset_deepcache()
+                timesteps = self.prepare_timesteps(num_inference_steps, strength, device)
+
+                if strength < 1.0:
+                    # Start from the source faces noised to the first timestep that is run
+                    noise = latents / self.scheduler.init_noise_sigma
+                    source_latents = ref_latents.chunk(2)[1] if do_classifier_free_guidance else ref_latents
+                    latents = self.scheduler.add_noise(source_latents, noise, timesteps[:1])
+
+                # 9. Denoising loop
+                latents = self.denoise_window(
+                    latents,
+                    mask_latents,
+                    masked_image_latents,
+                    ref_latents,
+                    audio_embeds,
+                    timesteps,
+                    guidance_scale,
+                    num_guided_steps,
+                    do_classifier_free_guidance,
+                    extra_step_kwargs,
+                    callback,
+                    callback_steps,
+                )
+
+                # Recover the pixel values
+                if partial_decode:
+                    decoded_latents = self.decode_latents_partial(
+                        latents, ref_pixel_values, masks, partial_decode_margin
+                    )
+                else:
+                    decoded_latents = self.decode_latents(latents)
+                decoded_latents = self.paste_surrounding_pixels_back(
+                    decoded_latents, ref_pixel_values, 1 - masks, device, weight_dtype
+                )
+                # Restoring is per frame, so the windows are pasted back as they finish
+                output_frames[start:end] = self.restore_video(
+                    decoded_latents, video_frames[start:end], boxes[start:end], affine_matrices[start:end]
+                )
+
+                if checkpoint is not None:
+                    checkpoint.save_window(i, output_frames[start:end])
+                    checkpoint.save_state(i + 1, start_rng, get_rng_state(generator))
+
+            if progressive_writer is not None:
+                if progressive_writer.num_frames == 0:
+                    seconds_to_first_frames = time.perf_counter() - call_start
+                progressive_writer.write(output_frames[progressive_writer.num_frames :])
+                progressive_writer.close()
+        except BaseException:
+            if progressive_writer is not None:
+                # No partial video is left behind for a failed render
+                progressive_writer.abort()
+            raise
+
+        num_skipped_frames = len(whisper_chunks) - len(synced_frame_indices)
+        if num_skipped_frames > 0:
+            print(f"Skipped diffusion for {num_skipped_frames} of {len(whisper_chunks)} silent frames")
+        synced_video_frames = output_frames
 
-            # 9. Denoising loop
-            num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
-            with self.progress_bar(total=num_inference_steps) as progress_bar:
-                for j, t in enumerate(timesteps):
-                    # expand the latents if we are doing classifier free guidance
-                    unet_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+        if is_train:
+            self.unet.train()
 
-                    unet_input = self.scheduler.scale_model_input(unet_input, t)
+        if progressive_writer is None:
+            write_video(os.path.join(temp_dir, "video.mp4"), synced_video_frames, fps=video_fps)
 
-                    # concat latents, mask, masked_image_latents in the channel dimension
-                    unet_input = torch.cat([unet_input, mask_latents, masked_image_latents, ref_latents], dim=1)
+            command = f"ffmpeg -y -loglevel error -nostdin -i {os.path.join(temp_dir, 'video.mp4')} -i {os.path.join(temp_dir, 'audio.wav')} -c:v libx264 -crf 18 -c:a aac -q:v 0 -q:a 0 {video_out_path}"
+            subprocess.run(command, shell=True)
 
-                    # predict the noise residual
-                    noise_pred = self.unet(unet_input, t, encoder_hidden_states=audio_embeds).sample
+        report = {
+            "num_frames": len(whisper_chunks),
+            "num_skipped_frames": num_skipped_frames,
+            "skipped_fraction": num_skipped_frames / max(len(whisper_chunks), 1),
+        }
+        if progressive_writer is not None:
+            report["seconds_to_first_frames"] = seconds_to_first_frames
+        return report
 
-                    # perform guidance
-                    if do_classifier_free_guidance:
-                        noise_pred_uncond, noise_pred_audio = noise_pred.chunk(2)
-                        noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_audio - noise_pred_uncond)
-
-                    # compute the previous noisy sample x_t -> x_t-1
-                    latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
-
-                    # call the callback, if provided
-                    if j == len(timesteps) - 1 or ((j + 1) > num_warmup_steps and (j + 1) % self.scheduler.order == 0):
-                        progress_bar.update()
-                        if callback is not None and j % callback_steps == 0:
-                            callback(j, t, latents)
-
-            # Recover the pixel values
-            decoded_latents = self.decode_latents(latents)
-            decoded_latents = self.paste_surrounding_pixels_back(
-                decoded_latents, ref_pixel_values, 1 - masks, device, weight_dtype
-            )
-            synced_video_frames.append(decoded_latents)
+    @torch.no_grad()
+    def render_batch(
+        self,
+        video_path: str,
+        audio_paths: List[str],
+        video_out_paths: List[str],
+        num_frames: int = 16,
+        video_fps: int = 25,
+        audio_sample_rate: int = 16000,
+        height: Optional[int] = None,
+        width: Optional[int] = None,
+        num_inference_steps: int = 20,
+        guidance_scale: float = 1.5,
+        weight_dtype: Optional[torch.dtype] = torch.float16,
+        eta: float = 0.0,
+        mask_image_path: str = "latentsync/utils/mask.png",
+        temp_dir: str = "temp",
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+        skip_silence: bool = False,
+        silence_threshold_db: float = -40.0,
+        guidance_end_step: Optional[Union[int, float]] = None,
+        strength: float = 1.0,
+        partial_decode: bool = False,
+        partial_decode_margin: int = 8,
+        max_batch_size: int = 1,
+    ) -> List[dict]:
+        """
+        Lip-syncs `video_path` to each of `audio_paths` and writes the results to `video_out_paths`, with the
+        arguments of `__call__`. Returns the report of every output.
+
+        The video is read, its faces aligned and the faces of every window encoded with the VAE once for all the
+        audios. Each audio replays the random draws of its own `__call__` from the same starting state (the
+        initial latents, then the VAE posterior samples of the windows it renders), and the windows of the audios
+        are stacked on the batch dimension of the UNet, at most `max_batch_size` audios per forward. With the
+        default of one audio per forward, every output is bit-identical to a `__call__` with the same seed. Larger
+        batches are faster but approximate, batched UNet kernels may round differently (see
+        tools/validate_multi_audio.py).
+        """
+        if len(audio_paths) != len(video_out_paths):
+            raise ValueError(f"Got {len(audio_paths)} audios for {len(video_out_paths)} output paths")
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+        if eta != 0.0:
+            # The noise of a batched scheduler step cannot be drawn per audio
+            raise ValueError("render_batch needs a scheduler step without noise, eta must be 0")
 
-        synced_video_frames = self.restore_video(torch.cat(synced_video_frames), video_frames, boxes, affine_matrices)
+        is_train = self.unet.training
+        self.unet.eval()
 
-        audio_samples_remain_length = int(synced_video_frames.shape[0] / video_fps * audio_sample_rate)
-        audio_samples = audio_samples[:audio_samples_remain_length].cpu().numpy()
+        check_ffmpeg_installed()
 
-        if is_train:
-            self.unet.train()
+        device = self._execution_device
+        mask_image = load_fixed_mask(height, mask_image_path)
+        restorer_dtype = weight_dtype if weight_dtype == torch.bfloat16 else None
+        self.image_processor = ImageProcessor(
+            height, device=str(device), mask_image=mask_image, detect_faces=True, restorer_dtype=restorer_dtype
+        )
+        self.set_progress_bar_config(desc=f"Sample frames: {num_frames}")
+
+        height = height or self.unet.config.sample_size * self.vae_scale_factor
+        width = width or self.unet.config.sample_size * self.vae_scale_factor
+        self.check_inputs(height, width, 1)
+        do_classifier_free_guidance = guidance_scale > 1.0
+
+        if not 0.0 < strength <= 1.0:
+            raise ValueError(f"strength must be in (0, 1], got {strength}")
+        timesteps = self.prepare_timesteps(num_inference_steps, strength, device)
+        num_guided_steps = self.get_num_guided_steps(guidance_end_step, len(timesteps))
+        extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
+
+        all_whisper_chunks = []
+        all_audio_samples = []
+        all_silent_windows = []
+        for audio_path in audio_paths:
+            whisper_feature = self.audio_encoder.audio2feat(audio_path)
+            whisper_chunks = self.audio_encoder.feature2chunks(feature_array=whisper_feature, fps=video_fps)
+            audio_samples = read_audio(audio_path)
+            silent_windows = None
+            if skip_silence:
+                silent_frames = detect_silent_frames(
+                    audio_samples,
+                    len(whisper_chunks),
+                    video_fps=video_fps,
+                    audio_sample_rate=audio_sample_rate,
+                    threshold_db=silence_threshold_db,
+                    audio_context=self.audio_encoder.audio_feat_length,
+                )
+                silent_windows = detect_silent_windows(silent_frames, num_frames)
+            all_whisper_chunks.append(whisper_chunks)
+            all_audio_samples.append(audio_samples)
+            all_silent_windows.append(silent_windows)
+        num_output_frames = [len(whisper_chunks) for whisper_chunks in all_whisper_chunks]
+
+        # Prepared for the longest audio, the frames of a shorter one are a prefix of these (the video is looped
+        # the same way and the face alignment is smoothed causally)
+        video_frames = read_video(video_path, use_decord=False)
+        longest = max(range(len(audio_paths)), key=lambda k: num_output_frames[k])
+        video_frames, faces, boxes, affine_matrices = self.loop_video(all_whisper_chunks[longest], video_frames)
 
         if os.path.exists(temp_dir):
             shutil.rmtree(temp_dir)
-        os.makedirs(temp_dir, exist_ok=True)
+        audio_temp_dirs = []
+        video_writers = []
+        for k, audio_samples in enumerate(all_audio_samples):
+            audio_temp_dir = os.path.join(temp_dir, str(k))
+            os.makedirs(audio_temp_dir, exist_ok=True)
+            audio_samples = audio_samples[: int(num_output_frames[k] / video_fps * audio_sample_rate)]
+            sf.write(os.path.join(audio_temp_dir, "audio.wav"), audio_samples.cpu().numpy(), audio_sample_rate)
+            audio_temp_dirs.append(audio_temp_dir)
+            # The frames of all the outputs do not fit in memory, they are encoded as the windows finish
+            video_writers.append(open_video_writer(os.path.join(audio_temp_dir, "video.mp4"), video_fps))
+
+        # The initial latents do not depend on the audio, every single-audio render draws the same
+        all_latents = self.prepare_latents(
+            max(num_output_frames),
+            self.vae.config.latent_channels,
+            height,
+            width,
+            weight_dtype,
+            device,
+            generator,
+        )
+        rng_states = [get_rng_state(generator)] * len(audio_paths)
+        num_synced_frames = [0] * len(audio_paths)
 
-        write_video(os.path.join(temp_dir, "video.mp4"), synced_video_frames, fps=video_fps)
+        num_inferences = math.ceil(max(num_output_frames) / num_frames)
+        for i in tqdm.tqdm(range(num_inferences), desc="Doing inference..."):
+            start = i * num_frames
+            # The audios that render this window, by the end of their window (the last windows can be shorter)
+            groups = {}
+            for k in range(len(audio_paths)):
+                end = min(start + num_frames, num_output_frames[k])
+                if end <= start:
+                    continue
+                if all_silent_windows[k] is not None and all_silent_windows[k][i]:
+                    for frame in video_frames[start:end]:
+                        video_writers[k].append_data(frame)
+                    continue
+                num_synced_frames[k] += end - start
+                groups.setdefault(end, []).append(k)
+
+            for end, group in sorted(groups.items()):
+                ref_pixel_values, masked_pixel_values, masks = self.image_processor.prepare_masks_and_masked_images(
+                    faces[start:end], affine_transform=False
+                )
+                masked_posterior = self.vae_encode_posterior(masked_pixel_values.to(device=device, dtype=weight_dtype))
+                ref_posterior = self.vae_encode_posterior(ref_pixel_values.to(device=device, dtype=weight_dtype))
+
+                window_mask_latents = {}
+                window_masked_image_latents = {}
+                window_ref_latents = {}
+                for k in group:
+                    set_rng_state(rng_states[k], generator)
+                    window_mask_latents[k], window_masked_image_latents[k] = self.prepare_mask_latents(
+                        masks,
+                        masked_pixel_values,
+                        height,
+                        width,
+                        weight_dtype,
+                        device,
+                        generator,
+                        False,
+                        posterior=masked_posterior,
+                    )
+                    window_ref_latents[k] = self.prepare_image_latents(
+                        ref_pixel_values, device, weight_dtype, generator, False, posterior=ref_posterior
+                    )
+                    rng_states[k] = get_rng_state(generator)
+
+                for batch_start in range(0, len(group), max_batch_size):
+                    batch = group[batch_start : batch_start + max_batch_size]
+                    latents = all_latents[:, :, start:end].repeat(len(batch), 1, 1, 1, 1)
+                    mask_latents = torch.cat([window_mask_latents[k] for k in batch])
+                    masked_image_latents = torch.cat([window_masked_image_latents[k] for k in batch])
+                    ref_latents = torch.cat([window_ref_latents[k] for k in batch])
+                    if self.unet.add_audio_layer:
+                        # (b f) n d, in the order of the batch
+                        audio_embeds = torch.cat([torch.stack(all_whisper_chunks[k][start:end]) for k in batch])
+                        audio_embeds = audio_embeds.to(device, dtype=weight_dtype)
+                    else:
+                        audio_embeds = None
+                    if do_classifier_free_guidance:
+                        # The unconditional inputs of the whole batch, then the audio-conditioned ones
+                        mask_latents = torch.cat([mask_latents] * 2)
+                        masked_image_latents = torch.cat([masked_image_latents] * 2)
+                        ref_latents = torch.cat([ref_latents] * 2)
+                        if audio_embeds is not None:
+                            audio_embeds = torch.cat([torch.zeros_like(audio_embeds), audio_embeds])
+
+                    self.unet.reset_deepcache()
+                    timesteps = self.prepare_timesteps(num_inference_steps, strength, device)
+                    if strength < 1.0:
+                        noise = latents / self.scheduler.init_noise_sigma
+                        source_latents = ref_latents.chunk(2)[1] if do_classifier_free_guidance else ref_latents
+                        latents = self.scheduler.add_noise(source_latents, noise, timesteps[:1])
+
+                    latents = self.denoise_window(
+                        latents,
+                        mask_latents,
+                        masked_image_latents,
+                        ref_latents,
+                        audio_embeds,
+                        timesteps,
+                        guidance_scale,
+                        num_guided_steps,
+                        do_classifier_free_guidance,
+                        extra_step_kwargs,
+                    )
+
+                    # Decoded one audio at a time, as in its single-audio render
+                    for b, k in enumerate(batch):
+                        if partial_decode:
+                            decoded_latents = self.decode_latents_partial(
+                                latents[b : b + 1], ref_pixel_values, masks, partial_decode_margin
+                            )
+                        else:
+                            decoded_latents = self.decode_latents(latents[b : b + 1])
+                        decoded_latents = self.paste_surrounding_pixels_back(
+                            decoded_latents, ref_pixel_values, 1 - masks, device, weight_dtype
+                        )
+                        restored_frames = self.restore_video(
+                            decoded_latents, video_frames[start:end], boxes[start:end], affine_matrices[start:end]
+                        )
+                        for frame in restored_frames:
+                            video_writers[k].append_data(frame)
 
-        sf.write(os.path.join(temp_dir, "audio.wav"), audio_samples, audio_sample_rate)
+        if is_train:
+            self.unet.train()
 
-        command = f"ffmpeg -y -loglevel error -nostdin -i {os.path.join(temp_dir, 'video.mp4')} -i {os.path.join(temp_dir, 'audio.wav')} -c:v libx264 -crf 18 -c:a aac -q:v 0 -q:a 0 {video_out_path}"
-        subprocess.run(command, shell=True)
+        reports = []
+        for k, video_out_path in enumerate(video_out_paths):
+            video_writers[k].close()
+            video_path_k = os.path.join(audio_temp_dirs[k], "video.mp4")
+            audio_path_k = os.path.join(audio_temp_dirs[k], "audio.wav")
+            command = f"ffmpeg -y -loglevel error -nostdin -i {video_path_k} -i {audio_path_k} -c:v libx264 -crf 18 -c:a aac -q:v 0 -q:a 0 {video_out_path}"
+            subprocess.run(command, shell=True)
+
+            num_skipped_frames = num_output_frames[k] - num_synced_frames[k]
+            reports.append(
+                {
+                    "num_frames": num_output_frames[k],
+                    "num_skipped_frames": num_skipped_frames,
+                    "skipped_fraction": num_skipped_frames / max(num_output_frames[k], 1),
+                }
+            )
+        return reports
@@ -0,0 +1,174 @@
+import contextlib
+import threading
+import time
+from typing import List, Optional
+
+import torch
+
+
+class _StepRequest:
+    def __init__(self, sample: torch.Tensor, timestep, encoder_hidden_states: Optional[torch.Tensor]):
+        self.sample = sample
+        self.timestep = timestep
+        self.encoder_hidden_states = encoder_hidden_states
+        self.key = (
+            tuple(sample.shape[1:]),
+            sample.dtype,
+            sample.device,
+            None if encoder_hidden_states is None else tuple(encoder_hidden_states.shape[1:]),
+        )
+        self.arrival = time.perf_counter()
+        self.output = None
+        self.error = None
+        self.done = False
+
+
+class UNetStepBatcher:
+    """
+    Runs the UNet calls of concurrent `LipsyncPipeline` calls (one thread per job) as batched forwards.
+
+    Every job in its denoising loop is a participant (see `participant`). A call waits until every participant
+    has submitted its step, until `max_batch_size` samples are pending, or at most `max_wait` seconds, then the
+    pending steps whose sample and audio embeddings have the same shape (resolution, `num_frames`) run as one
+    forward. Each request keeps its own timestep, the UNet embeds a timestep per sample, and gets its own slice
+    of the output back, so classifier-free guidance is still applied per job with its own guidance scale.
+
+        batcher = UNetStepBatcher(unet, max_batch_size=8)
+        pipeline.unet_batcher = batcher  # in every job: pipeline.fork(...)
+        ...
+        print(batcher.metrics())
+    """
+
+    def __init__(self, unet, max_batch_size: int = 8, max_wait: float = 0.02):
+        self.unet = unet
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._condition = threading.Condition()
+        self._pending: List[_StepRequest] = []
+        self._num_participants = 0
+        # One forward at a time, two groups of shapes would only compete for the device
+        self._forward_lock = threading.Lock()
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        with self._condition:
+            self._num_requests = 0
+            self._num_forwards = 0
+            self._num_samples = 0
+            self._total_wait = 0.0
+            self._forward_time = 0.0
+
+    def metrics(self) -> dict:
+        """Batching efficiency since the last `reset_metrics`."""
+        with self._condition:
+            num_forwards = max(self._num_forwards, 1)
+            return {
+                "requests": self._num_requests,
+                "forwards": self._num_forwards,
+                "requests_per_forward": self._num_requests / num_forwards,
+                "mean_batch_size": self._num_samples / num_forwards,
+                # Fraction of the batch capacity that was used
+                "fill_ratio": self._num_samples / (num_forwards * self.max_batch_size),
+                "mean_wait_ms": 1000 * self._total_wait / max(self._num_requests, 1),
+                "forward_seconds": self._forward_time,
+            }
+
+    @contextlib.contextmanager
+    def participant(self):
+        """Marks the calling job as denoising, the batcher waits for its steps."""
+        with self._condition:
+            self._num_participants += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._num_participants -= 1
+                # The others may be waiting for a step of this job
+                self._condition.notify_all()
+
+    def _ready(self, key) -> bool:
+        if len(self._pending) >= self._num_participants:
+            return True
+        num_samples = sum(request.sample.shape[0] for request in self._pending if request.key == key)
+        return num_samples >= self.max_batch_size
+
+    def _pop_batch(self, key) -> List[_StepRequest]:
+        batch = []
+        num_samples = 0
+        for request in self._pending:
+            if request.key != key:
+                continue
+            if batch and num_samples + request.sample.shape[0] > self.max_batch_size:
+                break
+            batch.append(request)
+            num_samples += request.sample.shape[0]
+        for request in batch:
+            self._pending.remove(request)
+        return batch
+
+    def _run(self, batch: List[_StepRequest]):
+        start = time.perf_counter()
+        num_samples = sum(request.sample.shape[0] for request in batch)
+        try:
+            sample = torch.cat([request.sample for request in batch])
+            timestep_dtype = torch.as_tensor(batch[0].timestep).dtype
+            timesteps = torch.cat(
+                [
+                    torch.as_tensor(request.timestep, dtype=timestep_dtype, device=sample.device)
+                    .reshape(-1)
+                    .expand(request.sample.shape[0])
+                    for request in batch
+                ]
+            )
+            encoder_hidden_states = None
+            if batch[0].encoder_hidden_states is not None:
+                encoder_hidden_states = torch.cat([request.encoder_hidden_states for request in batch])
+            with self._forward_lock:
+                output = self.unet(sample, timesteps, encoder_hidden_states=encoder_hidden_states).sample
+            outputs = output.split([request.sample.shape[0] for request in batch])
+            error = None
+        except Exception as e:
+            outputs = [None] * len(batch)
+            error = e
+
+        with self._condition:
+            for request, request_output in zip(batch, outputs):
+                request.output = request_output
+                request.error = error
+                request.done = True
+                self._total_wait += start - request.arrival
+            self._num_requests += len(batch)
+            self._num_forwards += 1
+            self._num_samples += num_samples
+            self._forward_time += time.perf_counter() - start
+            self._condition.notify_all()
+
+    def __call__(
+        self, sample: torch.Tensor, timestep, encoder_hidden_states: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """The UNet output (the `.sample` of the UNet output) for this request."""
+        request = _StepRequest(sample, timestep, encoder_hidden_states)
+        deadline = request.arrival + self.max_wait
+        with self._condition:
+            self._pending.append(request)
+            self._condition.notify_all()
+
+        while True:
+            with self._condition:
+                while True:
+                    if request.done:
+                        if request.error is not None:
+                            raise request.error
+                        return request.output
+                    if request in self._pending and (
+                        self._ready(request.key) or time.perf_counter() >= deadline
+                    ):
+                        # This thread runs the batch, the others wait for their slices
+                        batch = self._pop_batch(request.key)
+                        break
+                    if request in self._pending:
+                        self._condition.wait(timeout=max(deadline - time.perf_counter(), 0.001))
+                    else:
+                        # In a batch that another thread is running
+                        self._condition.wait()
+            self._run(batch)
@@ -19,16 +19,20 @@ class AlignRestore(object):
             self.p_bias = None
             self.device = device
             self.dtype = dtype
-            self.fill_value = torch.tensor([127, 127, 127], device=device, dtype=dtype)
-            self.mask = torch.ones((1, 1, self.face_size[1], self.face_size[0]), device=device, dtype=dtype)
+            # The sampling grids of the warps hold normalized coordinates, with the 8 bit mantissa of bf16 they
+            # are off by several pixels on large frames. In bf16 the warps run in fp32 and only the blending in bf16
+            self.warp_dtype = torch.float32 if dtype == torch.bfloat16 else dtype
+            self.fill_value = torch.tensor([127, 127, 127], device=device, dtype=self.warp_dtype)
+            self.mask = torch.ones((1, 1, self.face_size[1], self.face_size[0]), device=device, dtype=self.warp_dtype)
 
     def align_warp_face(self, img, landmarks3, smooth=True):
         affine_matrix, self.p_bias = self.transformation_from_points(
             landmarks3, self.face_template, smooth, self.p_bias
         )
 
-        img = rearrange(torch.from_numpy(img).to(device=self.device, dtype=self.dtype), "h w c -> c h w").unsqueeze(0)
-        affine_matrix = torch.from_numpy(affine_matrix).to(device=self.device, dtype=self.dtype).unsqueeze(0)
+        img = rearrange(torch.from_numpy(img).to(device=self.device, dtype=self.warp_dtype), "h w c -> c h w")
+        img = img.unsqueeze(0)
+        affine_matrix = torch.from_numpy(affine_matrix).to(device=self.device, dtype=self.warp_dtype).unsqueeze(0)
 
         cropped_face = kornia.geometry.transform.warp_affine(
             img,
@@ -45,20 +49,20 @@ class AlignRestore(object):
         h, w, _ = input_img.shape
 
         if isinstance(affine_matrix, np.ndarray):
-            affine_matrix = torch.from_numpy(affine_matrix).to(device=self.device, dtype=self.dtype).unsqueeze(0)
+            affine_matrix = torch.from_numpy(affine_matrix).to(device=self.device, dtype=self.warp_dtype).unsqueeze(0)
 
         inv_affine_matrix = kornia.geometry.transform.invert_affine_transform(affine_matrix)
-        face = face.to(dtype=self.dtype).unsqueeze(0)
+        face = face.to(dtype=self.warp_dtype).unsqueeze(0)
 
         inv_face = kornia.geometry.transform.warp_affine(
             face, inv_affine_matrix, (h, w), mode="bilinear", padding_mode="fill", fill_value=self.fill_value
         ).squeeze(0)
-        inv_face = (inv_face / 2 + 0.5).clamp(0, 1) * 255
+        inv_face = (inv_face.to(self.dtype) / 2 + 0.5).clamp(0, 1) * 255
 
         input_img = rearrange(torch.from_numpy(input_img).to(device=self.device, dtype=self.dtype), "h w c -> c h w")
         inv_mask = kornia.geometry.transform.warp_affine(
             self.mask, inv_affine_matrix, (h, w), padding_mode="zeros"
-        )  # (1, 1, h_up, w_up)
+        ).to(self.dtype)  # (1, 1, h_up, w_up)
 
         inv_mask_erosion = kornia.morphology.erosion(
             inv_mask,
@@ -79,7 +83,7 @@ class AlignRestore(object):
         # )
 
         # Run on CPU to avoid consuming a large amount of GPU memory.
-        inv_mask_erosion = inv_mask_erosion.squeeze().cpu().numpy().astype(np.float32)
+        inv_mask_erosion = inv_mask_erosion.squeeze().float().cpu().numpy()
         inv_mask_center = cv2.erode(inv_mask_erosion, np.ones((erosion_radius, erosion_radius), np.uint8))
         inv_mask_center = torch.from_numpy(inv_mask_center).to(device=self.device, dtype=self.dtype)[None, None, ...]
 
@@ -65,6 +65,53 @@ def melspectrogram(wav):
     return S
 
 
+def melspectrogram_torch(wavs, lengths=None):
+    """Torch implementation of `melspectrogram` for a batch of waveforms, on the device of `wavs`.
+
+    wavs: (T,) or (B, T) tensor, zero-padded on the right when the waveforms have different lengths
+    lengths: optional number of valid samples of each waveform; if given, a list of (num_mels, frames)
+        tensors is returned, otherwise a (num_mels, frames) or (B, num_mels, frames) tensor.
+
+    float64 inputs reproduce the librosa path to numerical precision; float32 inputs are faster, on GPU in particular.
+    """
+    if config.audio.use_lws:
+        raise NotImplementedError("melspectrogram_torch does not support lws")
+
+    single = wavs.dim() == 1
+    if single:
+        wavs = wavs.unsqueeze(0)
+    if wavs.dtype != torch.float64:
+        wavs = wavs.float()
+
+    if config.audio.preemphasize:
+        # lfilter([1, -k], [1], wav) with zero initial conditions
+        wavs = torch.cat([wavs[:, :1], wavs[:, 1:] - config.audio.preemphasis * wavs[:, :-1]], dim=1)
+    if lengths is not None:
+        lengths = torch.as_tensor(lengths, device=wavs.device)
+        # librosa pads each waveform with zeros after the filter, not before it
+        valid = torch.arange(wavs.shape[1], device=wavs.device)[None, :] < lengths[:, None]
+        wavs = wavs * valid
+
+    window = torch.hann_window(config.audio.win_size, dtype=wavs.dtype, device=wavs.device)
+    D = torch.stft(
+        wavs,
+        n_fft=config.audio.n_fft,
+        hop_length=get_hop_size(),
+        win_length=config.audio.win_size,
+        window=window,
+        center=True,
+        pad_mode="constant",
+        return_complex=True,
+    )
+    S = _amp_to_db_torch(_linear_to_mel_torch(D.abs())) - config.audio.ref_level_db
+    if config.audio.signal_normalization:
+        S = _normalize_torch(S)
+
+    if lengths is not None:
+        return [S[i, :, : int(length) // get_hop_size() + 1] for i, length in enumerate(lengths.tolist())]
+    return S[0] if single else S
+
+
 def _lws_processor():
     import lws
 
@@ -127,11 +174,24 @@ def _build_mel_basis():
     )
 
 
+def _linear_to_mel_torch(spectogram):
+    global _mel_basis
+    if _mel_basis is None:
+        _mel_basis = _build_mel_basis()
+    mel_basis = torch.from_numpy(_mel_basis).to(device=spectogram.device, dtype=spectogram.dtype)
+    return torch.matmul(mel_basis, spectogram)
+
+
 def _amp_to_db(x):
     min_level = np.exp(config.audio.min_level_db / 20 * np.log(10))
     return 20 * np.log10(np.maximum(min_level, x))
 
 
+def _amp_to_db_torch(x):
+    min_level = np.exp(config.audio.min_level_db / 20 * np.log(10))
+    return 20 * torch.log10(torch.clamp(x, min=min_level))
+
+
 def _db_to_amp(x):
     return np.power(10.0, (x) * 0.05)
 
@@ -161,6 +221,20 @@ def _normalize(S):
         return config.audio.max_abs_value * ((S - config.audio.min_level_db) / (-config.audio.min_level_db))
 
 
+def _normalize_torch(S):
+    if config.audio.symmetric_mels:
+        S = (2 * config.audio.max_abs_value) * (
+            (S - config.audio.min_level_db) / (-config.audio.min_level_db)
+        ) - config.audio.max_abs_value
+        min_value = -config.audio.max_abs_value
+    else:
+        S = config.audio.max_abs_value * ((S - config.audio.min_level_db) / (-config.audio.min_level_db))
+        min_value = 0
+    if config.audio.allow_clipping_in_normalization:
+        S = torch.clamp(S, min_value, config.audio.max_abs_value)
+    return S
+
+
 def _denormalize(D):
     if config.audio.allow_clipping_in_normalization:
         if config.audio.symmetric_mels:
@@ -32,28 +32,36 @@ def load_fixed_mask(resolution: int, mask_image_path="latentsync/utils/mask.png"
 
 
 class ImageProcessor:
-    def __init__(self, resolution: int = 512, device: str = "cpu", mask_image=None):
+    def __init__(
+        self, resolution: int = 512, device: str = "cpu", mask_image=None, detect_faces=None, restorer_dtype=None
+    ):
         self.resolution = resolution
         self.resize = transforms.Resize(
             (resolution, resolution), interpolation=transforms.InterpolationMode.BICUBIC, antialias=True
         )
         self.normalize = transforms.Normalize([0.5], [0.5], inplace=True)
 
-        self.restorer = AlignRestore(resolution=resolution, device=device)
+        # kornia's warps are slow or unsupported in fp16 on the CPU, bf16 has to be asked for
+        if restorer_dtype is None:
+            restorer_dtype = torch.float32 if device == "cpu" else torch.float16
+        self.restorer = AlignRestore(resolution=resolution, device=device, dtype=restorer_dtype)
 
         if mask_image is None:
             self.mask_image = load_fixed_mask(resolution)
         else:
             self.mask_image = mask_image
 
-        if device == "cpu":
-            self.face_detector = None
-        else:
+        # The face detector is only loaded when needed, by default on the GPU
+        if detect_faces is None:
+            detect_faces = device != "cpu"
+        if detect_faces:
             self.face_detector = FaceDetector(device=device)
+        else:
+            self.face_detector = None
 
     def affine_transform(self, image: torch.Tensor) -> np.ndarray:
         if self.face_detector is None:
-            raise NotImplementedError("Using the CPU for face detection is not supported")
+            raise NotImplementedError("Face detection is disabled, create the ImageProcessor with detect_faces=True")
         bbox, landmark_2d_106 = self.face_detector(image)
         if bbox is None:
             raise RuntimeError("Face not detected")
@@ -102,7 +110,7 @@ class ImageProcessor:
 
 class VideoProcessor:
     def __init__(self, resolution: int = 512, device: str = "cpu"):
-        self.image_processor = ImageProcessor(resolution, device)
+        self.image_processor = ImageProcessor(resolution, device, detect_faces=True)
 
     def affine_transform_video(self, video_path):
         video_frames = read_video(video_path, change_fps=False)
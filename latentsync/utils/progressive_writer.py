@@ -0,0 +1,181 @@
+import os
+import shutil
+import subprocess
+from typing import List
+
+import numpy as np
+
+PROGRESSIVE_FORMATS = ("fmp4", "hls")
+
+
+def hls_playlist_path(video_out_path: str) -> str:
+    """Where the HLS playlist of `video_out_path` is written, its segments are next to it."""
+    return os.path.join(os.path.splitext(video_out_path)[0] + "_hls", "index.m3u8")
+
+
+def list_hls_segments(playlist_path: str) -> List[str]:
+    """Paths of the finished segments of a playlist, ffmpeg only lists a segment once it is closed."""
+    if not os.path.isfile(playlist_path):
+        return []
+    with open(playlist_path) as f:
+        lines = [line.strip() for line in f]
+    playlist_dir = os.path.dirname(playlist_path)
+    return [os.path.join(playlist_dir, line) for line in lines if line and not line.startswith("#")]
+
+
+def is_hls_playlist_finished(playlist_path: str) -> bool:
+    if not os.path.isfile(playlist_path):
+        return False
+    with open(playlist_path) as f:
+        return "#EXT-X-ENDLIST" in f.read()
+
+
+class ProgressiveVideoWriter:
+    """
+    Encodes the frames of a render while it runs, so the first seconds are playable before the last window is
+    restored. The frames are piped to one ffmpeg process that muxes them with the (already complete) audio file:
+
+        fmp4    a fragmented MP4 at `video_out_path`, one fragment per `segment_seconds`
+        hls     an HLS event playlist (see `hls_playlist_path`) with an MPEG-TS segment per `segment_seconds`,
+                remuxed to `video_out_path` by `close`
+
+    Every fragment and segment starts with a keyframe and holds the audio of its frames.
+
+        writer = ProgressiveVideoWriter("out.mp4", "temp/audio.wav", width, height, fps=25)
+        try:
+            for frames in windows:
+                writer.write(frames)
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+    """
+
+    def __init__(
+        self,
+        video_out_path: str,
+        audio_path: str,
+        width: int,
+        height: int,
+        fps: int = 25,
+        output_format: str = "fmp4",
+        segment_seconds: float = 2.0,
+    ):
+        if output_format not in PROGRESSIVE_FORMATS:
+            raise ValueError(f"Unknown progressive output format {output_format}, choose one of {PROGRESSIVE_FORMATS}")
+        self.video_out_path = video_out_path
+        self.output_format = output_format
+        self.width = width
+        self.height = height
+        self.num_frames = 0
+
+        keyframe_interval = max(round(fps * segment_seconds), 1)
+        command = [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-nostdin",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(fps),
+            "-i",
+            "pipe:0",
+            "-i",
+            audio_path,
+            "-map",
+            "0:v",
+            "-map",
+            "1:a",
+            # yuv420p needs even dimensions
+            "-vf",
+            "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-c:v",
+            "libx264",
+            "-crf",
+            "18",
+            "-pix_fmt",
+            "yuv420p",
+            "-g",
+            str(keyframe_interval),
+            "-keyint_min",
+            str(keyframe_interval),
+            "-sc_threshold",
+            "0",
+            "-c:a",
+            "aac",
+            # Wait for the video before muxing the audio, which is read ahead from the file
+            "-max_interleave_delta",
+            "0",
+        ]
+        if output_format == "fmp4":
+            command += ["-movflags", "+frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", video_out_path]
+        else:
+            self.playlist_path = hls_playlist_path(video_out_path)
+            playlist_dir = os.path.dirname(self.playlist_path)
+            os.makedirs(playlist_dir, exist_ok=True)
+            for name in os.listdir(playlist_dir):
+                os.remove(os.path.join(playlist_dir, name))
+            command += [
+                "-f",
+                "hls",
+                "-hls_time",
+                str(segment_seconds),
+                "-hls_list_size",
+                "0",
+                "-hls_playlist_type",
+                "event",
+                "-hls_segment_filename",
+                os.path.join(playlist_dir, "segment_%05d.ts"),
+                self.playlist_path,
+            ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, frames: np.ndarray):
+        """Append (f, h, w, 3) uint8 RGB frames."""
+        if len(frames) == 0:
+            return
+        if frames.shape[1:] != (self.height, self.width, 3):
+            raise ValueError(f"Expected frames of shape (f, {self.height}, {self.width}, 3), got {frames.shape}")
+        self.process.stdin.write(np.ascontiguousarray(frames, dtype=np.uint8).tobytes())
+        self.process.stdin.flush()
+        self.num_frames += len(frames)
+
+    def close(self):
+        _, stderr = self.process.communicate()
+        if self.process.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed to write {self.video_out_path}: {stderr.decode(errors='replace')}")
+        if self.output_format == "hls":
+            # The complete render as a regular MP4 as well, for the clients that download the result
+            subprocess.run(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-loglevel",
+                    "error",
+                    "-nostdin",
+                    "-i",
+                    self.playlist_path,
+                    "-c",
+                    "copy",
+                    "-bsf:a",
+                    "aac_adtstoasc",
+                    self.video_out_path,
+                ],
+                check=True,
+            )
+
+    def abort(self):
+        """Stop ffmpeg and remove the partial output, for a render that failed."""
+        if self.process.returncode is None:
+            self.process.kill()
+            self.process.communicate()
+        if self.output_format == "hls":
+            shutil.rmtree(os.path.dirname(self.playlist_path), ignore_errors=True)
+        if os.path.exists(self.video_out_path):
+            os.remove(self.video_out_path)
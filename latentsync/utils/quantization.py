@@ -0,0 +1,43 @@
+import torch
+from torch import nn
+from diffusers.models.attention import FeedForward
+
+from ..models.attention import Attention
+from ..models.motion_module import VanillaTemporalModule
+from ..whisper.whisper.model import Linear as WhisperLinear
+
+QUANTIZED_UNET_MODULES = (Attention, FeedForward, VanillaTemporalModule)
+
+
+def quantize_unet_int8(unet: nn.Module) -> nn.Module:
+    """
+    Apply dynamic int8 quantization (CPU only) to the linear layers of the attention, feed-forward and motion
+    modules of the UNet. Weights are stored in int8 and activations are quantized on the fly, so the model keeps
+    taking fp32 inputs. The convolutions of the resnet blocks stay in fp32.
+    """
+    qconfig_spec = {
+        name: torch.ao.quantization.default_dynamic_qconfig
+        for name, module in unet.named_modules()
+        if isinstance(module, QUANTIZED_UNET_MODULES)
+    }
+    return torch.ao.quantization.quantize_dynamic(unet, qconfig_spec=qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+def _replace_whisper_linear(module: nn.Module):
+    # quantize_dynamic matches exact module types, and whisper wraps its linear layers in a subclass
+    for name, child in module.named_children():
+        if isinstance(child, WhisperLinear):
+            linear = nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+            linear.weight = child.weight
+            linear.bias = child.bias
+            setattr(module, name, linear)
+        else:
+            _replace_whisper_linear(child)
+
+
+def quantize_whisper_encoder_int8(whisper_model: nn.Module) -> nn.Module:
+    """Apply dynamic int8 quantization to the linear layers of the whisper audio encoder (CPU only)."""
+    encoder = whisper_model.encoder.float()
+    _replace_whisper_linear(encoder)
+    torch.ao.quantization.quantize_dynamic(encoder, qconfig_spec={nn.Linear}, dtype=torch.qint8, inplace=True)
+    return whisper_model
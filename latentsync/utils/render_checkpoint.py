@@ -0,0 +1,119 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+from typing import List, Optional, Union
+
+import numpy as np
+import torch
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def file_digest(path, chunk_size=1024**2):
+    """sha256 of the contents of `path`, computed once per process for a given file (the checkpoint is large)."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _digests_lock:
+        if memo_key in _digests:
+            return _digests[memo_key]
+
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    with _digests_lock:
+        _digests[memo_key] = digest
+    return digest
+
+
+@contextlib.contextmanager
+def open_atomic(path: str, mode: str):
+    """Write to a temporary file that replaces `path` only once it is complete."""
+    tmp_path = f"{path}.partial"
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def get_rng_state(generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None) -> dict:
+    """The state of every random number generator a render draws from."""
+    state = {"cpu": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    if generator is not None:
+        generators = generator if isinstance(generator, list) else [generator]
+        state["generators"] = [g.get_state() for g in generators]
+    return state
+
+
+def set_rng_state(state: dict, generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None):
+    torch.set_rng_state(state["cpu"])
+    if "cuda" in state:
+        torch.cuda.set_rng_state_all(state["cuda"])
+    if generator is not None:
+        generators = generator if isinstance(generator, list) else [generator]
+        for g, generator_state in zip(generators, state["generators"]):
+            g.set_state(generator_state)
+
+
+class RenderCheckpoint:
+    """
+    Checkpoints of a render, one per finished window, in the job directory `job_dir`:
+
+        meta.json           the digests of the inputs, the seed and the render parameters, a resumed job must
+                            match them
+        window_00012.npy    the restored frames of window 12 (absent for windows skipped as silent)
+        state.pt            the next window to render, the RNG states before the initial latents are drawn
+                            and after the last finished window
+
+    Every file is written to a temporary name and renamed, so a job killed at any point leaves a consistent
+    directory behind. See the `checkpoint_dir` argument of `LipsyncPipeline.__call__`.
+    """
+
+    def __init__(self, job_dir: str, params: dict):
+        self.job_dir = job_dir
+        os.makedirs(job_dir, exist_ok=True)
+
+        meta_path = os.path.join(job_dir, "meta.json")
+        params = json.loads(json.dumps(params))
+        if os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                saved_params = json.load(f)
+            if saved_params != params:
+                raise ValueError(
+                    f"The checkpoints in {job_dir} belong to a render with other parameters: {saved_params}, "
+                    f"this one has {params}"
+                )
+        else:
+            with open_atomic(meta_path, "w") as f:
+                json.dump(params, f, indent=2)
+
+    def window_path(self, index: int) -> str:
+        return os.path.join(self.job_dir, f"window_{index:05d}.npy")
+
+    def load_state(self) -> Optional[dict]:
+        """The saved state, None for a new job."""
+        state_path = os.path.join(self.job_dir, "state.pt")
+        if not os.path.isfile(state_path):
+            return None
+        return torch.load(state_path, weights_only=True)
+
+    def save_state(self, next_window: int, start_rng: dict, rng: Optional[dict]):
+        state = {"next_window": next_window, "start_rng": start_rng, "rng": rng}
+        with open_atomic(os.path.join(self.job_dir, "state.pt"), "wb") as f:
+            torch.save(state, f)
+
+    def save_window(self, index: int, frames: np.ndarray):
+        with open_atomic(self.window_path(index), "wb") as f:
+            np.save(f, frames)
+
+    def load_window(self, index: int) -> np.ndarray:
+        return np.load(self.window_path(index), mmap_mode="r")
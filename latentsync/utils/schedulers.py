@@ -0,0 +1,19 @@
+from diffusers import DDIMScheduler, DPMSolverMultistepScheduler, UniPCMultistepScheduler
+
+# Every scheduler is built from the DDIM config the model was trained with (configs/scheduler_config.json),
+# so the noise schedule is the same and only the solver changes
+SCHEDULERS = {
+    "ddim": (DDIMScheduler, {}),
+    # Second order multistep solvers, usable in the 6-10 step range
+    "dpmsolver++": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++", "solver_order": 2}),
+    "unipc": (UniPCMultistepScheduler, {"solver_order": 2}),
+}
+
+
+def load_scheduler(name: str = "ddim", config_dir: str = "configs"):
+    """Build the scheduler registered under `name` from the noise schedule in `config_dir`."""
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler {name}, choose one of {', '.join(SCHEDULERS)}")
+    scheduler_cls, overrides = SCHEDULERS[name]
+    config = DDIMScheduler.load_config(config_dir)
+    return scheduler_cls.from_config(config, **overrides)
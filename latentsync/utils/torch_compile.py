@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+
+import torch
+
+
+def compile_cache_key(model_config: dict, dtype: torch.dtype, device="cuda") -> str:
+    """
+    Key of the compiled artifacts. Inductor kernels are only valid for the same model architecture, torch build,
+    GPU model and dtype, so all of them go into the key.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        device_name = torch.cuda.get_device_name(device)
+    else:
+        device_name = device.type
+    payload = json.dumps(
+        {
+            "model_config": model_config,
+            "torch": torch.__version__,
+            "cuda": torch.version.cuda,
+            "device": device_name,
+            "dtype": str(dtype),
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def configure_compile_cache(cache_dir: str, cache_key: str) -> str:
+    """
+    Point the inductor (and triton) caches to `cache_dir/cache_key` and enable the FX graph cache, so a worker
+    started later loads the compiled kernels from disk instead of compiling them again. Must be called before
+    the first compiled forward.
+    """
+    cache_path = os.path.abspath(os.path.join(cache_dir, cache_key))
+    os.makedirs(cache_path, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_path
+    os.environ["TRITON_CACHE_DIR"] = os.path.join(cache_path, "triton")
+    os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+
+    import torch._inductor.config as inductor_config
+
+    # The config module reads the environment on import, which may have happened already
+    inductor_config.fx_graph_cache = True
+    if hasattr(inductor_config, "autograd_cache"):
+        inductor_config.autograd_cache = True
+    return cache_path
+
+
+def compile_unet(unet, cache_dir: str, dtype: torch.dtype, device="cuda", mode=None, backend="inductor", num_graphs=8):
+    """
+    Compile the UNet forward with static shapes. The module itself is kept, so attributes such as `config`
+    are still reachable by the pipeline. `num_graphs` is the number of input shapes (see `warmup_unet`) the
+    forward is compiled for before torch falls back to running it eagerly.
+
+    DeepCache decides on the host which blocks a step runs and keeps a step counter on the module, which would
+    break the graph and recompile it every step, so the two cannot be combined.
+    """
+    if unet.deepcache_interval is not None:
+        raise ValueError("A UNet with DeepCache enabled cannot be compiled, disable one of them")
+    cache_key = compile_cache_key(unet.config, dtype, device)
+    cache_path = configure_compile_cache(cache_dir, cache_key)
+    print(f"Compiling UNet, artifact cache: {cache_path}")
+
+    import torch._dynamo.config as dynamo_config
+
+    # Renamed in later torch releases
+    limit_name = "recompile_limit" if hasattr(dynamo_config, "recompile_limit") else "cache_size_limit"
+    setattr(dynamo_config, limit_name, max(getattr(dynamo_config, limit_name), num_graphs))
+    unet.compile(dynamic=False, mode=mode, backend=backend)
+    return unet
+
+
+def warmup_batch_sizes(unet_batch_size=None):
+    """
+    Batch sizes of the UNet forwards of a pipeline: 2 with classifier-free guidance and 1 without it or once the
+    guided steps end. With `UNetStepBatcher`, the steps of concurrent jobs are batched up to `unet_batch_size`
+    samples, a single step of two samples may exceed it.
+    """
+    if unet_batch_size is None:
+        return [1, 2]
+    return list(range(1, max(unet_batch_size, 2) + 1))
+
+
+@torch.no_grad()
+def warmup_unet(
+    unet,
+    batch_sizes,
+    num_frames,
+    height,
+    width,
+    audio_embeds_shape,
+    device="cuda",
+    dtype=torch.float16,
+    timestep_per_sample=False,
+):
+    """
+    Run one forward pass per batch size of `batch_sizes` with the shapes used during inference, so the (cached)
+    compilation happens at startup rather than in the first requests. `audio_embeds_shape` is the (tokens, dim)
+    shape of one whisper chunk. The pipeline passes a scalar timestep, `UNetStepBatcher` one per sample
+    (`timestep_per_sample`). A shorter last window of a video is compiled when it is first rendered.
+    """
+    for batch_size in batch_sizes:
+        sample = torch.zeros(
+            batch_size, unet.config.in_channels, num_frames, height // 8, width // 8, device=device, dtype=dtype
+        )
+        audio_embeds = torch.zeros(batch_size * num_frames, *audio_embeds_shape, device=device, dtype=dtype)
+        if timestep_per_sample:
+            # Contiguous like the timesteps concatenated by the batcher, the graphs are specialized on strides
+            timestep = torch.full((batch_size,), 999, device=device)
+        else:
+            timestep = torch.tensor(999, device=device)
+        unet(sample, timestep, encoder_hidden_states=audio_embeds)
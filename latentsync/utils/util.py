@@ -112,15 +112,55 @@ def read_audio(audio_path: str, audio_sample_rate: int = 16000):
     return audio_samples
 
 
-def write_video(video_output_path: str, video_frames: np.ndarray, fps: int):
-    with imageio.get_writer(
+def detect_silent_frames(
+    audio_samples: torch.Tensor,
+    num_frames: int,
+    video_fps: int = 25,
+    audio_sample_rate: int = 16000,
+    threshold_db: float = -40.0,
+    floor_db: float = -60.0,
+    audio_context=(2, 2),
+) -> np.ndarray:
+    """Marks the video frames whose lips can be left untouched because the audio around them is silent.
+
+    A frame is silent when its RMS level is `threshold_db` below the loudest frame or below `floor_db` dBFS.
+    `audio_context` is the number of frames before and after a frame whose audio the UNet sees
+    (`audio_feat_length`); a frame is only marked when all of them are silent.
+    """
+    samples_per_frame = int(round(audio_sample_rate / video_fps))
+    audio_samples = audio_samples.float().flatten()[: num_frames * samples_per_frame]
+    audio_samples = torch.nn.functional.pad(audio_samples, (0, num_frames * samples_per_frame - len(audio_samples)))
+    rms = audio_samples.view(num_frames, samples_per_frame).pow(2).mean(dim=1).sqrt()
+    level_db = 20 * torch.log10(rms.clamp(min=1e-10))
+    silent = ((level_db < level_db.max() + threshold_db) | (level_db < floor_db)).cpu().numpy()
+
+    silent_with_context = silent.copy()
+    for offset in range(-audio_context[0], audio_context[1] + 1):
+        indices = np.clip(np.arange(num_frames) + offset, 0, num_frames - 1)
+        silent_with_context &= silent[indices]
+    return silent_with_context
+
+
+def detect_silent_windows(silent_frames: np.ndarray, window_size: int) -> np.ndarray:
+    """Marks the windows of `window_size` frames (the last one may be shorter) whose frames are all silent."""
+    num_windows = -(-len(silent_frames) // window_size)
+    return np.array([silent_frames[i * window_size : (i + 1) * window_size].all() for i in range(num_windows)])
+
+
+def open_video_writer(video_output_path: str, fps: int):
+    """The imageio writer of `write_video`, to append the frames as they are rendered."""
+    return imageio.get_writer(
         video_output_path,
         fps=fps,
         codec="libx264",
         macro_block_size=None,
         ffmpeg_params=["-crf", "13"],
         ffmpeg_log_level="error",
-    ) as writer:
+    )
+
+
+def write_video(video_output_path: str, video_frames: np.ndarray, fps: int):
+    with open_video_writer(video_output_path, fps) as writer:
         for video_frame in video_frames:
             writer.append_data(video_frame)
 
@@ -158,6 +198,15 @@ def zero_rank_log(logger, message: str):
         logger.info(message)
 
 
+def get_free_memory(device: Union[str, torch.device]) -> int:
+    """Free memory in bytes on the given device: free GPU memory for CUDA, available RAM otherwise."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        free_memory, _ = torch.cuda.mem_get_info(device)
+        return free_memory
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
 def check_video_fps(video_path: str):
     cam = cv2.VideoCapture(video_path)
     fps = cam.get(cv2.CAP_PROP_FPS)
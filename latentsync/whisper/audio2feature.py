@@ -1,12 +1,22 @@
 # Adapted from https://github.com/TMElyralab/MuseTalk/blob/main/musetalk/whisper/audio2feature.py
 
 from .whisper import load_model
+from .whisper.audio import HOP_LENGTH, N_FFT, N_FRAMES, log_mel_spectrogram, mel_filters, pad_or_trim
+from .whisper.transcribe import encode_segment, get_encoder_dtype, pad_segment
 import numpy as np
 import torch
 import os
 from pathlib import Path
 
 
+def cast_encoder_weights(encoder, dtype):
+    # whisper's Linear and Conv1d cast their weights to the input dtype at every call, cast them once instead.
+    # The LayerNorms compute in fp32 and keep their weights
+    for module in encoder.modules():
+        if isinstance(module, (torch.nn.Linear, torch.nn.Conv1d)):
+            module.to(dtype)
+
+
 class Audio2Feature:
     def __init__(
         self,
@@ -15,14 +25,24 @@ class Audio2Feature:
         audio_embeds_cache_dir=None,
         num_frames=16,
         audio_feat_length=[2, 2],
+        truncate_context=False,
+        context_margin=100,
+        dtype=None,
     ):
         self.model = load_model(model_path, device)
+        # The encoder dtype, None keeps whisper's default (fp16 on the GPU, fp32 on the CPU)
+        self.dtype = dtype
+        if dtype is not None:
+            cast_encoder_weights(self.model.encoder, dtype)
         self.audio_embeds_cache_dir = audio_embeds_cache_dir
         if audio_embeds_cache_dir is not None and audio_embeds_cache_dir != "":
             Path(audio_embeds_cache_dir).mkdir(parents=True, exist_ok=True)
         self.num_frames = num_frames
         self.embedding_dim = self.model.dims.n_audio_state
         self.audio_feat_length = audio_feat_length
+        # Encode short clips without padding them to the full 30 s window (see whisper.transcribe)
+        self.truncate_context = truncate_context
+        self.context_margin = context_margin
 
     def get_sliced_feature(self, feature_array, vid_idx, fps=25):
         """
@@ -104,9 +124,14 @@ class Audio2Feature:
 
     def _audio2feat(self, audio_path: str):
         # get the sample rate of the audio
-        result = self.model.transcribe(audio_path)
+        result = self.model.transcribe(
+            audio_path, truncate_context=self.truncate_context, context_margin=self.context_margin, dtype=self.dtype
+        )
+        return self.segments2feat(result["segments"])
+
+    def segments2feat(self, segments):
         embed_list = []
-        for emb in result["segments"]:
+        for emb in segments:
             encoder_embeddings = emb["encoder_embeddings"]
             encoder_embeddings = encoder_embeddings.transpose(0, 2, 1, 3)
             encoder_embeddings = encoder_embeddings.squeeze(0)
@@ -121,8 +146,10 @@ class Audio2Feature:
         if self.audio_embeds_cache_dir == "" or self.audio_embeds_cache_dir is None:
             return self._audio2feat(audio_path)
 
+        # Truncated-context embeddings differ slightly from the padded ones, so they are cached separately
+        cache_suffix = f"_embeds_trunc{self.context_margin}.pt" if self.truncate_context else "_embeds.pt"
         audio_embeds_cache_path = os.path.join(
-            self.audio_embeds_cache_dir, os.path.basename(audio_path).replace(".mp4", "_embeds.pt")
+            self.audio_embeds_cache_dir, os.path.basename(audio_path).replace(".mp4", cache_suffix)
         )
 
         if os.path.isfile(audio_embeds_cache_path):
@@ -148,6 +175,167 @@ class Audio2Feature:
         return mel_overlap
 
 
+class StreamingAudio2Feature:
+    """
+    Incremental counterpart of `Audio2Feature.audio2feat` followed by `feature2chunks`, for audio that
+    arrives in blocks (e.g. from a TTS stream).
+
+    `push` accepts 16 kHz mono PCM and returns the whisper chunks of every new block of video frames whose
+    right-hand context (`audio_feat_length[1]`) is covered by the audio received so far. Each call only
+    encodes the mel frames received since the previous encode, with `context_margin` frames of context on
+    either side, so a stream costs one pass over its audio rather than one pass per call over the open 30 s
+    window. Whisper attends over its whole window and normalizes the mel spectrogram by its global maximum,
+    so the chunks of the open window are provisional: they approximate the offline chunks from the audio
+    seen so far. Chunks of a closed window are encoded over the full window. `finish` returns the exact
+    offline chunks for the complete stream, reusing the encoder outputs of closed 30 s windows whose input
+    did not change.
+
+        stream = StreamingAudio2Feature(audio_encoder, fps=25)
+        for pcm in pcm_blocks:
+            for block in stream.push(pcm):
+                ...  # list of `block_size` provisional chunks
+        whisper_chunks = stream.finish()  # identical to audio2feat + feature2chunks on the full audio
+    """
+
+    def __init__(self, audio_encoder: Audio2Feature, fps=25, block_size=None):
+        self.audio_encoder = audio_encoder
+        self.model = audio_encoder.model
+        self.fps = fps
+        self.block_size = block_size if block_size is not None else audio_encoder.num_frames
+        self.dtype = get_encoder_dtype(self.model, dtype=audio_encoder.dtype)
+        self.reset()
+
+    def reset(self):
+        self.audio = torch.zeros(0)
+        # Raw log10 mel frames whose STFT window lies entirely inside the received audio
+        self.log_mel = torch.zeros(mel_filters("cpu").shape[0], 0)
+        self.log_mel_max = torch.tensor(-float("inf"))
+        # (padded mel input, segment) of every fully received 30 s window
+        self.closed_segments = []
+        # Provisional segments covering the start of the open window, in order
+        self.open_segments = []
+        self.num_emitted_frames = 0
+        self.feature_array = None
+        self.whisper_chunks = None
+
+    def push(self, samples):
+        if self.whisper_chunks is not None:
+            raise RuntimeError("The stream is finished, call reset() before pushing more audio")
+        samples = torch.as_tensor(np.asarray(samples, dtype=np.float32)).flatten()
+        self.audio = torch.cat([self.audio, samples])
+        self._extend_log_mel()
+
+        while self.log_mel.shape[1] >= (len(self.closed_segments) + 1) * N_FRAMES:
+            seek = len(self.closed_segments) * N_FRAMES
+            segment_input, segment = self._encode(seek, seek + N_FRAMES)
+            self.closed_segments.append((segment_input, segment))
+            self.open_segments = []
+
+        # A frame can be emitted once the last feature of its window exists
+        num_features = len(self.closed_segments) * N_FRAMES // 2 + (self.log_mel.shape[1] % N_FRAMES) // 2
+        right_offset = (self.audio_encoder.audio_feat_length[1] + 1) * 2 - 1
+        num_ready_frames = self.num_emitted_frames
+        while int(num_ready_frames * 50 / self.fps) + right_offset < num_features:
+            num_ready_frames += 1
+
+        num_blocks = (num_ready_frames - self.num_emitted_frames) // self.block_size
+        if num_blocks == 0:
+            return []
+
+        open_seek = len(self.closed_segments) * N_FRAMES
+        encoded_seek = self.open_segments[-1]["end"] if self.open_segments else open_seek
+        # The encoder downsamples by 2, so only encode whole frame pairs
+        end_seek = open_seek + (self.log_mel.shape[1] - open_seek) // 2 * 2
+        if end_seek > encoded_seek:
+            self.open_segments.append(self._encode_tail(open_seek, encoded_seek, end_seek))
+        segments = [segment for _, segment in self.closed_segments] + self.open_segments
+        feature_array = self.audio_encoder.segments2feat(segments)
+
+        blocks = []
+        for _ in range(num_blocks):
+            block = []
+            for vid_idx in range(self.num_emitted_frames, self.num_emitted_frames + self.block_size):
+                selected_feature, _ = self.audio_encoder.get_sliced_feature(feature_array, vid_idx, fps=self.fps)
+                block.append(selected_feature)
+            blocks.append(block)
+            self.num_emitted_frames += self.block_size
+        return blocks
+
+    def finish(self):
+        """
+        Returns the whisper chunks of the complete stream, identical to the offline computation. Frames from
+        `num_emitted_frames` on have not been returned by `push` yet.
+        """
+        if self.whisper_chunks is not None:
+            return self.whisper_chunks
+
+        mel = log_mel_spectrogram(self.audio)
+        segments = []
+        for index, seek in enumerate(range(0, mel.shape[-1], N_FRAMES)):
+            end_seek = min(seek + N_FRAMES, mel.shape[-1])
+            segment_input = pad_segment(
+                mel[:, seek:end_seek], self.audio_encoder.truncate_context, self.audio_encoder.context_margin
+            )
+            if index < len(self.closed_segments) and torch.equal(self.closed_segments[index][0], segment_input):
+                segments.append(self.closed_segments[index][1])
+                continue
+            encoder_embeddings = encode_segment(self.model, segment_input, self.dtype)
+            segments.append({"start": seek, "end": end_seek, "encoder_embeddings": encoder_embeddings})
+
+        self.feature_array = self.audio_encoder.segments2feat(segments)
+        self.whisper_chunks = self.audio_encoder.feature2chunks(feature_array=self.feature_array, fps=self.fps)
+        return self.whisper_chunks
+
+    def _extend_log_mel(self):
+        # Frame k of the centered STFT covers samples [k * HOP_LENGTH - N_FFT // 2, k * HOP_LENGTH + N_FFT // 2)
+        num_samples = self.audio.shape[0]
+        if num_samples <= N_FFT // 2:
+            return
+        num_stable = min(num_samples // HOP_LENGTH, (num_samples - N_FFT // 2) // HOP_LENGTH + 1)
+        first = self.log_mel.shape[1]
+        if num_stable <= first:
+            return
+
+        start = first * HOP_LENGTH - N_FFT // 2
+        end = (num_stable - 1) * HOP_LENGTH + N_FFT // 2
+        if start < 0:
+            # Same reflection padding as torch.stft(center=True)
+            samples = torch.cat([self.audio[1 : 1 - start].flip(0), self.audio[:end]])
+        else:
+            samples = self.audio[start:end]
+
+        window = torch.hann_window(N_FFT)
+        stft = torch.stft(samples, N_FFT, HOP_LENGTH, window=window, center=False, return_complex=True)
+        magnitudes = stft.abs() ** 2
+        log_mel = torch.clamp(mel_filters("cpu") @ magnitudes, min=1e-10).log10()
+
+        self.log_mel = torch.cat([self.log_mel, log_mel], dim=1)
+        self.log_mel_max = torch.maximum(self.log_mel_max, log_mel.max())
+
+    def _encode(self, seek, end_seek):
+        # Normalization of log_mel_spectrogram, using the maximum over the audio received so far
+        mel = self.log_mel[:, seek:end_seek]
+        mel = (torch.maximum(mel, self.log_mel_max - 8.0) + 4.0) / 4.0
+        segment_input = pad_segment(mel, self.audio_encoder.truncate_context, self.audio_encoder.context_margin)
+        encoder_embeddings = encode_segment(self.model, segment_input, self.dtype)
+        return segment_input, {"start": seek, "end": end_seek, "encoder_embeddings": encoder_embeddings}
+
+    def _encode_tail(self, open_seek, seek, end_seek):
+        # Encode mel frames [seek, end_seek) of the open window with `context_margin` frames of context on
+        # either side, at their position inside the window, and keep the embeddings of the new frames only
+        context_margin = self.audio_encoder.context_margin + self.audio_encoder.context_margin % 2
+        context_seek = max(open_seek, seek - context_margin)
+        mel = self.log_mel[:, context_seek:end_seek]
+        mel = (torch.maximum(mel, self.log_mel_max - 8.0) + 4.0) / 4.0
+        segment_length = min(N_FRAMES - (context_seek - open_seek), mel.shape[-1] + context_margin)
+        segment_input = pad_or_trim(mel, segment_length)
+        encoder_embeddings = encode_segment(
+            self.model, segment_input, self.dtype, position_offset=(context_seek - open_seek) // 2
+        )
+        encoder_embeddings = encoder_embeddings[:, :, (seek - context_seek) // 2 :]
+        return {"start": seek, "end": end_seek, "encoder_embeddings": encoder_embeddings}
+
+
 if __name__ == "__main__":
     audio_encoder = Audio2Feature(model_path="checkpoints/whisper/tiny.pt")
     audio_path = "assets/demo1_audio.wav"
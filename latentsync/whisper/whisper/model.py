@@ -45,6 +45,13 @@ class Conv1d(nn.Conv1d):
         )
 
 
+def to_numpy(x: Tensor) -> np.ndarray:
+    """numpy has no bfloat16, bf16 activations are returned in fp32"""
+    if x.dtype == torch.bfloat16:
+        x = x.float()
+    return x.cpu().detach().numpy()
+
+
 def sinusoids(length, channels, max_timescale=10000):
     """Returns sinusoids for positional embedding"""
     assert channels % 2 == 0
@@ -140,27 +147,31 @@ class AudioEncoder(nn.Module):
         )
         self.ln_post = LayerNorm(n_state)
 
-    def forward(self, x: Tensor, include_embeddings: bool = False):
+    def forward(self, x: Tensor, include_embeddings: bool = False, position_offset: int = 0):
         """
         x : torch.Tensor, shape = (batch_size, n_mels, n_ctx)
             the mel spectrogram of the audio
         include_embeddings: bool
             whether to include intermediate steps in the output
+        position_offset: int
+            position of the first encoded frame inside the 30 s window, for a mel slice that does not start it
         """
         x = F.gelu(self.conv1(x))
         x = F.gelu(self.conv2(x))
         x = x.permute(0, 2, 1)
 
-        assert x.shape[1:] == self.positional_embedding.shape, "incorrect audio shape"
-        x = (x + self.positional_embedding).to(x.dtype)
+        # a shorter input (truncated context) is encoded with the matching slice of the positional embedding
+        assert position_offset + x.shape[1] <= self.positional_embedding.shape[0], "incorrect audio shape"
+        assert x.shape[2] == self.positional_embedding.shape[1], "incorrect audio shape"
+        x = (x + self.positional_embedding[position_offset : position_offset + x.shape[1]]).to(x.dtype)
 
         if include_embeddings:
-            embeddings = [x.cpu().detach().numpy()]
+            embeddings = [to_numpy(x)]
 
         for block in self.blocks:
             x = block(x)
             if include_embeddings:
-                embeddings.append(x.cpu().detach().numpy())
+                embeddings.append(to_numpy(x))
 
         x = self.ln_post(x)
 
@@ -16,6 +16,51 @@ if TYPE_CHECKING:
     from .model import Whisper
 
 
+def get_encoder_dtype(model: "Whisper", fp16: bool = True, dtype: Optional[torch.dtype] = None) -> torch.dtype:
+    """
+    The dtype the audio encoder runs in: `dtype` when given (e.g. bf16, which the CPU supports), otherwise
+    fp16 unless disabled or running on the CPU
+    """
+    if dtype is None:
+        dtype = torch.float16 if fp16 else torch.float32
+    if model.device == torch.device("cpu"):
+        if torch.cuda.is_available():
+            warnings.warn("Performing inference on CPU when CUDA is available")
+        if dtype == torch.float16:
+            warnings.warn("FP16 is not supported on CPU; using FP32 instead")
+            dtype = torch.float32
+    return dtype
+
+
+def pad_segment(mel_segment: torch.Tensor, truncate_context: bool = False, context_margin: int = 100) -> torch.Tensor:
+    """
+    Pad a (n_mels, <= N_FRAMES) mel segment to the length the encoder is run with, see `transcribe`
+    """
+    if truncate_context:
+        # the encoder downsamples by 2, so keep an even number of frames
+        segment_length = min(N_FRAMES, mel_segment.shape[-1] + context_margin)
+        segment_length += segment_length % 2
+    else:
+        segment_length = N_FRAMES
+    return pad_or_trim(mel_segment, segment_length)
+
+
+def encode_segment(model: "Whisper", segment: torch.Tensor, dtype: torch.dtype, position_offset: int = 0) -> np.ndarray:
+    """
+    Run the audio encoder on a padded mel segment and return the stacked per-layer embeddings. `position_offset`
+    is the encoder position of the segment's first frame pair when it starts inside a 30 s window
+    """
+    segment = segment.to(model.device).to(dtype)
+
+    single = segment.ndim == 2
+    if single:
+        segment = segment.unsqueeze(0)
+    if dtype == torch.float16:
+        segment = segment.half()
+    audio_features, embeddings = model.encoder(segment, include_embeddings=True, position_offset=position_offset)
+    return embeddings
+
+
 def transcribe(
         model: "Whisper",
         audio: Union[str, np.ndarray, torch.Tensor],
@@ -27,6 +72,9 @@ def transcribe(
         no_speech_threshold: Optional[float] = 0.6,
         condition_on_previous_text: bool = True,
         force_extraction: bool = False,
+        truncate_context: bool = False,
+        context_margin: int = 100,
+        dtype: Optional[torch.dtype] = None,
         **decode_options,
 ):
     """
@@ -63,6 +111,18 @@ def transcribe(
         disabling may make the text inconsistent across windows, but the model becomes less prone to
         getting stuck in a failure loop, such as repetition looping or timestamps going out of sync.
 
+    truncate_context: bool
+        If True, a segment shorter than 30 seconds is only padded to its own length plus
+        `context_margin` mel frames instead of the full 3000 frames, so the encoder attends over
+        a much shorter sequence. The embeddings are close to, but not bit-identical with, the
+        fully padded ones
+
+    context_margin: int
+        Number of padding mel frames (10 ms each) kept after a truncated segment
+
+    dtype: Optional[torch.dtype]
+        The dtype to run the encoder in, overrides `decode_options["fp16"]`. bf16 is supported on the CPU
+
     decode_options: dict
         Keyword arguments to construct `DecodingOptions` instances
 
@@ -71,15 +131,9 @@ def transcribe(
     A dictionary containing the resulting text ("text") and segment-level details ("segments"), and
     the spoken language ("language"), which is detected when `decode_options["language"]` is None.
     """
-    dtype = torch.float16 if decode_options.get("fp16", True) else torch.float32
-    if model.device == torch.device("cpu"):
-        if torch.cuda.is_available():
-            warnings.warn("Performing inference on CPU when CUDA is available")
-        if dtype == torch.float16:
-            warnings.warn("FP16 is not supported on CPU; using FP32 instead")
-            dtype = torch.float32
+    dtype = get_encoder_dtype(model, decode_options.get("fp16", True), dtype)
 
-    if dtype == torch.float32:
+    if dtype != torch.float16:
         decode_options["fp16"] = False
 
     mel = log_mel_spectrogram(audio)
@@ -105,16 +159,8 @@ def transcribe(
         while seek < num_frames:
             # seek是开始的帧数
             end_seek = min(seek + sample_skip, num_frames)
-            segment = pad_or_trim(mel[:,seek:seek+sample_skip], N_FRAMES).to(model.device).to(dtype)
-            
-            single = segment.ndim == 2
-            if single:
-                segment = segment.unsqueeze(0)
-            if dtype == torch.float16:
-                segment = segment.half()
-            audio_features, embeddings  = model.encoder(segment, include_embeddings = True)
-            
-            encoder_embeddings = embeddings
+            segment = pad_segment(mel[:, seek:seek + sample_skip], truncate_context, context_margin)
+            encoder_embeddings = encode_segment(model, segment, dtype)
             #print(f"encoder_embeddings shape {encoder_embeddings.shape}")
             add_segment(
                 start=seek,
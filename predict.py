@@ -5,9 +5,32 @@ from cog import BasePredictor, Input, Path
 import os
 import time
 import subprocess
+import uuid
+from collections import OrderedDict
 
 MODEL_CACHE = "checkpoints"
 MODEL_URL = "https://weights.replicate.delivery/default/chunyu-li/LatentSync/model.tar"
+CONFIG_PATH = "configs/unet/stage2_512.yaml"
+CKPT_PATH = "checkpoints/latentsync_unet.pt"
+# Written by tools/convert_unet_to_safetensors.py, loads faster than the pickled checkpoint
+SAFETENSORS_CKPT_PATH = "checkpoints/latentsync_unet.safetensors"
+# Compiling the UNet pays off for long-lived workers; the kernels are cached on disk for the next ones
+COMPILE_UNET = os.getenv("COMPILE_UNET", "0") == "1"
+COMPILE_CACHE_DIR = os.getenv("COMPILE_CACHE_DIR", "checkpoints/compile_cache")
+# Precision of CPU-only workers (fp32, bf16 or int8), ignored when CUDA is available
+CPU_DTYPE = os.getenv("CPU_DTYPE", "fp32")
+# Per-window checkpoints of long renders, on a volume that outlives the worker, so a preempted job can resume
+RENDER_CHECKPOINT_DIR = os.getenv("RENDER_CHECKPOINT_DIR") or None
+# Jobs rendered at once by a worker, their UNet steps run as batched forwards when more than one
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "1"))
+# Memory for the VAE activations in MB; when set, the frames go through the VAE in micro-batches that fit into it
+VAE_MEMORY_BUDGET_MB = int(os.getenv("VAE_MEMORY_BUDGET_MB", "0")) or None
+# One projection for the self-attention query, key and value; the sums round differently, so it is opt-in
+FUSE_QKV = os.getenv("FUSE_QKV", "0") == "1"
+
+
+def get_checkpoint_path():
+    return SAFETENSORS_CKPT_PATH if os.path.exists(SAFETENSORS_CKPT_PATH) else CKPT_PATH
 
 
 def download_weights(url, dest):
@@ -21,6 +44,10 @@ def download_weights(url, dest):
 class Predictor(BasePredictor):
     def setup(self) -> None:
         """Load the model into memory to make running multiple predictions efficient"""
+        self.last_report = None
+        # Reports of the latest jobs by job ID, until their caller collects them. Only the concurrent jobs are kept,
+        # the reports of jobs whose caller does not collect them (Cog called directly) are dropped.
+        self.job_reports = OrderedDict()
         # Download the model weights
         if not os.path.exists(MODEL_CACHE):
             download_weights(MODEL_URL, MODEL_CACHE)
@@ -31,14 +58,97 @@ class Predictor(BasePredictor):
             "ln -s $(pwd)/checkpoints/auxiliary/vgg16-397923af.pth ~/.cache/torch/hub/checkpoints/vgg16-397923af.pth"
         )
 
+        if COMPILE_UNET:
+            # Load, compile and warm up the UNet now instead of in the first prediction
+            from omegaconf import OmegaConf
+            from scripts.inference import get_device_and_dtype, get_pipeline
+
+            device, dtype = get_device_and_dtype(CPU_DTYPE)
+            get_pipeline(OmegaConf.load(CONFIG_PATH), self.build_args(guidance_scale=2.0), dtype, device)
+
+    def build_args(self, guidance_scale, **kwargs):
+        import argparse
+
+        args = argparse.Namespace(
+            inference_ckpt_path=get_checkpoint_path(),
+            video_path=None,
+            audio_path=None,
+            video_out_path="/tmp/video_out.mp4",
+            extra_audio_paths=None,
+            batch_max_audios=1,
+            inference_steps=20,
+            scheduler="ddim",
+            strength=1.0,
+            guidance_scale=guidance_scale,
+            guidance_end_step=None,
+            guidance_end_fraction=None,
+            temp_dir="temp",
+            checkpoint_dir=RENDER_CHECKPOINT_DIR,
+            job_id=None,
+            seed=0,
+            enable_deepcache=False,
+            deepcache_interval=3,
+            deepcache_branch_id=0,
+            fuse_qkv=FUSE_QKV,
+            attention_slicing=False,
+            attention_memory_budget_mb=None,
+            vae_micro_batching=VAE_MEMORY_BUDGET_MB is not None,
+            vae_memory_budget_mb=VAE_MEMORY_BUDGET_MB,
+            token_merging_ratios=None,
+            flat_layout=False,
+            channels_last=False,
+            compile_unet=COMPILE_UNET,
+            compile_cache_dir=COMPILE_CACHE_DIR,
+            cpu_dtype=CPU_DTYPE,
+            progressive_output=None,
+            segment_seconds=2.0,
+            unet_batching=WORKER_CONCURRENCY > 1,
+            unet_batch_size=8,
+            unet_batch_wait_ms=20.0,
+            partial_decode=False,
+            partial_decode_margin=8,
+            remove_background=False,
+            whisper_truncate_context=False,
+            skip_silence=False,
+            silence_threshold_db=-40.0,
+        )
+        for key, value in kwargs.items():
+            setattr(args, key, value)
+        return args
+
+    def output_paths(self, job_id=""):
+        """The output video and the temporary directory of a job."""
+        if WORKER_CONCURRENCY > 1:
+            # Concurrent jobs must not write to the same files
+            return f"/tmp/video_out_{job_id}.mp4", os.path.join("temp", job_id)
+        return "/tmp/video_out.mp4", "temp"
+
     def predict(
         self,
         video: Path = Input(description="Input video", default=None),
         audio: Path = Input(description="Input audio to ", default=None),
         guidance_scale: float = Input(description="Guidance scale", ge=1, le=3, default=2.0),
-        inference_steps: int = Input(description="Inference steps", ge=20, le=50, default=20),
+        inference_steps: int = Input(
+            description="Inference steps, 6-10 are enough with dpmsolver++ or unipc", ge=6, le=50, default=20
+        ),
+        scheduler: str = Input(description="Sampler", choices=["ddim", "dpmsolver++", "unipc"], default="ddim"),
         seed: int = Input(description="Set to 0 for Random seed", default=0),
         remove_background: bool = Input(description="Remove background from final video", default=False),
+        skip_silence: bool = Input(description="Keep the source frames where the audio is silent", default=False),
+        guidance_end_fraction: float = Input(
+            description="Fraction of the steps that use guidance, the rest run at half the batch size",
+            ge=0,
+            le=1,
+            default=1.0,
+        ),
+        job_id: str = Input(
+            description="ID of the render, a rerun with the same ID resumes from its checkpoints", default=""
+        ),
+        progressive_output: str = Input(
+            description="Encode the video as it renders, to a fragmented MP4 or HLS segments next to the output",
+            choices=["none", "fmp4", "hls"],
+            default="none",
+        ),
     ) -> Path:
         """Run a single prediction on the model"""
         if seed <= 0:
@@ -47,37 +157,83 @@ class Predictor(BasePredictor):
 
         video_path = str(video)
         audio_path = str(audio)
-        config_path = "configs/unet/stage2_512.yaml"
-        ckpt_path = "checkpoints/latentsync_unet.pt"
-        output_path = "/tmp/video_out.mp4"
+        output_path, temp_dir = self.output_paths(job_id or uuid.uuid4().hex)
 
         # Use scripts.inference directly to get the correct return path
         from scripts.inference import main
         from omegaconf import OmegaConf
-        import argparse
-        
+
         # Load config
-        config = OmegaConf.load(config_path)
+        config = OmegaConf.load(CONFIG_PATH)
         config["run"].update({
             "guidance_scale": guidance_scale,
             "inference_steps": inference_steps,
         })
-        
+
         # Create arguments object
-        args = argparse.Namespace(
-            inference_ckpt_path=ckpt_path,
+        args = self.build_args(
+            guidance_scale=guidance_scale,
             video_path=video_path,
             audio_path=audio_path,
             video_out_path=output_path,
+            temp_dir=temp_dir,
             inference_steps=inference_steps,
-            guidance_scale=guidance_scale,
-            temp_dir="temp",
+            scheduler=scheduler,
             seed=seed,
-            enable_deepcache=False,
-            remove_background=remove_background
+            remove_background=remove_background,
+            skip_silence=skip_silence,
+            guidance_end_fraction=guidance_end_fraction,
+            # Without an ID there is no job to resume
+            checkpoint_dir=RENDER_CHECKPOINT_DIR if job_id else None,
+            job_id=job_id or None,
+            progressive_output=None if progressive_output == "none" else progressive_output,
         )
-        
+
         print(f"Running inference with remove_background={remove_background}")
-        final_output_path = main(config=config, args=args)
-        
+        final_output_path, report = main(config=config, args=args, return_report=True)
+        self.last_report = report
+        if job_id:
+            self.job_reports[job_id] = report
+            while len(self.job_reports) > max(WORKER_CONCURRENCY, 1):
+                self.job_reports.popitem(last=False)
+
         return Path(final_output_path)
+
+    def predict_batch(
+        self,
+        video,
+        audios,
+        guidance_scale=2.0,
+        inference_steps=20,
+        scheduler="ddim",
+        seed=0,
+        skip_silence=False,
+        guidance_end_fraction=1.0,
+        job_id="",
+    ):
+        """Render `video` with every audio of `audios` in one pipeline call, returns the output paths and reports."""
+        if seed <= 0:
+            seed = int.from_bytes(os.urandom(2), "big")
+        print(f"Using seed: {seed}")
+
+        output_path, temp_dir = self.output_paths(job_id or uuid.uuid4().hex)
+        output_stem = os.path.splitext(output_path)[0]
+        output_paths = [f"{output_stem}_{index}.mp4" for index in range(len(audios))]
+
+        from scripts.inference import main_batch
+        from omegaconf import OmegaConf
+
+        config = OmegaConf.load(CONFIG_PATH)
+        args = self.build_args(
+            guidance_scale=guidance_scale,
+            video_path=str(video),
+            temp_dir=temp_dir,
+            inference_steps=inference_steps,
+            scheduler=scheduler,
+            seed=seed,
+            skip_silence=skip_silence,
+            guidance_end_fraction=guidance_end_fraction,
+            checkpoint_dir=None,
+        )
+        reports = main_batch(config, args, [str(audio) for audio in audios], output_paths)
+        return output_paths, reports
@@ -0,0 +1,100 @@
+"""Result cache of the RunPod worker, for retried and repeated render requests.
+
+A render is identified by `result_key`: the sha256 of the video and audio contents, of the checkpoint
+and of the config, together with the render settings. Identical requests get the same key whatever
+the URLs they were downloaded from, so a retried job is answered from the store without rendering.
+Renders with a random seed (seed 0) are not reproducible and are never stored.
+
+The store is pluggable, `LocalDirectoryResultStore` keeps the results on disk (for tests and single
+workers) and `GCSResultStore` next to the uploaded videos, where every worker sees them.
+
+    store = LocalDirectoryResultStore("/tmp/result_cache")
+    key = result_key(video_path, audio_path, ckpt_path, config_path, {"guidance_scale": 2.0, "seed": 1247})
+    result = store.get(key)
+    if result is None:
+        ...  # render, upload
+        store.put(key, {"output_url": output_url, "report": report}, output_path)
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Optional
+
+from latentsync.utils.render_checkpoint import file_digest
+
+
+def result_key(video_path, audio_path, checkpoint_path, config_path, settings: dict):
+    """
+    Key of a render. `settings` holds every request parameter that changes the output
+    (guidance_scale, inference_steps, seed, remove_background, ...), it must be JSON serializable.
+    """
+    payload = {
+        "video": file_digest(video_path),
+        "audio": file_digest(audio_path),
+        "checkpoint": file_digest(checkpoint_path),
+        "config": file_digest(config_path),
+        "settings": settings,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResultStore:
+    """Maps a result key to the JSON record of a finished render (e.g. its upload URL and report)."""
+
+    def get(self, key) -> Optional[dict]:
+        raise NotImplementedError
+
+    def put(self, key, result: dict, output_path=None):
+        """Store `result` under `key`, backends that can hold files keep a copy of `output_path` as well."""
+        raise NotImplementedError
+
+
+class LocalDirectoryResultStore(ResultStore):
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def get(self, key) -> Optional[dict]:
+        record_path = os.path.join(self.root, f"{key}.json")
+        if not os.path.isfile(record_path):
+            return None
+        with open(record_path) as f:
+            result = json.load(f)
+        # The record is written last, but the output may have been removed since
+        if "output_path" in result and not os.path.isfile(result["output_path"]):
+            return None
+        return result
+
+    def put(self, key, result: dict, output_path=None):
+        result = dict(result)
+        if output_path is not None:
+            stored_output_path = os.path.join(self.root, f"{key}{os.path.splitext(output_path)[1]}")
+            shutil.copyfile(output_path, stored_output_path)
+            result["output_path"] = stored_output_path
+
+        # Write the record atomically, a reader never sees a partial file
+        fd, tmp_path = tempfile.mkstemp(prefix=".partial-", dir=self.root)
+        with os.fdopen(fd, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp_path, os.path.join(self.root, f"{key}.json"))
+
+
+class GCSResultStore(ResultStore):
+    """Keeps the records as JSON blobs under `prefix` of a google.cloud.storage bucket, next to the uploaded videos."""
+
+    def __init__(self, bucket, prefix="results/"):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, key) -> Optional[dict]:
+        blob = self.bucket.blob(f"{self.prefix}{key}.json")
+        if not blob.exists():
+            return None
+        return json.loads(blob.download_as_text())
+
+    def put(self, key, result: dict, output_path=None):
+        blob = self.bucket.blob(f"{self.prefix}{key}.json")
+        blob.upload_from_string(json.dumps(result), content_type="application/json")
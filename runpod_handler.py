@@ -2,16 +2,25 @@ import sys
 import subprocess
 import runpod
 import os
+import asyncio
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
 import requests
 import uuid
 import base64, json
 from google.cloud import storage
-from predict import Predictor # Assuming Predictor is in predict.py
+from download_cache import DownloadCache
+from latentsync.utils.progressive_writer import hls_playlist_path, list_hls_segments
+from predict import CONFIG_PATH, WORKER_CONCURRENCY, Predictor, get_checkpoint_path # Assuming Predictor is in predict.py
+from result_cache import GCSResultStore, LocalDirectoryResultStore, result_key
 
 # Global predictor instance to reuse (RunPod might keep workers warm)
 # Setup will be called if the instance is not ready
 predictor_instance = None
+# Concurrent jobs (WORKER_CONCURRENCY > 1) set up the predictor once
+_predictor_lock = threading.Lock()
 
 # ------------------ GCS client helper ------------------
 _gcs_client = None
@@ -36,38 +45,173 @@ def get_gcs_client():
     return _gcs_client
 # -------------------------------------------------------
 
+# Inputs are kept across jobs on the worker's disk, a repeated avatar URL is not downloaded again
+download_cache = DownloadCache(
+    os.getenv("DOWNLOAD_CACHE_DIR", "/tmp/latentsync_download_cache"),
+    max_bytes=int(float(os.getenv("DOWNLOAD_CACHE_MAX_GB", "10")) * 1024**3),
+)
 
-def download_file(url, destination_dir):
-    """Downloads a file from a URL to a specified directory using pget."""
-    print(f"Downloading {url} to {destination_dir}")
-    
-    # Extract a clean filename from URL (remove query parameters)
-    from urllib.parse import urlparse
-    parsed_url = urlparse(url)
-    clean_filename = os.path.basename(parsed_url.path)
-    if not clean_filename or clean_filename == '/':
-        clean_filename = "downloaded_file"
-    
-    filename = os.path.join(destination_dir, clean_filename)
-    
-    try:
-        subprocess.check_call(["pget", url, filename], close_fds=False)
-        print(f"Successfully downloaded {url} to {filename}")
-        return filename
-    except subprocess.CalledProcessError as e:
-        print(f"Error downloading {url}: {e}")
-        raise
-    except FileNotFoundError:
-        print("Error: pget command not found. Ensure it is installed and in PATH.")
-        raise Exception("pget not found. Cannot download files.")
+# ------------------ Result cache ------------------
+_result_store = None
 
 
-def handler(event):
+def get_result_store():
+    """The store of finished renders selected by RESULT_CACHE_BACKEND (gcs, local or none)."""
+    global _result_store
+    if _result_store is not None:
+        return _result_store
+
+    backend = os.getenv("RESULT_CACHE_BACKEND", "gcs")
+    if backend == "none":
+        return None
+    if backend == "local":
+        _result_store = LocalDirectoryResultStore(os.getenv("RESULT_CACHE_DIR", "/tmp/latentsync_result_cache"))
+    elif backend == "gcs":
+        bucket = get_gcs_client().bucket(os.getenv("GCS_BUCKET"))
+        _result_store = GCSResultStore(bucket, prefix=os.getenv("RESULT_CACHE_PREFIX", "results/"))
+    else:
+        raise ValueError(f"Unknown RESULT_CACHE_BACKEND {backend}, choose one of gcs, local or none")
+    return _result_store
+# --------------------------------------------------
+
+
+def upload_file(local_file_path, bucket_name, blob_path, content_type, cache_control=None):
+    """Upload a file to gs://bucket_name/blob_path and return its public URL."""
+    client = get_gcs_client()
+    bucket = client.bucket(bucket_name)
+    blob = bucket.blob(blob_path)
+    if cache_control is not None:
+        blob.cache_control = cache_control
+
+    print(f"HANDLER: Uploading to gs://{bucket_name}/{blob_path} ...")
+    blob.upload_from_filename(local_file_path, content_type=content_type)
+
+    public_url = f"https://storage.googleapis.com/{bucket_name}/{blob_path}"
+    print(f"HANDLER: Upload success. Public URL: {public_url}")
+    return public_url
+
+
+def upload_output(local_file_path, bucket_name):
+    """Upload a rendered video to GCS and return its public URL."""
+    prefix = os.getenv("GCS_UPLOAD_PREFIX", "videos/")
+# MODNet使用MP4格式，文件更小
+    file_extension = "mp4"
+    content_type = "video/mp4"
+    unique_filename = f"{uuid.uuid4()}.{file_extension}"
+    return upload_file(local_file_path, bucket_name, f"{prefix}{unique_filename}", content_type)
+
+
+def stream_hls_segments(event, playlist_path, bucket_name, render_done, poll_seconds=1.0):
+    """
+    Upload the HLS segments of a running render as ffmpeg closes them, then the playlist, and report the
+    playlist URL as job progress, so clients can play the first seconds while the rest renders.
+    Returns the URL of the playlist once `render_done` is set and every segment is uploaded.
+    """
+    prefix = f"{os.getenv('GCS_UPLOAD_PREFIX', 'videos/')}{uuid.uuid4()}/"
+    uploaded = set()
+    playlist_url = None
+    while True:
+        # Checked before listing, the segments closed when the render ends are uploaded in this round
+        finished = render_done.is_set()
+        segments = [segment for segment in list_hls_segments(playlist_path) if segment not in uploaded]
+        for segment in segments:
+            upload_file(segment, bucket_name, f"{prefix}{os.path.basename(segment)}", "video/mp2t")
+            uploaded.add(segment)
+        if segments or (finished and os.path.isfile(playlist_path)):
+            # The playlist only lists uploaded segments, and players must not cache it while it grows
+            playlist_url = upload_file(
+                playlist_path,
+                bucket_name,
+                f"{prefix}index.m3u8",
+                "application/vnd.apple.mpegurl",
+                cache_control="no-cache",
+            )
+            runpod.serverless.progress_update(event, {"playlist_url": playlist_url, "segments": len(uploaded)})
+        if finished:
+            return playlist_url
+        render_done.wait(poll_seconds)
+
+
+def get_predictor():
     global predictor_instance
+    with _predictor_lock:
+        if predictor_instance is None:
+            print("Initializing Predictor...")
+            predictor = Predictor()
+            predictor.setup() # This downloads model weights, sets up links
+            predictor_instance = predictor
+            print("Predictor initialized.")
+    return predictor_instance
+
+
+def clip_audio(audio_path, audio_max_sec, clipped_audio):
+    subprocess.check_call([
+        "ffmpeg", "-y", "-i", audio_path,
+        "-t", str(audio_max_sec), "-c", "copy", clipped_audio
+    ])
+    print(f"Audio clipped to {audio_max_sec}s -> {clipped_audio}")
+    return clipped_audio
+
+
+def batch_handler(event, job_input):
+    """
+    Renders one video with every audio of `audio_urls` in a single pipeline call, which prepares the video once
+    and batches the UNet steps of the audios. Returns an output URL and report per audio, in their order.
+    """
+    video_url = job_input.get('video_url')
+    audio_urls = job_input.get('audio_urls')
+    audio_max_sec = float(job_input.get('audio_max_sec', 0))  # 0 means no clipping
+    if not video_url or not audio_urls:
+        return {"error": "video_url and audio_urls are required."}
+
+    bucket_name = os.getenv("GCS_BUCKET")
+    if not bucket_name:
+        print("HANDLER: Error - GCS_BUCKET environment variable not set.")
+        return {"error": "GCS_BUCKET environment variable not set."}
+
+    predictor = get_predictor()
+    try:
+        # The downloads stay pinned in the download cache until the job is done
+        with (
+            tempfile.TemporaryDirectory() as tmpdir_audio,
+            download_cache.use([video_url] + list(audio_urls)) as local_paths,
+        ):
+            local_video_path, local_audio_paths = local_paths[0], local_paths[1:]
+            if audio_max_sec > 0:
+                local_audio_paths = [
+                    clip_audio(audio_path, audio_max_sec, os.path.join(tmpdir_audio, f"clip_{index}.wav"))
+                    for index, audio_path in enumerate(local_audio_paths)
+                ]
+
+            output_paths, reports = predictor.predict_batch(
+                video=local_video_path,
+                audios=local_audio_paths,
+                guidance_scale=float(job_input.get('guidance_scale', 2.0)),
+                inference_steps=int(job_input.get('inference_steps', 20)),
+                scheduler=job_input.get('scheduler', 'ddim'),
+                seed=int(job_input.get('seed', 0)),
+                skip_silence=bool(job_input.get('skip_silence', False)),
+                guidance_end_fraction=float(job_input.get('guidance_end_fraction', 1.0)),
+                job_id=event.get('id', ''),
+            )
 
+            outputs = []
+            for output_path, report in zip(output_paths, reports):
+                outputs.append({"output_url": upload_output(output_path, bucket_name), "report": report})
+                os.remove(output_path)
+            return {"outputs": outputs}
+
+    except Exception as e:
+        print(f"HANDLER: Exception caught in batch render ({e}), returning error.")
+        return {"error": str(e)}
+
+
+def handler(event):
     job_input = event.get('input', {})
     if not job_input:
         return {"error": "No input provided in event"}
+    if job_input.get('audio_urls'):
+        return batch_handler(event, job_input)
 
     video_url = job_input.get('video_url')
     audio_url = job_input.get('audio_url')
@@ -79,48 +223,99 @@ def handler(event):
 # Parameters for the model, with defaults matching predict.py if not provided
     guidance_scale = float(job_input.get('guidance_scale', 2.0))
     inference_steps = int(job_input.get('inference_steps', 20))
+    scheduler = job_input.get('scheduler', 'ddim')  # 'dpmsolver++' or 'unipc' for 6-10 steps
     seed = int(job_input.get('seed', 0)) # 0 for random seed as per predict.py
     remove_background = bool(job_input.get('remove_background', False))
+    skip_silence = bool(job_input.get('skip_silence', False))
+    guidance_end_fraction = float(job_input.get('guidance_end_fraction', 1.0))  # 1.0 guides every step
+    # 'hls' uploads segments while rendering and reports the playlist URL as progress, 'fmp4' writes a fragmented MP4
+    progressive_output = job_input.get('progressive_output', 'none')
+    if progressive_output != 'none' and remove_background:
+        return {"error": "progressive_output cannot be combined with remove_background."}
 
     # Initialize predictor if not already done
-    if predictor_instance is None:
-        print("Initializing Predictor...")
-        predictor_instance = Predictor()
-        predictor_instance.setup() # This downloads model weights, sets up links
-        print("Predictor initialized.")
+    get_predictor()
+    job_id = event.get('id', '')
 
     try:
-        # Create temporary directories for downloaded files
-        with tempfile.TemporaryDirectory() as tmpdir_video, tempfile.TemporaryDirectory() as tmpdir_audio:
-            print(f"Created temporary directories: {tmpdir_video}, {tmpdir_audio}")
-            
-            local_video_path = download_file(video_url, tmpdir_video)
-            local_audio_path = download_file(audio_url, tmpdir_audio)
+        # The downloads land in the download cache, pinned until the job is done, the temporary directory only
+        # holds the clipped audio. The video and the audio are downloaded in parallel
+        with tempfile.TemporaryDirectory() as tmpdir_audio, download_cache.use([video_url, audio_url]) as local_paths:
+            local_video_path, local_audio_path = local_paths
+
+            bucket_name = os.getenv("GCS_BUCKET")
+            if not bucket_name:
+                print("HANDLER: Error - GCS_BUCKET environment variable not set.")
+                return {"error": "GCS_BUCKET environment variable not set."}
+
+            # Identical requests (e.g. retries after a timeout) are answered without rendering. The key covers
+            # the contents of the inputs, so the same files behind other URLs hit the cache as well. Seed 0 asks
+            # for a new random seed, those renders are neither looked up nor stored
+            result_store = get_result_store()
+            cache_key = None
+            if result_store is not None and seed != 0:
+                settings = {
+                    "guidance_scale": guidance_scale,
+                    "inference_steps": inference_steps,
+                    "scheduler": scheduler,
+                    "seed": seed,
+                    "remove_background": remove_background,
+                    "skip_silence": skip_silence,
+                    "guidance_end_fraction": guidance_end_fraction,
+                    "progressive_output": progressive_output,
+                    "audio_max_sec": audio_max_sec,
+                }
+                cache_key = result_key(local_video_path, local_audio_path, get_checkpoint_path(), CONFIG_PATH, settings)
+                cached = result_store.get(cache_key)
+                if cached is not None:
+                    print(f"HANDLER: Result cache hit {cache_key}")
+                    output_url = cached.get("output_url")
+                    if output_url is None:
+                        # The store only holds the video
+                        output_url = upload_output(cached["output_path"], bucket_name)
+                    return {"output_url": output_url, "report": cached.get("report"), "cached": True}
 
             # Optional audio clipping
             if audio_max_sec > 0:
-                clipped_audio = os.path.join(tmpdir_audio, "clip.wav")
                 try:
-                    subprocess.check_call([
-                        "ffmpeg", "-y", "-i", local_audio_path,
-                        "-t", str(audio_max_sec), "-c", "copy", clipped_audio
-                    ])
-                    local_audio_path = clipped_audio
-                    print(f"Audio clipped to {audio_max_sec}s -> {clipped_audio}")
+                    local_audio_path = clip_audio(
+                        local_audio_path, audio_max_sec, os.path.join(tmpdir_audio, "clip.wav")
+                    )
                 except subprocess.CalledProcessError as e:
                     print(f"Error clipping audio: {e}")
                     return {"error": "Failed to clip audio"}
 
+            streamer = None
+            if progressive_output == 'hls':
+                playlist_path = hls_playlist_path(predictor_instance.output_paths(job_id)[0])
+                # A playlist left by an earlier job must not be streamed
+                shutil.rmtree(os.path.dirname(playlist_path), ignore_errors=True)
+                render_done = threading.Event()
+                streamer = ThreadPoolExecutor(max_workers=1)
+                playlist_future = streamer.submit(stream_hls_segments, event, playlist_path, bucket_name, render_done)
+
             print(f"Calling predictor.predict with video: {local_video_path}, audio: {local_audio_path}")
-            # Call the predict method
-            output_path_object = predictor_instance.predict(
-                video=local_video_path, # predict.py expects string paths
-                audio=local_audio_path, # predict.py expects string paths
-                guidance_scale=guidance_scale,
-                inference_steps=inference_steps,
-                seed=seed,
-                remove_background=remove_background
-            )
+            try:
+                # Call the predict method
+                output_path_object = predictor_instance.predict(
+                    video=local_video_path, # predict.py expects string paths
+                    audio=local_audio_path, # predict.py expects string paths
+                    guidance_scale=guidance_scale,
+                    inference_steps=inference_steps,
+                    scheduler=scheduler,
+                    seed=seed,
+                    remove_background=remove_background,
+                    skip_silence=skip_silence,
+                    guidance_end_fraction=guidance_end_fraction,
+                    # A retried RunPod job keeps its ID and resumes from the checkpoints (RENDER_CHECKPOINT_DIR)
+                    job_id=job_id,
+                    progressive_output=progressive_output,
+                )
+            finally:
+                if streamer is not None:
+                    render_done.set()
+                    streamer.shutdown(wait=False)
+            playlist_url = playlist_future.result() if streamer is not None else None
             
             output_path_str = str(output_path_object) # Convert Path object to string
             print(f"Prediction successful. Output at: {output_path_str}")
@@ -128,35 +323,31 @@ def handler(event):
             # ---------- Upload to Google Cloud Storage ----------
             local_file_path = output_path_str  # '/tmp/video_out.mp4'
 
-            bucket_name = os.getenv("GCS_BUCKET")
-            if not bucket_name:
-                print("HANDLER: Error - GCS_BUCKET environment variable not set.")
-                return {"error": "GCS_BUCKET environment variable not set."}
-
             try:
-                client = get_gcs_client()
-                bucket = client.bucket(bucket_name)
-
-                prefix = os.getenv("GCS_UPLOAD_PREFIX", "videos/")
-# MODNet使用MP4格式，文件更小
-                file_extension = "mp4"
-                content_type = "video/mp4"
-                unique_filename = f"{uuid.uuid4()}.{file_extension}"
-                blob_path = f"{prefix}{unique_filename}"
-                blob = bucket.blob(blob_path)
-
-                print(f"HANDLER: Uploading to gs://{bucket_name}/{blob_path} ...")
-                blob.upload_from_filename(local_file_path, content_type=content_type)
-
-                public_url = f"https://storage.googleapis.com/{bucket_name}/{blob_path}"
-                print(f"HANDLER: Upload success. Public URL: {public_url}")
-
-                return {"output_url": public_url}
+                public_url = upload_output(local_file_path, bucket_name)
             except Exception as upload_e:
                 print(f"HANDLER: Failed to upload to GCS: {upload_e}")
                 return {"error": "Failed to upload to GCS", "details": str(upload_e)}
             # ---------- End GCS upload ----------
 
+            report = predictor_instance.job_reports.pop(job_id, None) if job_id else predictor_instance.last_report
+            result = {"output_url": public_url, "report": report}
+            if playlist_url is not None:
+                result["playlist_url"] = playlist_url
+            if cache_key is not None:
+                try:
+                    result_store.put(cache_key, result, local_file_path)
+                except Exception as cache_e:
+                    # The render succeeded, a failure to cache it is not an error of the job
+                    print(f"HANDLER: Failed to store the result in the result cache: {cache_e}")
+            if WORKER_CONCURRENCY > 1:
+                # Every concurrent job writes its own output, remove it once uploaded
+                for path in {local_file_path, local_file_path.replace('_no_bg.mp4', '.mp4')}:
+                    if os.path.exists(path):
+                        os.remove(path)
+                shutil.rmtree(os.path.dirname(hls_playlist_path(local_file_path)), ignore_errors=True)
+            return result
+
     except Exception as e:
         print(f"Error during prediction: {e}")
         print(f"HANDLER: Exception caught ({e}), returning error.")
@@ -169,4 +360,13 @@ if __name__ == '__main__':
     # And ensure predict.py and its dependencies are in PYTHONPATH.
     
     print("Starting RunPod serverless worker...")
-    runpod.serverless.start({"handler": handler})
+    if WORKER_CONCURRENCY > 1:
+        # The jobs render in threads, their UNet steps are batched together (see UNetStepBatcher)
+        async def async_handler(event):
+            return await asyncio.to_thread(handler, event)
+
+        runpod.serverless.start(
+            {"handler": async_handler, "concurrency_modifier": lambda current_concurrency: WORKER_CONCURRENCY}
+        )
+    else:
+        runpod.serverless.start({"handler": handler})
@@ -14,31 +14,30 @@
 
 import argparse
 import os
+import shutil
+import threading
 from omegaconf import OmegaConf
 import torch
-from diffusers import AutoencoderKL, DDIMScheduler
+from diffusers import AutoencoderKL
 from latentsync.models.unet import UNet3DConditionModel
 from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
+from latentsync.pipelines.unet_batcher import UNetStepBatcher
 from accelerate.utils import set_seed
 from latentsync.whisper.audio2feature import Audio2Feature
-from DeepCache import DeepCacheSDHelper
+from latentsync.utils.torch_compile import compile_unet, warmup_batch_sizes, warmup_unet
+from latentsync.utils.image_processor import load_fixed_mask
+from latentsync.utils.progressive_writer import PROGRESSIVE_FORMATS, hls_playlist_path
+from latentsync.utils.quantization import quantize_unet_int8, quantize_whisper_encoder_int8
+from latentsync.utils.schedulers import SCHEDULERS, load_scheduler
 
 
-def main(config, args):
-    if not os.path.exists(args.video_path):
-        raise RuntimeError(f"Video path '{args.video_path}' not found")
-    if not os.path.exists(args.audio_path):
-        raise RuntimeError(f"Audio path '{args.audio_path}' not found")
+_pipeline_cache = {}
+# Concurrent jobs (--unet_batching) must not load the models twice
+_pipeline_lock = threading.Lock()
 
-    # Check if the GPU supports float16
-    is_fp16_supported = torch.cuda.is_available() and torch.cuda.get_device_capability()[0] > 7
-    dtype = torch.float16 if is_fp16_supported else torch.float32
 
-    print(f"Input video path: {args.video_path}")
-    print(f"Input audio path: {args.audio_path}")
-    print(f"Loaded checkpoint path: {args.inference_ckpt_path}")
-
-    scheduler = DDIMScheduler.from_pretrained("configs")
+def build_pipeline(config, args, dtype, device="cuda"):
+    scheduler = load_scheduler(args.scheduler)
 
     if config.model.cross_attention_dim == 768:
         whisper_model_path = "checkpoints/whisper/small.pt"
@@ -49,9 +48,11 @@ def main(config, args):
 
     audio_encoder = Audio2Feature(
         model_path=whisper_model_path,
-        device="cuda",
+        device=device,
         num_frames=config.data.num_frames,
         audio_feat_length=config.data.audio_feat_length,
+        truncate_context=args.whisper_truncate_context,
+        dtype=dtype if dtype == torch.bfloat16 else None,
     )
 
     vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=dtype)
@@ -62,31 +63,195 @@ def main(config, args):
         OmegaConf.to_container(config.model),
         args.inference_ckpt_path,
         device="cpu",
+        dtype=dtype,
     )
 
-    unet = unet.to(dtype=dtype)
+    if args.fuse_qkv:
+        unet.fuse_qkv_projections()
+
+    if args.token_merging_ratios:
+        # Only merge tokens in the part of the face that is copied from the reference frames
+        merge_mask = load_fixed_mask(config.data.resolution, config.data.mask_image_path)[0]
+        unet.set_token_merging(args.token_merging_ratios, merge_mask=merge_mask)
+
+    if args.attention_slicing:
+        memory_budget = None
+        if args.attention_memory_budget_mb is not None:
+            memory_budget = args.attention_memory_budget_mb * 1024**2
+        unet.set_attention_slice("auto", memory_budget=memory_budget)
+
+    if args.flat_layout:
+        unet.enable_flat_layout(channels_last=args.channels_last)
+
+    if device == "cpu" and args.cpu_dtype == "int8":
+        print("Quantizing the UNet and whisper linear layers to int8")
+        quantize_unet_int8(unet)
+        quantize_whisper_encoder_int8(audio_encoder.model)
 
     pipeline = LipsyncPipeline(
         vae=vae,
         audio_encoder=audio_encoder,
         unet=unet,
         scheduler=scheduler,
-    ).to("cuda")
+    ).to(device)
+
+    if args.vae_micro_batching:
+        memory_budget = None
+        if args.vae_memory_budget_mb is not None:
+            memory_budget = args.vae_memory_budget_mb * 1024**2
+        pipeline.enable_vae_micro_batching(memory_budget)
+
+    if args.unet_batching:
+        pipeline.unet_batcher = UNetStepBatcher(
+            unet, max_batch_size=args.unet_batch_size, max_wait=args.unet_batch_wait_ms / 1000
+        )
 
     # use DeepCache
-    if args.enable_deepcache:
-        helper = DeepCacheSDHelper(pipe=pipeline)
-        helper.set_params(cache_interval=3, cache_branch_id=0)
-        helper.enable()
+    if args.enable_deepcache and args.unet_batching:
+        # The cached features belong to one job's latents, the batched forwards mix the steps of several jobs
+        print("DeepCache is disabled with --unet_batching")
+    elif args.enable_deepcache and args.compile_unet:
+        # The cached steps are decided on the host, the compiled forward would recompile at every step
+        print("DeepCache is disabled with --compile_unet")
+    elif args.enable_deepcache:
+        unet.enable_deepcache(cache_interval=args.deepcache_interval, cache_branch_id=args.deepcache_branch_id)
+
+    if args.compile_unet:
+        batch_sizes = warmup_batch_sizes(args.unet_batch_size if args.unet_batching else None)
+        # A shorter last window compiles once more for every batch size
+        compile_unet(unet, args.compile_cache_dir, dtype=dtype, device=device, num_graphs=2 * len(batch_sizes))
+        # one whisper chunk holds 2 positions per video frame of context, from every encoder layer
+        num_audio_tokens = (sum(config.data.audio_feat_length) + 1) * 2 * (audio_encoder.model.dims.n_audio_layer + 1)
+        warmup_unet(
+            unet,
+            batch_sizes=batch_sizes,
+            num_frames=config.data.num_frames,
+            height=config.data.resolution,
+            width=config.data.resolution,
+            audio_embeds_shape=(num_audio_tokens, audio_encoder.embedding_dim),
+            device=device,
+            dtype=dtype,
+            timestep_per_sample=args.unet_batching,
+        )
+
+    return pipeline
+
 
-    if args.seed != -1:
-        set_seed(args.seed)
+def get_pipeline(config, args, dtype, device="cuda"):
+    """Return the pipeline for these settings, loading (and compiling) it only on the first call in the process."""
+    key = (
+        OmegaConf.to_yaml(config.model),
+        OmegaConf.to_yaml(config.data),
+        args.inference_ckpt_path,
+        str(dtype),
+        device,
+        args.cpu_dtype if device == "cpu" else None,
+        args.fuse_qkv,
+        args.attention_slicing,
+        args.attention_memory_budget_mb,
+        args.vae_micro_batching,
+        args.vae_memory_budget_mb,
+        tuple(args.token_merging_ratios or ()),
+        args.flat_layout,
+        args.channels_last,
+        args.enable_deepcache,
+        args.deepcache_interval,
+        args.deepcache_branch_id,
+        args.whisper_truncate_context,
+        args.compile_unet,
+        args.compile_cache_dir,
+        args.unet_batching,
+        args.unet_batch_size,
+        args.unet_batch_wait_ms,
+    )
+    with _pipeline_lock:
+        if key not in _pipeline_cache:
+            # Keep a single pipeline alive, the models do not fit in GPU memory twice
+            _pipeline_cache.clear()
+            _pipeline_cache[key] = build_pipeline(config, args, dtype, device)
+        return _pipeline_cache[key]
+
+
+def get_device_and_dtype(cpu_dtype="fp32"):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cpu":
+        # CPUs with bf16 matrix instructions (AVX512-BF16, AMX) run the models in bf16, int8 quantizes fp32 models
+        return device, torch.bfloat16 if cpu_dtype == "bf16" else torch.float32
+    # Check if the GPU supports float16
+    is_fp16_supported = torch.cuda.get_device_capability()[0] > 7
+    dtype = torch.float16 if is_fp16_supported else torch.float32
+    return device, dtype
+
+
+def get_guidance_end_step(args):
+    if args.guidance_end_step is not None and args.guidance_end_fraction is not None:
+        raise ValueError("Only one of --guidance_end_step and --guidance_end_fraction can be set")
+    if args.guidance_end_step is not None:
+        return args.guidance_end_step
+    return args.guidance_end_fraction
+
+
+def get_checkpoint_dir(args):
+    if args.checkpoint_dir is None:
+        return None
+    if not args.job_id:
+        raise ValueError("--job_id is required with --checkpoint_dir, a resumed job is found by its ID")
+    return os.path.join(args.checkpoint_dir, args.job_id)
+
+
+def get_job_pipeline(config, args, dtype, device):
+    """The pipeline of a job with its scheduler, and the generator to pass it (None for the seeded global RNG)."""
+    pipeline = get_pipeline(config, args, dtype, device)
+    generator = None
+    if args.unet_batching:
+        # Other jobs run on the same models in other threads: this job gets its own pipeline state and RNG,
+        # the global seed is shared by all of them
+        pipeline = pipeline.fork(load_scheduler(args.scheduler))
+        generator = torch.Generator(device)
+        if args.seed != -1:
+            generator.manual_seed(args.seed)
+        else:
+            generator.seed()
+        print(f"Initial seed: {generator.initial_seed()}")
     else:
-        torch.seed()
+        # The scheduler is cheap to build, so switching it does not reload the models
+        pipeline.scheduler = load_scheduler(args.scheduler)
+
+        if args.seed != -1:
+            set_seed(args.seed)
+        else:
+            torch.seed()
+
+        print(f"Initial seed: {torch.initial_seed()}")
+    return pipeline, generator
+
+
+def main(config, args, return_report=False):
+    if not os.path.exists(args.video_path):
+        raise RuntimeError(f"Video path '{args.video_path}' not found")
+    if not os.path.exists(args.audio_path):
+        raise RuntimeError(f"Audio path '{args.audio_path}' not found")
+    if args.progressive_output is not None and args.remove_background:
+        # The streamed frames would not be the final output
+        raise ValueError("--progressive_output cannot be combined with --remove_background")
+
+    device, dtype = get_device_and_dtype(args.cpu_dtype)
+    if device == "cpu":
+        print(f"CUDA is not available, running on the CPU ({args.cpu_dtype})")
+
+    print(f"Input video path: {args.video_path}")
+    print(f"Input audio path: {args.audio_path}")
+    print(f"Loaded checkpoint path: {args.inference_ckpt_path}")
+
+    pipeline, generator = get_job_pipeline(config, args, dtype, device)
 
-    print(f"Initial seed: {torch.initial_seed()}")
+    checkpoint_dir = get_checkpoint_dir(args)
+    if checkpoint_dir is not None:
+        print(f"Checkpointing every window to {checkpoint_dir}")
+    if args.progressive_output == "hls":
+        print(f"Streaming segments to {hls_playlist_path(args.video_out_path)}")
 
-    pipeline(
+    report = pipeline(
         video_path=args.video_path,
         audio_path=args.audio_path,
         video_out_path=args.video_out_path,
@@ -98,7 +263,25 @@ def main(config, args):
         height=config.data.resolution,
         mask_image_path=config.data.mask_image_path,
         temp_dir=args.temp_dir,
+        skip_silence=args.skip_silence,
+        silence_threshold_db=args.silence_threshold_db,
+        guidance_end_step=get_guidance_end_step(args),
+        strength=args.strength,
+        partial_decode=args.partial_decode,
+        partial_decode_margin=args.partial_decode_margin,
+        checkpoint_dir=checkpoint_dir,
+        generator=generator,
+        progressive_output=args.progressive_output,
+        segment_seconds=args.segment_seconds,
     )
+    if pipeline.unet_batcher is not None:
+        # Since the models were loaded, for all the jobs of the worker
+        report["unet_batching"] = pipeline.unet_batcher.metrics()
+    print(f"Skipped {report['skipped_fraction']:.1%} of the frames as silent")
+
+    if checkpoint_dir is not None:
+        # The output is written, the job does not need to be resumed anymore
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
     
     final_output_path = args.video_out_path
     
@@ -126,25 +309,229 @@ def main(config, args):
             print("[BACKGROUND REMOVAL] Continuing with original video...")
     else:
         print("[BACKGROUND REMOVAL] Background removal not requested.")
-    
+
+    if return_report:
+        return final_output_path, report
     return final_output_path
 
 
-if __name__ == "__main__":
+def main_batch(config, args, audio_paths, video_out_paths):
+    """
+    Render `args.video_path` with every audio of `audio_paths` in one pipeline call (see
+    `LipsyncPipeline.render_batch`). With `args.batch_max_audios` 1, each output is the one `main` renders for that
+    audio with the same seed.
+    Returns the reports of the outputs.
+    """
+    if not os.path.exists(args.video_path):
+        raise RuntimeError(f"Video path '{args.video_path}' not found")
+    for audio_path in audio_paths:
+        if not os.path.exists(audio_path):
+            raise RuntimeError(f"Audio path '{audio_path}' not found")
+    if args.remove_background or args.progressive_output is not None or args.checkpoint_dir is not None:
+        raise ValueError("Batch renders do not support --remove_background, --progressive_output or --checkpoint_dir")
+
+    device, dtype = get_device_and_dtype(args.cpu_dtype)
+    print(f"Input video path: {args.video_path}")
+    print(f"Input audio paths: {audio_paths}")
+
+    pipeline, generator = get_job_pipeline(config, args, dtype, device)
+    reports = pipeline.render_batch(
+        video_path=args.video_path,
+        audio_paths=audio_paths,
+        video_out_paths=video_out_paths,
+        num_frames=config.data.num_frames,
+        num_inference_steps=args.inference_steps,
+        guidance_scale=args.guidance_scale,
+        weight_dtype=dtype,
+        width=config.data.resolution,
+        height=config.data.resolution,
+        mask_image_path=config.data.mask_image_path,
+        temp_dir=args.temp_dir,
+        generator=generator,
+        skip_silence=args.skip_silence,
+        silence_threshold_db=args.silence_threshold_db,
+        guidance_end_step=get_guidance_end_step(args),
+        strength=args.strength,
+        partial_decode=args.partial_decode,
+        partial_decode_margin=args.partial_decode_margin,
+        max_batch_size=args.batch_max_audios,
+    )
+    if pipeline.unet_batcher is not None:
+        for report in reports:
+            report["unet_batching"] = pipeline.unet_batcher.metrics()
+    return reports
+
+
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--unet_config_path", type=str, default="configs/unet.yaml")
     parser.add_argument("--inference_ckpt_path", type=str, required=True)
     parser.add_argument("--video_path", type=str, required=True)
     parser.add_argument("--audio_path", type=str, required=True)
     parser.add_argument("--video_out_path", type=str, required=True)
+    parser.add_argument(
+        "--extra_audio_paths",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Render the video with these audios too, in the same pipeline call as --audio_path",
+    )
+    parser.add_argument(
+        "--batch_max_audios",
+        type=int,
+        default=1,
+        help="Most audios per UNet forward with --extra_audio_paths. With 1 the outputs are identical to single "
+        "renders, larger batches are faster but may round differently",
+    )
     parser.add_argument("--inference_steps", type=int, default=20)
     parser.add_argument("--guidance_scale", type=float, default=1.0)
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        default="ddim",
+        choices=list(SCHEDULERS),
+        help="Sampler, the multistep dpmsolver++ and unipc need fewer steps (6-10)",
+    )
+    parser.add_argument(
+        "--strength",
+        type=float,
+        default=1.0,
+        help="Start from the source faces noised to this fraction of the schedule, 1.0 starts from pure noise",
+    )
+    parser.add_argument(
+        "--guidance_end_step",
+        type=int,
+        default=None,
+        help="Apply classifier-free guidance only to the first N denoising steps",
+    )
+    parser.add_argument(
+        "--guidance_end_fraction",
+        type=float,
+        default=None,
+        help="Apply classifier-free guidance only to this leading fraction of the denoising steps",
+    )
     parser.add_argument("--temp_dir", type=str, default="temp")
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        default=None,
+        help="Save every finished window to checkpoint_dir/job_id, a rerun with the same job ID resumes from there",
+    )
+    parser.add_argument("--job_id", type=str, default=None, help="ID of the render for --checkpoint_dir")
+    parser.add_argument(
+        "--progressive_output",
+        type=str,
+        default=None,
+        choices=list(PROGRESSIVE_FORMATS),
+        help="Encode every window as it finishes, to a fragmented MP4 or an HLS playlist next to the output",
+    )
+    parser.add_argument(
+        "--segment_seconds", type=float, default=2.0, help="Duration of the fragments or HLS segments"
+    )
     parser.add_argument("--seed", type=int, default=1247)
     parser.add_argument("--enable_deepcache", action="store_true")
+    parser.add_argument("--deepcache_interval", type=int, default=3, help="Run the full UNet every N steps")
+    parser.add_argument(
+        "--deepcache_branch_id", type=int, default=0, help="Number of shallow UNet blocks recomputed on cached steps, minus one"
+    )
+    parser.add_argument(
+        "--fuse_qkv", action="store_true", help="Compute the self-attention query, key and value with one projection"
+    )
+    parser.add_argument(
+        "--attention_slicing",
+        action="store_true",
+        help="Compute attention in head slices and query chunks that fit into the memory budget",
+    )
+    parser.add_argument(
+        "--attention_memory_budget_mb",
+        type=int,
+        default=None,
+        help="Memory for the attention scores of one chunk, half of the free memory by default",
+    )
+    parser.add_argument(
+        "--vae_micro_batching",
+        action="store_true",
+        help="Run the VAE on as many frames at once as fit into the memory budget, tiled if one frame does not fit",
+    )
+    parser.add_argument(
+        "--vae_memory_budget_mb",
+        type=int,
+        default=None,
+        help="Memory for the VAE activations, half of the free memory by default",
+    )
+    parser.add_argument(
+        "--token_merging_ratios",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Fraction of the spatial self-attention tokens merged per resolution level, from the highest resolution",
+    )
+    parser.add_argument(
+        "--flat_layout",
+        action="store_true",
+        help="Keep the UNet activations in a flattened (b f) c h w layout and fuse GroupNorm with SiLU",
+    )
+    parser.add_argument(
+        "--channels_last", action="store_true", help="Use the channels_last memory format with --flat_layout"
+    )
+    parser.add_argument(
+        "--unet_batching",
+        action="store_true",
+        help="Run the UNet steps of jobs rendered concurrently in other threads as one batched forward",
+    )
+    parser.add_argument(
+        "--unet_batch_size", type=int, default=8, help="Most samples per batched UNet forward with --unet_batching"
+    )
+    parser.add_argument(
+        "--unet_batch_wait_ms",
+        type=float,
+        default=20.0,
+        help="Longest a UNet step waits for the steps of other jobs with --unet_batching",
+    )
+    parser.add_argument(
+        "--compile_unet", action="store_true", help="Compile the UNet with torch.compile and warm it up at startup"
+    )
+    parser.add_argument(
+        "--compile_cache_dir", type=str, default="checkpoints/compile_cache", help="Where the compiled kernels are kept"
+    )
+    parser.add_argument(
+        "--cpu_dtype",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16", "int8"],
+        help="Precision when CUDA is not available, int8 quantizes the UNet and whisper linear layers",
+    )
+    parser.add_argument(
+        "--partial_decode", action="store_true", help="VAE-decode only the latents around the mouth region"
+    )
+    parser.add_argument(
+        "--partial_decode_margin", type=int, default=8, help="Latents decoded around the mouth region on each side"
+    )
     parser.add_argument("--remove_background", action="store_true", help="Remove background after processing")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--whisper_truncate_context",
+        action="store_true",
+        help="Encode clips shorter than 30 s without padding them to the full whisper window",
+    )
+    parser.add_argument("--skip_silence", action="store_true", help="Keep the source frames of silent windows")
+    parser.add_argument(
+        "--silence_threshold_db", type=float, default=-40.0, help="Silence level relative to the loudest frame"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
 
     config = OmegaConf.load(args.unet_config_path)
 
-    main(config, args)
+    if args.extra_audio_paths:
+        # The extra outputs are named after their audio, next to --video_out_path
+        out_stem, out_ext = os.path.splitext(args.video_out_path)
+        video_out_paths = [args.video_out_path] + [
+            f"{out_stem}_{os.path.splitext(os.path.basename(audio_path))[0]}{out_ext}"
+            for audio_path in args.extra_audio_paths
+        ]
+        main_batch(config, args, [args.audio_path] + args.extra_audio_paths, video_out_paths)
+    else:
+        main(config, args)
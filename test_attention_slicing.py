@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Tests for the memory-bounded sliced attention of the UNet (set_attention_slice with a memory budget).
+Uses a small randomly initialized UNet on CPU, so no checkpoint is needed.
+"""
+
+import torch
+
+import latentsync.models.attention as attention_module
+import latentsync.models.unet as unet_module
+from latentsync.models.attention import Attention
+from latentsync.models.unet import UNet3DConditionModel
+
+NUM_FRAMES = 4
+CROSS_ATTENTION_DIM = 16
+
+
+def build_unet():
+    torch.manual_seed(0)
+    unet = UNet3DConditionModel(
+        sample_size=16,
+        in_channels=13,
+        out_channels=4,
+        block_out_channels=(32, 32, 64, 64),
+        layers_per_block=1,
+        norm_num_groups=8,
+        cross_attention_dim=CROSS_ATTENTION_DIM,
+        attention_head_dim=8,
+        add_audio_layer=True,
+    )
+    # conv_in and conv_out are zero initialized, which would make every output identical
+    with torch.no_grad():
+        for conv in (unet.conv_in, unet.conv_out):
+            conv.weight.normal_(std=0.1)
+    return unet.eval()
+
+
+def test_chunked_attention_layer_matches_full():
+    torch.manual_seed(0)
+    attention = Attention(query_dim=64, heads=4, dim_head=16).eval()
+    hidden_states = torch.randn(2, 300, 64)
+    with torch.no_grad():
+        reference = attention(hidden_states)
+        # 2 heads per slice, and a budget that fits the scores of a few dozen queries
+        attention.set_attention_slice(2, memory_budget=2 * 2 * 2 * 300 * 4 * 37)
+        assert attention.query_chunk_size(torch.empty(2, 4, 300, 16), torch.empty(2, 4, 300, 16), 2) == 37
+        chunked = attention(hidden_states)
+    torch.testing.assert_close(chunked, reference, rtol=1e-5, atol=1e-6)
+
+
+def test_unet_attention_slicing_matches_full():
+    unet = build_unet()
+    generator = torch.Generator().manual_seed(1)
+    sample = torch.randn(2, 13, NUM_FRAMES, 16, 16, generator=generator)
+    audio_embeds = torch.randn(2 * NUM_FRAMES, 10, CROSS_ATTENTION_DIM, generator=generator)
+
+    with torch.no_grad():
+        reference = unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+        unet.set_attention_slice("max", memory_budget=64 * 1024)
+        assert all(module.slice_size == 1 for module in unet.modules() if isinstance(module, Attention))
+        sliced = unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+        unet.set_attention_slice(None)
+        restored = unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+
+    torch.testing.assert_close(sliced, reference, rtol=1e-5, atol=1e-5)
+    assert torch.equal(restored, reference)
+
+
+def test_free_memory_is_measured_once_per_forward():
+    unet = build_unet()
+    generator = torch.Generator().manual_seed(1)
+    sample = torch.randn(2, 13, NUM_FRAMES, 16, 16, generator=generator)
+    audio_embeds = torch.randn(2 * NUM_FRAMES, 10, CROSS_ATTENTION_DIM, generator=generator)
+
+    calls = []
+
+    def get_free_memory(device):
+        calls.append(device)
+        return 2 * 64 * 1024
+
+    with torch.no_grad():
+        reference = unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+    original_get_free_memory = unet_module.get_free_memory
+    try:
+        unet_module.get_free_memory = get_free_memory
+        attention_module.get_free_memory = get_free_memory
+        unet.set_attention_slice("max")
+        with torch.no_grad():
+            sliced = unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+            assert len(calls) == 1
+            unet(sample, 400, encoder_hidden_states=audio_embeds)
+            assert len(calls) == 2
+
+            # A fixed budget is never measured
+            unet.set_attention_slice("max", memory_budget=64 * 1024)
+            unet(sample, 300, encoder_hidden_states=audio_embeds)
+            assert len(calls) == 2
+    finally:
+        unet_module.get_free_memory = attention_module.get_free_memory = original_get_free_memory
+    torch.testing.assert_close(sliced, reference, rtol=1e-5, atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_chunked_attention_layer_matches_full()
+    test_unet_attention_slicing_matches_full()
+    test_free_memory_is_measured_once_per_forward()
+    print("All attention slicing tests passed")
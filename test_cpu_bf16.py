@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Tests for the bf16 CPU path of the whisper encoder and AlignRestore.
+Runs on CPU with small randomly initialized modules and a synthetic frame, so no checkpoint is needed.
+"""
+
+import numpy as np
+import torch
+
+from latentsync.utils.affine_transform import AlignRestore
+from latentsync.whisper.audio2feature import cast_encoder_weights
+from latentsync.whisper.whisper.model import AudioEncoder
+
+
+def test_whisper_encoder_bf16():
+    torch.manual_seed(0)
+    encoder = AudioEncoder(n_mels=80, n_ctx=100, n_state=64, n_head=4, n_layer=2).eval()
+    mel = torch.randn(1, 80, 200)
+    with torch.no_grad():
+        _, reference = encoder(mel, include_embeddings=True)
+        cast_encoder_weights(encoder, torch.bfloat16)
+        _, embeddings = encoder(mel.to(torch.bfloat16), include_embeddings=True)
+
+    # numpy has no bfloat16, the embeddings come back in fp32
+    assert embeddings.dtype == np.float32
+    assert encoder.conv1.weight.dtype == torch.bfloat16
+    assert encoder.ln_post.weight.dtype == torch.float32
+    error = np.linalg.norm(embeddings - reference) / np.linalg.norm(reference)
+    assert error < 2e-2, error
+
+
+def test_restorer_bf16():
+    rng = np.random.default_rng(0)
+    # Smooth synthetic frame
+    frame = np.kron(rng.integers(0, 256, (18, 32, 3)), np.ones((20, 20, 1))).astype(np.uint8)
+    landmarks3 = np.array([[260.0, 140.0], [380.0, 140.0], [320.0, 200.0]])
+
+    restorers = {dtype: AlignRestore(resolution=256, dtype=dtype) for dtype in (torch.float32, torch.bfloat16)}
+    # The warps run in fp32, only the blending runs in bf16
+    assert restorers[torch.bfloat16].warp_dtype == torch.float32
+
+    face, affine_matrix = restorers[torch.float32].align_warp_face(frame.copy(), landmarks3=landmarks3, smooth=False)
+    face = torch.from_numpy(face).permute(2, 0, 1).float() / 127.5 - 1
+    outputs = {
+        dtype: restorer.restore_img(frame, face.to(dtype), affine_matrix) for dtype, restorer in restorers.items()
+    }
+    diff = np.abs(outputs[torch.float32].astype(np.int16) - outputs[torch.bfloat16].astype(np.int16))
+    assert diff.mean() < 0.5, diff.mean()
+    assert diff.max() <= 4, diff.max()
+
+
+if __name__ == "__main__":
+    test_whisper_encoder_bf16()
+    test_restorer_bf16()
+    print("All bf16 CPU tests passed")
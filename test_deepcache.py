@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Tests for the DeepCache-style feature reuse built into UNet3DConditionModel.
+Uses a small randomly initialized UNet on CPU, so no checkpoint is needed.
+"""
+
+import torch
+
+from latentsync.models.unet import UNet3DConditionModel
+
+NUM_FRAMES = 4
+AUDIO_TOKENS = 10
+CROSS_ATTENTION_DIM = 16
+
+
+def build_unet():
+    torch.manual_seed(0)
+    unet = UNet3DConditionModel(
+        sample_size=16,
+        in_channels=13,
+        out_channels=4,
+        block_out_channels=(32, 32, 64, 64),
+        layers_per_block=1,
+        norm_num_groups=8,
+        cross_attention_dim=CROSS_ATTENTION_DIM,
+        attention_head_dim=8,
+        add_audio_layer=True,
+    )
+    # conv_in and conv_out are zero initialized, which would make every output identical
+    with torch.no_grad():
+        for conv in (unet.conv_in, unet.conv_out):
+            conv.weight.normal_(std=0.1)
+    return unet.eval()
+
+
+def make_inputs(batch_size, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    sample = torch.randn(batch_size, 13, NUM_FRAMES, 16, 16, generator=generator)
+    audio_embeds = torch.randn(batch_size * NUM_FRAMES, AUDIO_TOKENS, CROSS_ATTENTION_DIM, generator=generator)
+    return sample, audio_embeds
+
+
+def run_steps(unet, sample, audio_embeds, timesteps):
+    outputs = []
+    with torch.no_grad():
+        for t in timesteps:
+            outputs.append(unet(sample, t, encoder_hidden_states=audio_embeds).sample)
+    return outputs
+
+
+def test_interval_one_matches_disabled():
+    unet = build_unet()
+    sample, audio_embeds = make_inputs(1)
+    timesteps = [900, 700, 500, 300]
+
+    reference = run_steps(unet, sample, audio_embeds, timesteps)
+    unet.enable_deepcache(cache_interval=1, cache_branch_id=0)
+    cached = run_steps(unet, sample, audio_embeds, timesteps)
+
+    for ref, out in zip(reference, cached):
+        assert torch.equal(ref, out)
+
+
+def test_cached_steps_reuse_deep_features():
+    unet = build_unet()
+    sample, audio_embeds = make_inputs(2)  # classifier-free guidance batch
+    timesteps = [900, 700, 500, 300]
+
+    reference = run_steps(unet, sample, audio_embeds, timesteps)
+    unet.enable_deepcache(cache_interval=2, cache_branch_id=1)
+    cached = run_steps(unet, sample, audio_embeds, timesteps)
+
+    for step, (ref, out) in enumerate(zip(reference, cached)):
+        assert out.shape == ref.shape
+        if step % 2 == 0:
+            # full steps are computed exactly as without caching
+            torch.testing.assert_close(out, ref, rtol=1e-5, atol=1e-6)
+        else:
+            # cached steps approximate the full output with the previous step's deep features
+            assert not torch.equal(out, ref)
+            relative_error = (out - ref).norm() / ref.norm()
+            assert torch.isfinite(out).all() and relative_error < 1.0, relative_error
+
+
+def test_cache_resets_between_trajectories():
+    unet = build_unet()
+    unet.enable_deepcache(cache_interval=3, cache_branch_id=0)
+    sample, audio_embeds = make_inputs(1)
+
+    run_steps(unet, sample, audio_embeds, [900, 600])
+    assert unet._deepcache_step == 2
+
+    # a larger timestep starts a new trajectory, which must run the full UNet again
+    with torch.no_grad():
+        restarted = unet(sample, 900, encoder_hidden_states=audio_embeds).sample
+    assert unet._deepcache_step == 1
+
+    unet.disable_deepcache()
+    with torch.no_grad():
+        reference = unet(sample, 900, encoder_hidden_states=audio_embeds).sample
+    assert torch.equal(restarted, reference)
+
+
+def test_batch_change_forces_full_step():
+    unet = build_unet()
+    unet.enable_deepcache(cache_interval=3, cache_branch_id=0)
+    single_sample, single_embeds = make_inputs(1)
+    double_sample, double_embeds = make_inputs(2)
+
+    with torch.no_grad():
+        unet(double_sample, 900, encoder_hidden_states=double_embeds)
+        cached = unet(single_sample, 800, encoder_hidden_states=single_embeds).sample
+        unet.disable_deepcache()
+        reference = unet(single_sample, 800, encoder_hidden_states=single_embeds).sample
+    assert torch.equal(cached, reference)
+
+
+if __name__ == "__main__":
+    test_interval_one_matches_disabled()
+    test_cached_steps_reuse_deep_features()
+    test_cache_resets_between_trajectories()
+    test_batch_change_forces_full_step()
+    print("All DeepCache tests passed")
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Tests for the download cache of the RunPod worker (download_cache.py).
+Uses file:// URLs and a fake downloader, so no network is needed.
+"""
+
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from download_cache import DownloadCache
+
+
+class FakeDownloader:
+    def __init__(self, size=100):
+        self.size = size
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, url, destination):
+        with self.lock:
+            self.calls.append(url)
+        # Slow enough for parallel requests of the same URL to overlap
+        time.sleep(0.05)
+        with open(destination, "wb") as f:
+            f.write(url.encode("utf-8").ljust(self.size, b"\0"))
+
+
+def test_file_urls():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "avatar.mp4")
+        with open(source, "wb") as f:
+            f.write(b"video")
+        cache = DownloadCache(os.path.join(tmpdir, "cache"), max_bytes=1024)
+
+        url = Path(source).as_uri()
+        path = cache.get(url)
+        assert path != source and os.path.basename(path) == "avatar.mp4"
+        assert open(path, "rb").read() == b"video"
+        assert cache.get(url) == path
+        assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_repeated_urls_skip_the_downloader():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        downloader = FakeDownloader()
+        cache = DownloadCache(tmpdir, max_bytes=1024, downloader=downloader)
+        video_url = "https://example.com/avatar.mp4?token=1"
+        video_path, audio_path = cache.get_all([video_url, "https://example.com/speech.wav"])
+        assert os.path.basename(video_path) == "avatar.mp4"
+        assert os.path.basename(audio_path) == "speech.wav"
+
+        # The avatar of the next job is served from disk
+        video_path_again, _ = cache.get_all([video_url, "https://example.com/other.wav"])
+        assert video_path_again == video_path
+        assert downloader.calls.count(video_url) == 1
+        assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_parallel_requests_download_once():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        downloader = FakeDownloader()
+        cache = DownloadCache(tmpdir, max_bytes=1024, downloader=downloader)
+        url = "https://example.com/talk.mp4"
+        first, second = cache.get_all([url, url])
+        assert first == second
+        assert downloader.calls == [url]
+
+
+def test_lru_eviction():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = DownloadCache(tmpdir, max_bytes=250, downloader=FakeDownloader(size=100))
+        urls = [f"https://example.com/{name}.mp4" for name in "abc"]
+        paths = [cache.get(url) for url in urls[:2]]
+        # a is used after b, so b is the least recently used entry
+        os.utime(paths[1], (1, 1))
+        cache.get(urls[0])
+        cache.get(urls[2])
+
+        assert os.path.exists(paths[0])
+        assert not os.path.exists(paths[1])
+        assert cache.size() <= 250
+
+        # An entry that is needed is kept, even when it alone exceeds the cap
+        cache.max_bytes = 50
+        path = cache.get("https://example.com/d.mp4")
+        assert os.path.exists(path)
+        assert cache.size() == 100
+
+
+def test_entries_in_use_are_not_evicted():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = DownloadCache(tmpdir, max_bytes=250, downloader=FakeDownloader(size=100))
+        job_a = ["https://example.com/a.mp4", "https://example.com/a.wav"]
+        with cache.use(job_a) as paths_a:
+            # Nested uses of the same entry keep it pinned until the last one exits
+            with cache.use(job_a[:1]):
+                pass
+            for path in paths_a:
+                os.utime(path, (1, 1))
+            # A concurrent job downloads newer files, job A's inputs are the least recently used
+            paths_b = cache.get_all(["https://example.com/b.mp4", "https://example.com/b.wav"])
+            assert all(os.path.exists(path) for path in paths_a)
+            assert all(os.path.exists(path) for path in paths_b)
+
+        # Once job A is done, its entries are evicted first
+        cache.evict()
+        assert not any(os.path.exists(path) for path in paths_a)
+        assert cache.size() <= 250
+
+
+def test_failed_download_leaves_no_entry():
+    def failing_downloader(url, destination):
+        with open(destination, "wb") as f:
+            f.write(b"partial")
+        raise RuntimeError("connection reset")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = DownloadCache(tmpdir, max_bytes=1024, downloader=failing_downloader)
+        try:
+            cache.get("https://example.com/avatar.mp4")
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("Expected the download error to be raised")
+        assert os.listdir(tmpdir) == []
+
+
+if __name__ == "__main__":
+    test_file_urls()
+    test_repeated_urls_skip_the_downloader()
+    test_parallel_requests_download_once()
+    test_lru_eviction()
+    test_entries_in_use_are_not_evicted()
+    test_failed_download_leaves_no_entry()
+    print("All download cache tests passed")
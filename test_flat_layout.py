@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Tests for the flattened (b f) c h w layout of the UNet (enable_flat_layout) and the fused GroupNorm + SiLU.
+Uses a small randomly initialized UNet with motion modules on CPU, so no checkpoint is needed.
+"""
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+
+from latentsync.models.resnet import group_norm_silu
+from latentsync.models.unet import UNet3DConditionModel
+
+NUM_FRAMES = 4
+CROSS_ATTENTION_DIM = 16
+
+
+def build_unet(use_inflated_groupnorm=False):
+    torch.manual_seed(0)
+    unet = UNet3DConditionModel(
+        sample_size=16,
+        in_channels=13,
+        out_channels=4,
+        block_out_channels=(32, 32, 64, 64),
+        layers_per_block=1,
+        norm_num_groups=8,
+        cross_attention_dim=CROSS_ATTENTION_DIM,
+        attention_head_dim=8,
+        add_audio_layer=True,
+        use_inflated_groupnorm=use_inflated_groupnorm,
+        use_motion_module=True,
+        motion_module_type="Vanilla",
+        motion_module_kwargs={
+            "num_attention_heads": 4,
+            "num_transformer_block": 1,
+            "attention_block_types": ["Temporal_Self", "Temporal_Self"],
+            "temporal_position_encoding": True,
+            "temporal_position_encoding_max_len": 24,
+            "zero_initialize": False,
+        },
+    )
+    # conv_in and conv_out are zero initialized, which would make every output identical
+    with torch.no_grad():
+        for conv in (unet.conv_in, unet.conv_out):
+            conv.weight.normal_(std=0.1)
+    return unet.eval()
+
+
+def make_inputs(batch_size=2, size=16, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    sample = torch.randn(batch_size, 13, NUM_FRAMES, size, size, generator=generator)
+    audio_embeds = torch.randn(batch_size * NUM_FRAMES, 10, CROSS_ATTENTION_DIM, generator=generator)
+    return sample, audio_embeds
+
+
+def test_group_norm_silu_matches_5d_group_norm():
+    torch.manual_seed(0)
+    norm = torch.nn.GroupNorm(4, 16, eps=1e-6)
+    with torch.no_grad():
+        norm.weight.normal_()
+        norm.bias.normal_()
+    x = torch.randn(2, 16, NUM_FRAMES, 8, 8)
+    with torch.no_grad():
+        reference = rearrange(F.silu(norm(x)), "b c f h w -> (b f) c h w")
+        flat = rearrange(x, "b c f h w -> (b f) c h w")
+        fused = group_norm_silu(flat, norm, video_length=NUM_FRAMES)
+        fused_channels_last = group_norm_silu(
+            flat.contiguous(memory_format=torch.channels_last), norm, video_length=NUM_FRAMES
+        )
+    torch.testing.assert_close(fused, reference, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(fused_channels_last, reference, rtol=1e-5, atol=1e-5)
+    assert fused_channels_last.is_contiguous(memory_format=torch.channels_last)
+
+
+def test_flat_layout_matches_default():
+    for use_inflated_groupnorm in (False, True):
+        unet = build_unet(use_inflated_groupnorm)
+        # 12x12 latents also exercise the forced upsample sizes
+        for size in (16, 12):
+            sample, audio_embeds = make_inputs(size=size)
+            with torch.no_grad():
+                reference = unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+                for channels_last in (False, True):
+                    unet.enable_flat_layout(channels_last=channels_last)
+                    flat = unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+                    unet.disable_flat_layout()
+                    assert flat.shape == reference.shape
+                    assert flat.is_contiguous()
+                    torch.testing.assert_close(flat, reference, rtol=1e-4, atol=1e-4)
+
+
+def test_flat_layout_with_deepcache():
+    unet = build_unet()
+    sample, audio_embeds = make_inputs()
+    timesteps = [900, 700, 500, 300]
+
+    unet.enable_deepcache(cache_interval=2, cache_branch_id=0)
+    with torch.no_grad():
+        reference = [unet(sample, t, encoder_hidden_states=audio_embeds).sample for t in timesteps]
+        unet.enable_flat_layout()
+        flat = [unet(sample, t, encoder_hidden_states=audio_embeds).sample for t in timesteps]
+
+    for ref, out in zip(reference, flat):
+        torch.testing.assert_close(out, ref, rtol=1e-4, atol=1e-4)
+
+
+if __name__ == "__main__":
+    test_group_norm_silu_matches_5d_group_norm()
+    test_flat_layout_matches_default()
+    test_flat_layout_with_deepcache()
+    print("All flat layout tests passed")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Tests for the fused query/key/value projections of the UNet self-attention layers.
+Uses a small randomly initialized UNet with motion modules on CPU, so no checkpoint is needed.
+"""
+
+import torch
+
+from latentsync.models.attention import Attention
+from latentsync.models.unet import UNet3DConditionModel
+
+NUM_FRAMES = 4
+CROSS_ATTENTION_DIM = 16
+
+
+def build_unet(seed=0):
+    torch.manual_seed(seed)
+    unet = UNet3DConditionModel(
+        sample_size=16,
+        in_channels=13,
+        out_channels=4,
+        block_out_channels=(32, 32, 64, 64),
+        layers_per_block=1,
+        norm_num_groups=8,
+        cross_attention_dim=CROSS_ATTENTION_DIM,
+        attention_head_dim=8,
+        add_audio_layer=True,
+        use_motion_module=True,
+        motion_module_type="Vanilla",
+        motion_module_kwargs={
+            "num_attention_heads": 4,
+            "num_transformer_block": 1,
+            "attention_block_types": ["Temporal_Self", "Temporal_Self"],
+            "temporal_position_encoding": True,
+            "temporal_position_encoding_max_len": 24,
+            "zero_initialize": False,
+        },
+    )
+    # conv_in and conv_out are zero initialized, which would make every output identical
+    with torch.no_grad():
+        for conv in (unet.conv_in, unet.conv_out):
+            conv.weight.normal_(std=0.1)
+    return unet.eval()
+
+
+def make_inputs(batch_size=2, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    sample = torch.randn(batch_size, 13, NUM_FRAMES, 16, 16, generator=generator)
+    audio_embeds = torch.randn(batch_size * NUM_FRAMES, 10, CROSS_ATTENTION_DIM, generator=generator)
+    return sample, audio_embeds
+
+
+def test_fused_matches_separate():
+    unet = build_unet()
+    sample, audio_embeds = make_inputs()
+    with torch.no_grad():
+        reference = unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+
+    unet.fuse_qkv_projections()
+    attentions = [module for module in unet.modules() if isinstance(module, Attention)]
+    for module in attentions:
+        # only self-attention layers are fused, the audio cross-attention keeps its projections
+        assert module.fused_projections == module.is_self_attention
+    assert any(module.fused_projections for module in attentions)
+
+    with torch.no_grad():
+        fused = unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+    torch.testing.assert_close(fused, reference, rtol=1e-5, atol=1e-5)
+
+    unet.unfuse_qkv_projections()
+    assert not any(module.fused_projections for module in attentions)
+    with torch.no_grad():
+        unfused = unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+    assert torch.equal(unfused, reference)
+
+
+def test_load_separate_checkpoint_into_fused_model():
+    source = build_unet(seed=0)
+    state_dict = {key: value.clone() for key, value in source.state_dict().items()}
+    assert any(key.endswith("attn1.to_q.weight") for key in state_dict)
+
+    target = build_unet(seed=1)
+    target.fuse_qkv_projections()
+    missing, unexpected = target.load_state_dict(state_dict, strict=True)
+    assert not missing and not unexpected
+
+    sample, audio_embeds = make_inputs()
+    with torch.no_grad():
+        reference = source(sample, 500, encoder_hidden_states=audio_embeds).sample
+        fused = target(sample, 500, encoder_hidden_states=audio_embeds).sample
+    torch.testing.assert_close(fused, reference, rtol=1e-5, atol=1e-5)
+
+
+def test_load_fused_checkpoint_into_separate_model():
+    source = build_unet(seed=0)
+    source.fuse_qkv_projections()
+    state_dict = {key: value.clone() for key, value in source.state_dict().items()}
+    assert any(key.endswith("attn1.to_qkv.weight") for key in state_dict)
+
+    target = build_unet(seed=1)
+    target.load_state_dict(state_dict, strict=True)
+    source.unfuse_qkv_projections()
+    for key, value in source.state_dict().items():
+        assert torch.equal(target.state_dict()[key], value), key
+
+
+if __name__ == "__main__":
+    test_fused_matches_separate()
+    test_load_separate_checkpoint_into_fused_model()
+    test_load_fused_checkpoint_into_separate_model()
+    print("All fused QKV tests passed")
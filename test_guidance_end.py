@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Tests for ending classifier-free guidance early (LipsyncPipeline.get_num_guided_steps and denoise_window).
+A toy UNet that records its inputs stands in for the real one, so no checkpoint is needed.
+"""
+
+import torch
+import tqdm
+
+from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
+from latentsync.utils.schedulers import load_scheduler
+
+NUM_STEPS = 5
+
+
+class ToyPipeline:
+    denoise_window = LipsyncPipeline.denoise_window
+
+    def __init__(self):
+        self.scheduler = load_scheduler("ddim")
+        self.unet_batcher = None
+        self.batch_sizes = []
+        self.audio_embeds = []
+
+    def progress_bar(self, total):
+        return tqdm.tqdm(total=total, disable=True)
+
+    def run_unet(self, sample, timestep, encoder_hidden_states):
+        self.batch_sizes.append(sample.shape[0])
+        self.audio_embeds.append(encoder_hidden_states)
+        # Depends on the latents, the conditions and the audio, like the real UNet
+        audio = encoder_hidden_states.mean(dim=(1, 2)).reshape(sample.shape[0], 1, -1, 1, 1)
+        return 0.1 * sample[:, :4] + 0.01 * sample[:, 4:8] + audio
+
+
+def make_window(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    latents = torch.randn(1, 4, 2, 8, 8, generator=generator)
+    mask_latents = torch.randn(1, 1, 2, 8, 8, generator=generator).repeat(2, 1, 1, 1, 1)
+    masked_image_latents = torch.randn(1, 4, 2, 8, 8, generator=generator).repeat(2, 1, 1, 1, 1)
+    ref_latents = torch.randn(1, 4, 2, 8, 8, generator=generator).repeat(2, 1, 1, 1, 1)
+    audio_embeds = torch.randn(2, 10, 6, generator=generator)
+    # The unconditional inputs first, then the audio-conditioned ones, as prepared by __call__
+    audio_embeds = torch.cat([torch.zeros_like(audio_embeds), audio_embeds])
+    return latents, mask_latents, masked_image_latents, ref_latents, audio_embeds
+
+
+def denoise(pipeline, num_guided_steps, guidance_scale=1.5, seed=0):
+    latents, mask_latents, masked_image_latents, ref_latents, audio_embeds = make_window(seed)
+    pipeline.scheduler.set_timesteps(NUM_STEPS)
+    return pipeline.denoise_window(
+        latents,
+        mask_latents,
+        masked_image_latents,
+        ref_latents,
+        audio_embeds,
+        pipeline.scheduler.timesteps,
+        guidance_scale=guidance_scale,
+        num_guided_steps=num_guided_steps,
+        do_classifier_free_guidance=True,
+        extra_step_kwargs={},
+    )
+
+
+def test_num_guided_steps():
+    assert LipsyncPipeline.get_num_guided_steps(None, 20) == 20
+    assert LipsyncPipeline.get_num_guided_steps(8, 20) == 8
+    assert LipsyncPipeline.get_num_guided_steps(0, 20) == 0
+    # More steps than are run
+    assert LipsyncPipeline.get_num_guided_steps(30, 20) == 20
+    for invalid in (-1, -0.1, 1.5):
+        try:
+            LipsyncPipeline.get_num_guided_steps(invalid, 20)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"Expected a ValueError for guidance_end_step={invalid}")
+
+
+def test_fractions_are_rounded_to_steps():
+    assert LipsyncPipeline.get_num_guided_steps(1.0, 20) == 20
+    assert LipsyncPipeline.get_num_guided_steps(0.0, 20) == 0
+    assert LipsyncPipeline.get_num_guided_steps(0.5, 20) == 10
+    assert LipsyncPipeline.get_num_guided_steps(0.33, 20) == 7
+    # Halves round to the even step count
+    assert LipsyncPipeline.get_num_guided_steps(0.25, 10) == 2
+    assert LipsyncPipeline.get_num_guided_steps(0.75, 10) == 8
+
+
+def test_guided_steps_run_the_full_batch():
+    for num_guided_steps in range(NUM_STEPS + 1):
+        pipeline = ToyPipeline()
+        denoise(pipeline, num_guided_steps)
+        assert pipeline.batch_sizes == [2] * num_guided_steps + [1] * (NUM_STEPS - num_guided_steps)
+
+
+def test_unguided_steps_keep_the_conditional_half():
+    pipeline = ToyPipeline()
+    _, _, _, _, audio_embeds = make_window()
+    denoise(pipeline, 2)
+    for step, step_audio_embeds in enumerate(pipeline.audio_embeds):
+        expected = audio_embeds if step < 2 else audio_embeds.chunk(2)[1]
+        assert torch.equal(step_audio_embeds, expected), step
+
+
+def test_guidance_scale_one_matches_unguided_steps():
+    # uncond + 1 * (audio - uncond) is the conditional prediction, the batch split changes nothing else
+    reference = denoise(ToyPipeline(), NUM_STEPS, guidance_scale=1.0)
+    for num_guided_steps in (0, 3):
+        latents = denoise(ToyPipeline(), num_guided_steps, guidance_scale=1.0)
+        torch.testing.assert_close(latents, reference)
+
+
+if __name__ == "__main__":
+    test_num_guided_steps()
+    test_fractions_are_rounded_to_steps()
+    test_guided_steps_run_the_full_batch()
+    test_unguided_steps_keep_the_conditional_half()
+    test_guidance_scale_one_matches_unguided_steps()
+    print("All guidance end tests passed")
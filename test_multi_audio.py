@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Tests for the random draws of batch renders (LipsyncPipeline.render_batch).
+A posterior encoded once and sampled with the replayed random state of every audio must give the latents that
+encoding and sampling in each single-audio render gives. Random posteriors stand in for the VAE.
+"""
+
+from types import SimpleNamespace
+
+import torch
+from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
+
+from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
+from latentsync.utils.render_checkpoint import get_rng_state, set_rng_state
+
+
+def fake_pipeline(micro_batch_size):
+    return SimpleNamespace(get_vae_micro_batch_size=lambda height, width, dtype: micro_batch_size)
+
+
+def sample_per_micro_batch(posterior, micro_batch_size):
+    # What vae_encode did before the posterior was exposed: encode and sample each micro-batch in turn
+    if micro_batch_size is None:
+        return DiagonalGaussianDistribution(posterior).sample()
+    chunks = posterior.split(max(micro_batch_size, 1))
+    return torch.cat([DiagonalGaussianDistribution(chunk).sample() for chunk in chunks])
+
+
+def test_sampling_matches_encoding_per_micro_batch():
+    posterior = torch.randn(16, 8, 4, 4)
+    for micro_batch_size in (None, 0, 1, 5, 16, 32):
+        pipeline = fake_pipeline(micro_batch_size)
+        torch.manual_seed(0)
+        expected = sample_per_micro_batch(posterior, micro_batch_size)
+        torch.manual_seed(0)
+        latents = LipsyncPipeline.sample_vae_posterior(pipeline, posterior, 32, 32)
+        torch.testing.assert_close(latents, expected, rtol=0, atol=0)
+
+
+def test_replayed_states_match_single_audio_renders():
+    # Window posteriors of the video, the last window of the second audio is shorter
+    window_posteriors = [torch.randn(16, 8, 4, 4) for _ in range(3)]
+    num_frames = [48, 40]
+    pipeline = fake_pipeline(5)
+
+    def single_render(num_output_frames):
+        torch.manual_seed(1247)
+        initial = torch.randn(1, 4, 1, 4, 4)
+        windows = []
+        for i, posterior in enumerate(window_posteriors):
+            end = min(16, num_output_frames - 16 * i)
+            windows.append(sample_per_micro_batch(posterior[:end], 5))
+            windows.append(sample_per_micro_batch(posterior[:end], 5))
+        return initial, windows
+
+    torch.manual_seed(1247)
+    initial = torch.randn(1, 4, 1, 4, 4)
+    rng_states = [get_rng_state()] * len(num_frames)
+    batch_windows = [[] for _ in num_frames]
+    for i, posterior in enumerate(window_posteriors):
+        for k in range(len(num_frames)):
+            end = min(16, num_frames[k] - 16 * i)
+            set_rng_state(rng_states[k])
+            batch_windows[k].append(LipsyncPipeline.sample_vae_posterior(pipeline, posterior[:end], 32, 32))
+            batch_windows[k].append(LipsyncPipeline.sample_vae_posterior(pipeline, posterior[:end], 32, 32))
+            rng_states[k] = get_rng_state()
+
+    for k, num_output_frames in enumerate(num_frames):
+        expected_initial, expected_windows = single_render(num_output_frames)
+        torch.testing.assert_close(initial, expected_initial, rtol=0, atol=0)
+        for latents, expected in zip(batch_windows[k], expected_windows):
+            torch.testing.assert_close(latents, expected, rtol=0, atol=0)
+
+
+if __name__ == "__main__":
+    test_sampling_matches_encoding_per_micro_batch()
+    test_replayed_states_match_single_audio_renders()
+    print("All multi-audio tests passed")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Tests for the progressive output of renders (latentsync.utils.progressive_writer).
+Encodes synthetic frames and a tone with ffmpeg, no checkpoint is needed.
+"""
+
+import json
+import os
+import subprocess
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+from latentsync.utils.progressive_writer import (
+    ProgressiveVideoWriter,
+    hls_playlist_path,
+    is_hls_playlist_finished,
+    list_hls_segments,
+)
+
+FPS = 25
+SAMPLE_RATE = 16000
+NUM_SECONDS = 6
+
+
+def write_tone(path):
+    t = np.arange(NUM_SECONDS * SAMPLE_RATE) / SAMPLE_RATE
+    samples = (0.3 * np.sin(2 * np.pi * 440 * t) * 32767).astype(np.int16)
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(samples.tobytes())
+
+
+def make_window(index, num_frames=16, height=90, width=160):
+    # Odd sizes are padded for yuv420p
+    frames = np.zeros((num_frames, height, width, 3), dtype=np.uint8)
+    frames[..., index % 3] = 255
+    return frames
+
+
+def probe_streams(path):
+    output = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_streams", "-of", "json", path], capture_output=True, check=True
+    ).stdout
+    return sorted(stream["codec_type"] for stream in json.loads(output)["streams"])
+
+
+def test_hls_segments_are_playable_before_the_render_ends():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        audio_path = os.path.join(tmpdir, "audio.wav")
+        write_tone(audio_path)
+        video_out_path = os.path.join(tmpdir, "out.mp4")
+        writer = ProgressiveVideoWriter(
+            video_out_path, audio_path, width=160, height=90, fps=FPS, output_format="hls", segment_seconds=1.0
+        )
+        num_windows = NUM_SECONDS * FPS // 16
+        for i in range(num_windows - 1):
+            writer.write(make_window(i))
+
+        # The last window is still rendering
+        playlist_path = hls_playlist_path(video_out_path)
+        deadline = time.time() + 30
+        while not list_hls_segments(playlist_path) and time.time() < deadline:
+            time.sleep(0.1)
+        segments = list_hls_segments(playlist_path)
+        assert segments, "No segment was written before the last window"
+        assert not is_hls_playlist_finished(playlist_path)
+        assert probe_streams(segments[0]) == ["audio", "video"]
+
+        writer.write(make_window(num_windows - 1))
+        writer.close()
+        assert writer.num_frames == num_windows * 16
+        assert is_hls_playlist_finished(playlist_path)
+        assert probe_streams(video_out_path) == ["audio", "video"]
+
+
+def test_fragmented_mp4():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        audio_path = os.path.join(tmpdir, "audio.wav")
+        write_tone(audio_path)
+        video_out_path = os.path.join(tmpdir, "out.mp4")
+        writer = ProgressiveVideoWriter(video_out_path, audio_path, width=160, height=90, fps=FPS, segment_seconds=1.0)
+        for i in range(NUM_SECONDS * FPS // 16):
+            writer.write(make_window(i))
+        writer.close()
+
+        with open(video_out_path, "rb") as f:
+            assert b"moof" in f.read()
+        assert probe_streams(video_out_path) == ["audio", "video"]
+
+
+def test_frames_of_another_size_are_rejected():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        audio_path = os.path.join(tmpdir, "audio.wav")
+        write_tone(audio_path)
+        writer = ProgressiveVideoWriter(os.path.join(tmpdir, "out.mp4"), audio_path, width=160, height=90)
+        try:
+            writer.write(make_window(0, height=64, width=64))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected a ValueError for frames of another size")
+        writer.write(make_window(0))
+        writer.close()
+
+
+def test_abort_removes_the_partial_output():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        audio_path = os.path.join(tmpdir, "audio.wav")
+        write_tone(audio_path)
+        for output_format in ("fmp4", "hls"):
+            video_out_path = os.path.join(tmpdir, f"{output_format}.mp4")
+            writer = ProgressiveVideoWriter(
+                video_out_path, audio_path, width=160, height=90, output_format=output_format, segment_seconds=1.0
+            )
+            for i in range(4):
+                writer.write(make_window(i))
+            # The render failed
+            writer.abort()
+            assert writer.process.returncode is not None
+            assert not os.path.exists(video_out_path)
+            assert not os.path.exists(os.path.dirname(hls_playlist_path(video_out_path)))
+
+
+if __name__ == "__main__":
+    test_hls_segments_are_playable_before_the_render_ends()
+    test_fragmented_mp4()
+    test_frames_of_another_size_are_rejected()
+    test_abort_removes_the_partial_output()
+    print("All progressive output tests passed")
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Tests for the dynamic int8 quantization of the UNet and the whisper audio encoder (--cpu_precision int8):
+the linear layers of the attention, feed-forward and motion modules must be replaced by dynamic-quantized
+ones and the outputs must stay close to fp32. Uses small randomly initialized models on CPU, so no
+checkpoint is needed.
+"""
+
+import copy
+
+import torch
+from diffusers.models.attention import FeedForward
+from torch import nn
+from torch.ao.nn.quantized import dynamic as nnqd
+
+from latentsync.models.attention import Attention
+from latentsync.models.motion_module import VanillaTemporalModule
+from latentsync.models.unet import UNet3DConditionModel
+from latentsync.utils.quantization import quantize_unet_int8, quantize_whisper_encoder_int8
+from latentsync.whisper.whisper.model import Linear as WhisperLinear
+from latentsync.whisper.whisper.model import ModelDimensions, Whisper
+
+NUM_FRAMES = 4
+CROSS_ATTENTION_DIM = 16
+
+
+def build_unet():
+    torch.manual_seed(0)
+    unet = UNet3DConditionModel(
+        sample_size=16,
+        in_channels=13,
+        out_channels=4,
+        block_out_channels=(32, 32, 64, 64),
+        layers_per_block=1,
+        norm_num_groups=8,
+        cross_attention_dim=CROSS_ATTENTION_DIM,
+        attention_head_dim=8,
+        add_audio_layer=True,
+        use_motion_module=True,
+        motion_module_type="Vanilla",
+        motion_module_kwargs={
+            "num_attention_heads": 4,
+            "num_transformer_block": 1,
+            "attention_block_types": ["Temporal_Self", "Temporal_Self"],
+            "temporal_position_encoding": True,
+            "temporal_position_encoding_max_len": 24,
+            "zero_initialize": False,
+        },
+    )
+    # conv_in and conv_out are zero initialized, which would make every output identical
+    with torch.no_grad():
+        for conv in (unet.conv_in, unet.conv_out):
+            conv.weight.normal_(std=0.1)
+    return unet.eval()
+
+
+def build_whisper():
+    torch.manual_seed(0)
+    dims = ModelDimensions(
+        n_mels=80,
+        n_audio_ctx=1500,
+        n_audio_state=64,
+        n_audio_head=2,
+        n_audio_layer=2,
+        n_vocab=51864,
+        n_text_ctx=8,
+        n_text_state=64,
+        n_text_head=2,
+        n_text_layer=1,
+    )
+    return Whisper(dims).eval()
+
+
+def relative_error(result, reference):
+    return (torch.linalg.norm(result - reference) / torch.linalg.norm(reference)).item()
+
+
+def test_unet_int8_matches_fp32():
+    unet = build_unet()
+    generator = torch.Generator().manual_seed(1)
+    sample = torch.randn(2, 13, NUM_FRAMES, 16, 16, generator=generator)
+    audio_embeds = torch.randn(2 * NUM_FRAMES, 10, CROSS_ATTENTION_DIM, generator=generator)
+
+    with torch.no_grad():
+        reference = unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+        quantized_unet = quantize_unet_int8(copy.deepcopy(unet))
+        result = quantized_unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+
+    assert result.shape == reference.shape
+    assert relative_error(result, reference) < 0.05
+
+    quantized_parents = (Attention, FeedForward, VanillaTemporalModule)
+    num_quantized = 0
+    for module in quantized_unet.modules():
+        if isinstance(module, quantized_parents):
+            linears = [child for child in module.modules() if isinstance(child, (nn.Linear, nnqd.Linear))]
+            assert len(linears) > 0
+            assert all(isinstance(linear, nnqd.Linear) for linear in linears)
+            num_quantized += len(linears)
+    assert num_quantized > 0
+
+    temporal_modules = [module for module in quantized_unet.modules() if isinstance(module, VanillaTemporalModule)]
+    assert len(temporal_modules) > 0
+    for module in temporal_modules:
+        assert isinstance(module.temporal_transformer.proj_in, nnqd.Linear)
+        assert isinstance(module.temporal_transformer.proj_out, nnqd.Linear)
+
+    # The time embedding and the resnet convolutions stay in fp32
+    assert type(quantized_unet.time_embedding.linear_1) is nn.Linear
+    assert type(quantized_unet.conv_in) is type(unet.conv_in)
+
+
+def test_whisper_encoder_int8_matches_fp32():
+    model = build_whisper()
+    mel = torch.randn(1, 80, 3000, generator=torch.Generator().manual_seed(1))
+
+    with torch.no_grad():
+        _, reference = model.encoder(mel, include_embeddings=True)
+        quantized_model = quantize_whisper_encoder_int8(copy.deepcopy(model))
+        _, result = quantized_model.encoder(mel, include_embeddings=True)
+
+    assert result.shape == reference.shape
+    assert relative_error(torch.from_numpy(result), torch.from_numpy(reference)) < 0.05
+
+    encoder_linears = [module for module in quantized_model.encoder.modules() if isinstance(module, nnqd.Linear)]
+    assert len(encoder_linears) > 0
+    assert not any(isinstance(module, (WhisperLinear, nn.Linear)) for module in quantized_model.encoder.modules())
+    # Only the encoder is quantized
+    assert any(isinstance(module, WhisperLinear) for module in quantized_model.decoder.modules())
+
+
+if __name__ == "__main__":
+    test_unet_int8_matches_fp32()
+    test_whisper_encoder_int8_matches_fp32()
+    print("All int8 quantization tests passed")
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Tests for the per-window render checkpoints (latentsync.utils.render_checkpoint).
+A toy render that draws from the RNG in every window stands in for the pipeline, and LipsyncPipeline.__call__ runs
+on fake components up to its first window, so no checkpoint is needed.
+"""
+
+import os
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+import latentsync.pipelines.lipsync_pipeline as lipsync_pipeline
+from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
+from latentsync.utils.render_checkpoint import RenderCheckpoint, get_rng_state, set_rng_state
+from latentsync.utils.schedulers import load_scheduler
+
+PARAMS = {"num_frames": 40, "window_size": 16, "guidance_scale": 1.5}
+
+
+class Preempted(Exception):
+    pass
+
+
+def toy_render(job_dir, generator, stop_after=None):
+    # Mirrors LipsyncPipeline.__call__: initial latents drawn once, then every window samples again
+    checkpoint = RenderCheckpoint(job_dir, PARAMS)
+    state = checkpoint.load_state()
+    start_rng = get_rng_state(generator)
+    if state is None:
+        checkpoint.save_state(0, start_rng, None)
+    else:
+        start_rng = state["start_rng"]
+        set_rng_state(start_rng, generator)
+
+    all_latents = torch.randn(PARAMS["num_frames"], 4, generator=generator)
+    first_window = 0
+    if state is not None and state["rng"] is not None:
+        first_window = state["next_window"]
+        set_rng_state(state["rng"], generator)
+
+    output = np.zeros((PARAMS["num_frames"], 4), dtype=np.float32)
+    num_windows = -(-PARAMS["num_frames"] // PARAMS["window_size"])
+    for i in range(num_windows):
+        start, end = i * PARAMS["window_size"], min((i + 1) * PARAMS["window_size"], PARAMS["num_frames"])
+        if i < first_window:
+            output[start:end] = checkpoint.load_window(i)
+            continue
+        if stop_after is not None and i == stop_after:
+            raise Preempted()
+        # The VAE samples from its posterior in every window
+        noise = torch.randn(end - start, 4, generator=generator)
+        output[start:end] = (all_latents[start:end] + torch.randn(end - start, 4) + noise).numpy()
+        checkpoint.save_window(i, output[start:end])
+        checkpoint.save_state(i + 1, start_rng, get_rng_state(generator))
+    return output
+
+
+def test_resumed_render_matches_uninterrupted_run():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        torch.manual_seed(0)
+        reference = toy_render(os.path.join(tmpdir, "reference"), torch.Generator().manual_seed(1))
+
+        for stop_after in (0, 1, 2):
+            job_dir = os.path.join(tmpdir, f"job_{stop_after}")
+            torch.manual_seed(0)
+            try:
+                toy_render(job_dir, torch.Generator().manual_seed(1), stop_after=stop_after)
+            except Preempted:
+                pass
+            # The new process starts with other RNG states
+            torch.manual_seed(123)
+            resumed = toy_render(job_dir, torch.Generator().manual_seed(2))
+            np.testing.assert_array_equal(resumed, reference)
+            assert not any(name.endswith(".partial") for name in os.listdir(job_dir))
+
+
+def test_other_parameters_are_rejected():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        RenderCheckpoint(tmpdir, PARAMS)
+        RenderCheckpoint(tmpdir, dict(PARAMS))
+        try:
+            RenderCheckpoint(tmpdir, {**PARAMS, "guidance_scale": 2.0})
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected a ValueError for a job with other parameters")
+
+
+class FakeAudioEncoder:
+    audio_feat_length = [2, 2]
+
+    def audio2feat(self, audio_path):
+        return None
+
+    def feature2chunks(self, feature_array, fps):
+        return [torch.zeros(10, 8) for _ in range(40)]
+
+
+class FakePipeline:
+    """The components `LipsyncPipeline.__call__` uses before its first window, which raises `Preempted`."""
+
+    __call__ = LipsyncPipeline.__call__
+    check_inputs = LipsyncPipeline.check_inputs
+    prepare_timesteps = LipsyncPipeline.prepare_timesteps
+    get_num_guided_steps = staticmethod(LipsyncPipeline.get_num_guided_steps)
+    prepare_extra_step_kwargs = LipsyncPipeline.prepare_extra_step_kwargs
+
+    def __init__(self):
+        self.unet = torch.nn.Module()
+        self.unet.config = SimpleNamespace(sample_size=8)
+        self.vae = SimpleNamespace(config=SimpleNamespace(latent_channels=4))
+        self.vae_scale_factor = 8
+        self.audio_encoder = FakeAudioEncoder()
+        self.scheduler = load_scheduler("ddim")
+        self._execution_device = torch.device("cpu")
+
+    def set_progress_bar_config(self, **kwargs):
+        pass
+
+    def loop_video(self, whisper_chunks, video_frames):
+        return video_frames[: len(whisper_chunks)], None, None, None
+
+    def prepare_latents(self, *args):
+        raise Preempted()
+
+
+def render_until_first_window(tmpdir, video_path, audio_path, seed):
+    patched = {
+        "check_ffmpeg_installed": lambda: None,
+        "load_fixed_mask": lambda resolution, mask_image_path: None,
+        "ImageProcessor": lambda *args, **kwargs: None,
+        "read_audio": lambda path: torch.zeros(40 * 640),
+        "read_video": lambda path, use_decord: np.zeros((40, 64, 64, 3), dtype=np.uint8),
+    }
+    originals = {name: getattr(lipsync_pipeline, name) for name in patched}
+    try:
+        for name, value in patched.items():
+            setattr(lipsync_pipeline, name, value)
+        FakePipeline()(
+            video_path,
+            audio_path,
+            os.path.join(tmpdir, "out.mp4"),
+            height=64,
+            temp_dir=os.path.join(tmpdir, "temp"),
+            generator=torch.Generator().manual_seed(seed),
+            checkpoint_dir=os.path.join(tmpdir, "job"),
+        )
+    except Preempted:
+        pass
+    finally:
+        for name, value in originals.items():
+            setattr(lipsync_pipeline, name, value)
+
+
+def test_rerun_with_other_inputs_is_rejected():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        video_path = os.path.join(tmpdir, "video.mp4")
+        audio_path = os.path.join(tmpdir, "audio.wav")
+        for path in (video_path, audio_path):
+            with open(path, "wb") as f:
+                f.write(os.path.basename(path).encode())
+
+        render_until_first_window(tmpdir, video_path, audio_path, seed=1247)
+        # The same job resumes
+        render_until_first_window(tmpdir, video_path, audio_path, seed=1247)
+
+        other_audio_path = os.path.join(tmpdir, "other_audio.wav")
+        with open(other_audio_path, "wb") as f:
+            f.write(b"another audio")
+        # The same video and audio files with other contents, another seed
+        reruns = [
+            (video_path, other_audio_path, 1247),
+            (other_audio_path, audio_path, 1247),
+            (video_path, audio_path, 1248),
+        ]
+        for rerun_video_path, rerun_audio_path, seed in reruns:
+            try:
+                render_until_first_window(tmpdir, rerun_video_path, rerun_audio_path, seed)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError(f"Expected a ValueError for a rerun of {rerun_video_path}, {rerun_audio_path}")
+
+        # Overwriting the input in place is a change as well
+        with open(audio_path, "wb") as f:
+            f.write(b"a new recording")
+        try:
+            render_until_first_window(tmpdir, video_path, audio_path, seed=1247)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected a ValueError for a rerun with a changed audio file")
+
+
+if __name__ == "__main__":
+    test_resumed_render_matches_uninterrupted_run()
+    test_other_parameters_are_rejected()
+    test_rerun_with_other_inputs_is_rejected()
+    print("All render checkpoint tests passed")
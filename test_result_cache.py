@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Tests for the result cache of the RunPod worker (result_cache.py).
+Uses small files in a temporary directory and the local-directory backend.
+"""
+
+import os
+import tempfile
+
+from result_cache import LocalDirectoryResultStore, result_key
+
+SETTINGS = {"guidance_scale": 2.0, "inference_steps": 20, "seed": 1247, "remove_background": False}
+
+
+def write(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def make_inputs(tmpdir, prefix):
+    return [
+        write(os.path.join(tmpdir, f"{prefix}_video.mp4"), b"video"),
+        write(os.path.join(tmpdir, f"{prefix}_audio.wav"), b"audio"),
+        write(os.path.join(tmpdir, f"{prefix}_unet.pt"), b"checkpoint"),
+        write(os.path.join(tmpdir, f"{prefix}_stage2.yaml"), b"config"),
+    ]
+
+
+def test_key_depends_on_contents_and_settings():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inputs = make_inputs(tmpdir, "a")
+        key = result_key(*inputs, SETTINGS)
+
+        # The same contents under other names give the same key
+        assert result_key(*make_inputs(tmpdir, "b"), SETTINGS) == key
+        assert result_key(*inputs, dict(reversed(list(SETTINGS.items())))) == key
+
+        assert result_key(*inputs, {**SETTINGS, "seed": 1}) != key
+        assert result_key(*inputs, {**SETTINGS, "remove_background": True}) != key
+        for index in range(len(inputs)):
+            changed = list(inputs)
+            changed[index] = write(os.path.join(tmpdir, f"changed_{index}"), b"other")
+            assert result_key(*changed, SETTINGS) != key
+
+
+def test_local_directory_store():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = LocalDirectoryResultStore(os.path.join(tmpdir, "results"))
+        key = result_key(*make_inputs(tmpdir, "a"), SETTINGS)
+        assert store.get(key) is None
+
+        output_path = write(os.path.join(tmpdir, "video_out.mp4"), b"rendered")
+        store.put(key, {"output_url": "https://example.com/out.mp4", "report": {"num_frames": 25}}, output_path)
+        # The job's output is overwritten by the next job, the store keeps its own copy
+        write(output_path, b"next job")
+
+        result = store.get(key)
+        assert result["output_url"] == "https://example.com/out.mp4"
+        assert result["report"] == {"num_frames": 25}
+        assert open(result["output_path"], "rb").read() == b"rendered"
+
+        # A record whose video is gone is a miss
+        os.remove(result["output_path"])
+        assert store.get(key) is None
+
+
+if __name__ == "__main__":
+    test_key_depends_on_contents_and_settings()
+    test_local_directory_store()
+    print("All result cache tests passed")
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Tests for loading UNet checkpoints converted to safetensors (tools/convert_unet_to_safetensors.py and
+UNet3DConditionModel.from_safetensors). Converts a small randomly initialized UNet, so no checkpoint is needed.
+"""
+
+import argparse
+import os
+import tempfile
+
+import torch
+
+from latentsync.models.unet import UNet3DConditionModel
+from tools.convert_unet_to_safetensors import main as convert
+
+MODEL_CONFIG = {
+    "sample_size": 16,
+    "in_channels": 13,
+    "out_channels": 4,
+    "block_out_channels": [32, 32, 64, 64],
+    "layers_per_block": 1,
+    "norm_num_groups": 8,
+    "cross_attention_dim": 16,
+    "attention_head_dim": 8,
+    "add_audio_layer": True,
+}
+
+
+def save_checkpoint(path, global_step=1234):
+    torch.manual_seed(0)
+    unet = UNet3DConditionModel.from_config(MODEL_CONFIG)
+    torch.save({"state_dict": unet.state_dict(), "global_step": global_step}, path)
+
+
+def convert_checkpoint(ckpt_path, dtype):
+    output_path = os.path.splitext(ckpt_path)[0] + f"_{dtype}.safetensors"
+    convert(argparse.Namespace(ckpt_path=ckpt_path, output_path=output_path, dtype=dtype))
+    return output_path
+
+
+def assert_state_dicts_equal(unet, reference):
+    state_dict = unet.state_dict()
+    reference_state_dict = reference.state_dict()
+    assert state_dict.keys() == reference_state_dict.keys()
+    for key, value in state_dict.items():
+        assert not value.is_meta, key
+        assert value.dtype == reference_state_dict[key].dtype, key
+        torch.testing.assert_close(value, reference_state_dict[key], rtol=0, atol=0, msg=key)
+
+
+def test_round_trip_matches_pickled_checkpoint():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ckpt_path = os.path.join(tmpdir, "unet.pt")
+        save_checkpoint(ckpt_path)
+        reference, reference_step = UNet3DConditionModel.from_pretrained(MODEL_CONFIG, ckpt_path)
+
+        safetensors_path = convert_checkpoint(ckpt_path, "fp32")
+        unet, global_step = UNet3DConditionModel.from_pretrained(MODEL_CONFIG, safetensors_path)
+        assert global_step == reference_step == 1234
+        assert_state_dicts_equal(unet, reference)
+
+        # The loaded model runs like the reference
+        unet.eval()
+        reference.eval()
+        sample = torch.randn(1, 13, 2, 16, 16)
+        audio_embeds = torch.randn(2, 10, 16)
+        with torch.no_grad():
+            output = unet(sample, torch.tensor(500), encoder_hidden_states=audio_embeds).sample
+            expected = reference(sample, torch.tensor(500), encoder_hidden_states=audio_embeds).sample
+        torch.testing.assert_close(output, expected, rtol=0, atol=0)
+
+
+def test_fp16_conversion():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ckpt_path = os.path.join(tmpdir, "unet.pt")
+        save_checkpoint(ckpt_path)
+        reference, _ = UNet3DConditionModel.from_pretrained(MODEL_CONFIG, ckpt_path, dtype=torch.float16)
+
+        safetensors_path = convert_checkpoint(ckpt_path, "fp16")
+        unet, _ = UNet3DConditionModel.from_safetensors(MODEL_CONFIG, safetensors_path, dtype=torch.float16)
+        assert_state_dicts_equal(unet, reference)
+
+
+def test_checkpoint_of_another_model_is_rejected():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ckpt_path = os.path.join(tmpdir, "unet.pt")
+        save_checkpoint(ckpt_path)
+        safetensors_path = convert_checkpoint(ckpt_path, "fp32")
+        try:
+            UNet3DConditionModel.from_safetensors({**MODEL_CONFIG, "layers_per_block": 2}, safetensors_path)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("Expected a RuntimeError for tensors missing from the checkpoint")
+
+
+if __name__ == "__main__":
+    test_round_trip_matches_pickled_checkpoint()
+    test_fp16_conversion()
+    test_checkpoint_of_another_model_is_rejected()
+    print("All safetensors checkpoint tests passed")
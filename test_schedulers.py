@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Tests for the scheduler registry (latentsync.utils.schedulers).
+Runs a toy denoising loop and LipsyncPipeline.denoise_window with a small randomly initialized UNet on CPU,
+so no checkpoint is needed.
+"""
+
+import torch
+import tqdm
+
+from latentsync.models.unet import UNet3DConditionModel
+from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
+from latentsync.utils.schedulers import SCHEDULERS, load_scheduler
+
+NUM_FRAMES = 2
+CROSS_ATTENTION_DIM = 16
+
+
+class UNetPipeline:
+    denoise_window = LipsyncPipeline.denoise_window
+    prepare_extra_step_kwargs = LipsyncPipeline.prepare_extra_step_kwargs
+    run_unet = LipsyncPipeline.run_unet
+
+    def __init__(self, unet, scheduler):
+        self.unet = unet
+        self.scheduler = scheduler
+        self.unet_batcher = None
+
+    def progress_bar(self, total):
+        return tqdm.tqdm(total=total, disable=True)
+
+
+def build_unet():
+    torch.manual_seed(0)
+    unet = UNet3DConditionModel(
+        sample_size=16,
+        in_channels=13,
+        out_channels=4,
+        block_out_channels=(32, 32, 64, 64),
+        layers_per_block=1,
+        norm_num_groups=8,
+        cross_attention_dim=CROSS_ATTENTION_DIM,
+        attention_head_dim=8,
+        add_audio_layer=True,
+    )
+    # conv_in and conv_out are zero initialized, which would make every output identical
+    with torch.no_grad():
+        for conv in (unet.conv_in, unet.conv_out):
+            conv.weight.normal_(std=0.1)
+    return unet.eval()
+
+
+def denoise(scheduler, latents, num_inference_steps):
+    # The pipeline resets the timesteps before every window, a multistep solver must start from scratch each time
+    scheduler.set_timesteps(num_inference_steps)
+    for t in scheduler.timesteps:
+        noise_pred = 0.1 * latents
+        latents = scheduler.step(noise_pred, t, latents).prev_sample
+    return latents
+
+
+def test_schedulers_share_the_noise_schedule():
+    reference = load_scheduler("ddim")
+    for name in SCHEDULERS:
+        scheduler = load_scheduler(name)
+        torch.testing.assert_close(scheduler.alphas_cumprod, reference.alphas_cumprod)
+
+
+def test_windows_are_independent():
+    latents = torch.randn(1, 4, 2, 8, 8, generator=torch.Generator().manual_seed(0))
+    for name in SCHEDULERS:
+        scheduler = load_scheduler(name)
+        first_window = denoise(scheduler, latents, 8)
+        second_window = denoise(scheduler, latents, 8)
+        assert torch.isfinite(first_window).all(), name
+        assert torch.equal(first_window, second_window), name
+
+
+def test_denoise_window_with_guidance():
+    unet = build_unet()
+    generator = torch.Generator().manual_seed(1)
+    latents = torch.randn(1, 4, NUM_FRAMES, 16, 16, generator=generator)
+    # The unconditional inputs first, then the audio-conditioned ones, as prepared by __call__
+    mask_latents = torch.randn(1, 1, NUM_FRAMES, 16, 16, generator=generator).repeat(2, 1, 1, 1, 1)
+    masked_image_latents = torch.randn(1, 4, NUM_FRAMES, 16, 16, generator=generator).repeat(2, 1, 1, 1, 1)
+    ref_latents = torch.randn(1, 4, NUM_FRAMES, 16, 16, generator=generator).repeat(2, 1, 1, 1, 1)
+    audio_embeds = torch.randn(NUM_FRAMES, 10, CROSS_ATTENTION_DIM, generator=generator)
+    audio_embeds = torch.cat([torch.zeros_like(audio_embeds), audio_embeds])
+
+    for name in SCHEDULERS:
+        pipeline = UNetPipeline(unet, load_scheduler(name))
+        extra_step_kwargs = pipeline.prepare_extra_step_kwargs(torch.Generator().manual_seed(2), 0.0)
+        pipeline.scheduler.set_timesteps(4)
+        with torch.no_grad():
+            result = pipeline.denoise_window(
+                latents,
+                mask_latents,
+                masked_image_latents,
+                ref_latents,
+                audio_embeds,
+                pipeline.scheduler.timesteps,
+                guidance_scale=1.5,
+                num_guided_steps=4,
+                do_classifier_free_guidance=True,
+                extra_step_kwargs=extra_step_kwargs,
+            )
+        assert result.shape == latents.shape, name
+        assert torch.isfinite(result).all(), name
+        assert not torch.equal(result, latents), name
+
+
+def test_unknown_scheduler():
+    try:
+        load_scheduler("heun")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected a ValueError for an unknown scheduler")
+
+
+if __name__ == "__main__":
+    test_schedulers_share_the_noise_schedule()
+    test_windows_are_independent()
+    test_denoise_window_with_guidance()
+    test_unknown_scheduler()
+    print("All scheduler tests passed")
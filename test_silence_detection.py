@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Tests for skipping the silent windows of a render (detect_silent_frames and detect_silent_windows in
+latentsync.utils.util). Synthetic tones and zeros stand in for speech.
+"""
+
+import numpy as np
+import torch
+
+from latentsync.utils.util import detect_silent_frames, detect_silent_windows
+
+SAMPLES_PER_FRAME = 640  # 16 kHz audio, 25 fps video
+
+
+def make_audio(frame_levels):
+    # One 440 Hz tone per video frame with the given amplitude, 0 for digital silence
+    t = torch.arange(SAMPLES_PER_FRAME) / 16000
+    tone = torch.sin(2 * torch.pi * 440 * t)
+    return torch.cat([level * tone for level in frame_levels])
+
+
+def test_threshold_relative_to_loudest_frame():
+    # Peaks of 0.5, 0.5 / 10 (-20 dB) and 0.5 / 1000 (-60 dB)
+    audio = make_audio([0.5, 0.05, 0.0005])
+    silent = detect_silent_frames(audio, 3, threshold_db=-40.0, floor_db=-100.0, audio_context=(0, 0))
+    assert silent.tolist() == [False, False, True]
+    silent = detect_silent_frames(audio, 3, threshold_db=-10.0, floor_db=-100.0, audio_context=(0, 0))
+    assert silent.tolist() == [False, True, True]
+
+
+def test_floor_marks_quiet_audio_silent():
+    # A quiet recording is silent below the floor, even though its loudest frame sets the relative threshold
+    audio = make_audio([0.001, 0.001, 0.0])
+    silent = detect_silent_frames(audio, 3, threshold_db=-40.0, floor_db=-50.0, audio_context=(0, 0))
+    assert silent.tolist() == [True, True, True]
+    silent = detect_silent_frames(audio, 3, threshold_db=-40.0, floor_db=-70.0, audio_context=(0, 0))
+    assert silent.tolist() == [False, False, True]
+
+
+def test_samples_map_to_their_frame():
+    levels = [0.5 if i in (3, 7) else 0.0 for i in range(10)]
+    silent = detect_silent_frames(make_audio(levels), 10, audio_context=(0, 0))
+    assert np.flatnonzero(~silent).tolist() == [3, 7]
+
+    # A short audio is padded with silence, samples past the last frame are ignored
+    audio = torch.cat([make_audio([0.5, 0.5]), torch.ones(100)])
+    assert detect_silent_frames(audio[: SAMPLES_PER_FRAME + 1], 3, audio_context=(0, 0)).tolist() == [
+        False,
+        True,
+        True,
+    ]
+    assert detect_silent_frames(audio, 2, audio_context=(0, 0)).tolist() == [False, False]
+
+
+def test_audio_context_keeps_the_frames_around_speech():
+    levels = [0.5 if i == 5 else 0.0 for i in range(12)]
+    silent = detect_silent_frames(make_audio(levels), 12, audio_context=(2, 2))
+    assert np.flatnonzero(~silent).tolist() == [3, 4, 5, 6, 7]
+    silent = detect_silent_frames(make_audio(levels), 12, audio_context=(1, 3))
+    assert np.flatnonzero(~silent).tolist() == [2, 3, 4, 5, 6]
+
+
+def test_window_is_skipped_only_when_all_its_frames_are_silent():
+    silent_frames = np.ones(40, dtype=bool)
+    silent_frames[20] = False
+    assert detect_silent_windows(silent_frames, 16).tolist() == [True, False, True]
+
+    # The last window is shorter than the others
+    silent_frames = np.ones(36, dtype=bool)
+    silent_frames[35] = False
+    assert detect_silent_windows(silent_frames, 16).tolist() == [True, True, False]
+
+    assert detect_silent_windows(np.ones(32, dtype=bool), 16).tolist() == [True, True]
+    assert detect_silent_windows(np.zeros(17, dtype=bool), 16).tolist() == [False, False]
+
+
+def test_speech_in_a_window_keeps_it_rendered():
+    # Speech on the first frame of the second window, the audio context reaches back into the first one
+    levels = [0.5 if i == 16 else 0.0 for i in range(48)]
+    silent_frames = detect_silent_frames(make_audio(levels), 48, audio_context=(2, 2))
+    assert detect_silent_windows(silent_frames, 16).tolist() == [False, False, True]
+
+
+if __name__ == "__main__":
+    test_threshold_relative_to_loudest_frame()
+    test_floor_marks_quiet_audio_silent()
+    test_samples_map_to_their_frame()
+    test_audio_context_keeps_the_frames_around_speech()
+    test_window_is_skipped_only_when_all_its_frames_are_silent()
+    test_speech_in_a_window_keeps_it_rendered()
+    print("All silence detection tests passed")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Tests for StreamingAudio2Feature: the incremental extractor must yield complete blocks of whisper chunks
+while audio arrives, encode each received mel frame about once, and reproduce the offline features exactly
+once the stream is finished. Uses a small randomly initialized whisper model, so no checkpoint is needed.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from latentsync.whisper import audio2feature
+from latentsync.whisper.audio2feature import Audio2Feature, StreamingAudio2Feature
+from latentsync.whisper.whisper.model import ModelDimensions, Whisper
+
+SAMPLE_RATE = 16000
+
+
+def build_audio_encoder(tmp_dir):
+    torch.manual_seed(0)
+    dims = ModelDimensions(
+        n_mels=80,
+        n_audio_ctx=1500,
+        n_audio_state=64,
+        n_audio_head=2,
+        n_audio_layer=2,
+        n_vocab=51864,
+        n_text_ctx=8,
+        n_text_state=64,
+        n_text_head=2,
+        n_text_layer=1,
+    )
+    model = Whisper(dims)
+    model_path = os.path.join(tmp_dir, "whisper_tiny_random.pt")
+    torch.save({"dims": dims.__dict__, "model_state_dict": model.state_dict()}, model_path)
+    return Audio2Feature(model_path=model_path, device="cpu")
+
+
+def synthetic_speech(seconds, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 3.0 * t)
+    audio = envelope * (0.3 * np.sin(2 * np.pi * 220.0 * t) + 0.1 * np.sin(2 * np.pi * 1250.0 * t))
+    audio += 0.01 * rng.standard_normal(len(t))
+    return audio.astype(np.float32)
+
+
+def test_streaming_matches_offline():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        audio_encoder = build_audio_encoder(tmp_dir)
+        # Longer than one 30 s whisper window, so a closed window is reused at the end
+        audio = synthetic_speech(35.3)
+
+        offline_features = audio_encoder._audio2feat(audio)
+        offline_chunks = audio_encoder.feature2chunks(feature_array=offline_features, fps=25)
+
+        stream = StreamingAudio2Feature(audio_encoder, fps=25)
+        rng = np.random.default_rng(1)
+        blocks = []
+        position = 0
+        while position < len(audio):
+            block_size = int(rng.integers(800, 12000))
+            blocks.extend(stream.push(audio[position : position + block_size]))
+            position += block_size
+        whisper_chunks = stream.finish()
+
+        assert len(stream.closed_segments) == 1
+        assert len(blocks) > 0
+        assert all(len(block) == stream.block_size for block in blocks)
+        assert stream.num_emitted_frames == len(blocks) * stream.block_size
+        assert stream.num_emitted_frames <= len(offline_chunks)
+        for block in blocks:
+            for chunk in block:
+                assert chunk.shape == offline_chunks[0].shape
+
+        assert torch.equal(stream.feature_array, offline_features)
+        assert len(whisper_chunks) == len(offline_chunks)
+        for chunk, offline_chunk in zip(whisper_chunks, offline_chunks):
+            assert torch.equal(chunk, offline_chunk)
+
+
+def test_push_chunks_match_finish():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        audio_encoder = build_audio_encoder(tmp_dir)
+        audio = synthetic_speech(35.3)
+
+        encoded_lengths = []
+        encode_segment = audio2feature.encode_segment
+
+        def recording_encode_segment(model, segment, dtype, position_offset=0):
+            encoded_lengths.append(segment.shape[-1])
+            return encode_segment(model, segment, dtype, position_offset=position_offset)
+
+        audio2feature.encode_segment = recording_encode_segment
+        try:
+            stream = StreamingAudio2Feature(audio_encoder, fps=25)
+            # The first push closes the first 30 s window, the rest arrives in 0.2 s blocks
+            first_push = 31 * SAMPLE_RATE
+            blocks = stream.push(audio[:first_push])
+            num_closed_frames = stream.num_emitted_frames
+            for position in range(first_push, len(audio), SAMPLE_RATE // 5):
+                blocks.extend(stream.push(audio[position : position + SAMPLE_RATE // 5]))
+            num_push_encodes = len(encoded_lengths)
+            whisper_chunks = stream.finish()
+        finally:
+            audio2feature.encode_segment = encode_segment
+
+        # Besides the closed window, the pushes encode each frame of the open window once, plus a context
+        # margin on either side of every encoded slice
+        assert encoded_lengths[0] == audio2feature.N_FRAMES
+        tail_lengths = encoded_lengths[1:num_push_encodes]
+        open_frames = stream.log_mel.shape[1] - audio2feature.N_FRAMES
+        assert sum(tail_lengths) <= open_frames + len(tail_lengths) * 2 * audio_encoder.context_margin
+
+        pushed_chunks = [chunk for block in blocks for chunk in block]
+        assert 0 < len(pushed_chunks) <= len(whisper_chunks)
+        # Frames whose features all lie in the closed window are final when pushed
+        closed_features = audio2feature.N_FRAMES // 2
+        right_offset = (audio_encoder.audio_feat_length[1] + 1) * 2
+        num_exact = 0
+        for vid_idx, (chunk, final_chunk) in enumerate(zip(pushed_chunks, whisper_chunks)):
+            assert chunk.shape == final_chunk.shape
+            if vid_idx < num_closed_frames and int(vid_idx * 50 / 25) + right_offset <= closed_features:
+                assert torch.equal(chunk, final_chunk)
+                num_exact += 1
+            else:
+                # Provisional chunks see a truncated context. A randomly initialized encoder attends almost
+                # uniformly over its window, so this bound is much looser than for a trained one
+                assert torch.linalg.norm(chunk - final_chunk) < 0.5 * torch.linalg.norm(final_chunk)
+        assert num_exact > 0
+
+
+if __name__ == "__main__":
+    test_streaming_matches_offline()
+    print("test_streaming_matches_offline passed")
+    test_push_chunks_match_finish()
+    print("test_push_chunks_match_finish passed")
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Tests for starting the denoising part way (LipsyncPipeline.prepare_timesteps with `strength`), with every
+scheduler of the registry. Runs a toy denoising loop on CPU, so no checkpoint is needed.
+"""
+
+import torch
+
+from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
+from latentsync.utils.schedulers import SCHEDULERS, load_scheduler
+
+
+class ToyPipeline:
+    prepare_timesteps = LipsyncPipeline.prepare_timesteps
+
+    def __init__(self, scheduler_name):
+        self.scheduler = load_scheduler(scheduler_name)
+
+
+def full_timesteps(scheduler_name, num_inference_steps):
+    scheduler = load_scheduler(scheduler_name)
+    scheduler.set_timesteps(num_inference_steps)
+    return scheduler.timesteps
+
+
+def test_full_strength_keeps_every_step():
+    for name in SCHEDULERS:
+        pipeline = ToyPipeline(name)
+        for strength in (1.0, 1.5):
+            timesteps = pipeline.prepare_timesteps(20, strength, "cpu")
+            assert torch.equal(timesteps, full_timesteps(name, 20)), name
+
+
+def test_strength_runs_the_last_steps():
+    for name in SCHEDULERS:
+        pipeline = ToyPipeline(name)
+        reference = full_timesteps(name, 20)
+        order = pipeline.scheduler.order
+        for strength, num_steps in ((0.5, 10), (0.26, 5), (0.05, 1)):
+            timesteps = pipeline.prepare_timesteps(20, strength, "cpu")
+            assert len(timesteps) == num_steps * order, (name, strength)
+            assert torch.equal(timesteps, reference[len(reference) - len(timesteps) :]), (name, strength)
+            if hasattr(pipeline.scheduler, "set_begin_index"):
+                assert pipeline.scheduler.begin_index == (20 - num_steps) * order, (name, strength)
+
+
+def test_truncated_schedule_denoises():
+    latents = torch.randn(1, 4, 2, 8, 8, generator=torch.Generator().manual_seed(0))
+    for name in SCHEDULERS:
+        pipeline = ToyPipeline(name)
+        # Every window prepares its timesteps again, multistep solvers restart at the same step
+        windows = []
+        for _ in range(2):
+            window_latents = latents
+            for t in pipeline.prepare_timesteps(10, 0.5, "cpu"):
+                window_latents = pipeline.scheduler.step(0.1 * window_latents, t, window_latents).prev_sample
+            windows.append(window_latents)
+        assert torch.isfinite(windows[0]).all(), name
+        assert torch.equal(windows[0], windows[1]), name
+
+
+def test_strength_without_steps():
+    pipeline = ToyPipeline("ddim")
+    try:
+        pipeline.prepare_timesteps(20, 0.01, "cpu")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected a ValueError for a strength that leaves no step")
+
+
+if __name__ == "__main__":
+    test_full_strength_keeps_every_step()
+    test_strength_runs_the_last_steps()
+    test_truncated_schedule_denoises()
+    test_strength_without_steps()
+    print("All strength tests passed")
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Tests for the temporal attention of the motion modules computed on strided views instead of rearranged copies.
+Runs on CPU with small randomly initialized modules, so no checkpoint is needed.
+"""
+
+import torch
+from einops import rearrange
+
+from latentsync.models.motion_module import TemporalTransformer3DModel, VersatileAttention
+
+NUM_FRAMES = 8
+
+
+def build_attention():
+    torch.manual_seed(0)
+    return VersatileAttention(
+        attention_mode="Temporal",
+        cross_attention_dim=None,
+        query_dim=32,
+        heads=4,
+        dim_head=8,
+        temporal_position_encoding=True,
+        temporal_position_encoding_max_len=24,
+    ).eval()
+
+
+def test_attention_matches_rearranged():
+    attention = build_attention()
+    hidden_states = torch.randn(2 * NUM_FRAMES, 36, 32)
+    with torch.no_grad():
+        reference = attention.forward_rearranged(hidden_states, video_length=NUM_FRAMES)
+        output = attention(hidden_states, video_length=NUM_FRAMES)
+        attention.fuse_projections()
+        fused = attention(hidden_states, video_length=NUM_FRAMES)
+    torch.testing.assert_close(output, reference, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(fused, reference, rtol=1e-5, atol=1e-5)
+
+
+def test_transformer_matches_flattened():
+    torch.manual_seed(0)
+    transformer = TemporalTransformer3DModel(
+        in_channels=32,
+        num_attention_heads=4,
+        attention_head_dim=8,
+        num_layers=1,
+        norm_num_groups=8,
+        temporal_position_encoding=True,
+    ).eval()
+    with torch.no_grad():
+        transformer.norm.weight.normal_()
+        transformer.norm.bias.normal_()
+    hidden_states = torch.randn(2, 32, NUM_FRAMES, 6, 6)
+
+    # The flattened path runs nn.GroupNorm on (b f) c h w, as the motion modules always did
+    flat = rearrange(hidden_states, "b c f h w -> (b f) c h w")
+    with torch.no_grad():
+        reference = transformer(flat, video_length=NUM_FRAMES)
+        reference = rearrange(reference, "(b f) c h w -> b c f h w", f=NUM_FRAMES)
+        output = transformer(hidden_states)
+    assert output.is_contiguous()
+    torch.testing.assert_close(output, reference, rtol=1e-5, atol=1e-5)
+
+    # With autograd the normalized tokens are not written into a preallocated buffer
+    output = transformer(hidden_states)
+    torch.testing.assert_close(output.detach(), reference, rtol=1e-5, atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_attention_matches_rearranged()
+    test_transformer_matches_flattened()
+    print("All temporal attention tests passed")
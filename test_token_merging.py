@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Tests for the token merging around the spatial self-attention (latentsync.models.token_merging).
+Runs on CPU with random tensors and a small randomly initialized UNet, so no checkpoint is needed.
+"""
+
+import torch
+
+from latentsync.models.attention import BasicTransformerBlock
+from latentsync.models.token_merging import compute_merge
+from latentsync.models.unet import UNet3DConditionModel
+
+
+def test_zero_ratio_is_identity():
+    x = torch.randn(2, 64, 8)
+    merge, unmerge = compute_merge(x, (8, 8), 0.0)
+    assert torch.equal(unmerge(merge(x)), x)
+
+
+def test_duplicate_tokens_are_merged_losslessly():
+    torch.manual_seed(0)
+    # every 2x2 patch holds four copies of the same token
+    patches = torch.randn(2, 4, 4, 8)
+    x = patches.repeat_interleave(2, dim=1).repeat_interleave(2, dim=2).reshape(2, 64, 8)
+    merge, unmerge = compute_merge(x, (8, 8), 0.75)
+    merged = merge(x)
+    assert merged.shape == (2, 16, 8)
+    torch.testing.assert_close(unmerge(merged), x)
+
+
+def test_merge_mask_protects_tokens():
+    torch.manual_seed(0)
+    x = torch.randn(1, 64, 8)
+    merge_mask = torch.ones(8, 8)
+    merge_mask[4:] = 0  # the lower half (mouth region) must be left untouched
+    merge, unmerge = compute_merge(x, (8, 8), 0.5, merge_mask=merge_mask)
+    merged = merge(x)
+    assert merged.shape[1] < 64
+    restored = unmerge(merged).reshape(1, 8, 8, 8)
+    assert torch.equal(restored[:, 4:], x.reshape(1, 8, 8, 8)[:, 4:])
+
+
+def test_unet_levels():
+    torch.manual_seed(0)
+    unet = UNet3DConditionModel(
+        sample_size=16,
+        in_channels=13,
+        out_channels=4,
+        block_out_channels=(32, 32, 64, 64),
+        layers_per_block=1,
+        norm_num_groups=8,
+        cross_attention_dim=16,
+        attention_head_dim=8,
+        add_audio_layer=True,
+    ).eval()
+    unet.set_token_merging({0: 0.5})
+    for block in (unet.down_blocks[0], unet.up_blocks[-1]):
+        assert all(m.token_merge_ratio == 0.5 for m in block.modules() if isinstance(m, BasicTransformerBlock))
+    assert all(m.token_merge_ratio == 0.0 for m in unet.mid_block.modules() if isinstance(m, BasicTransformerBlock))
+
+    sample = torch.randn(1, 13, 2, 16, 16)
+    audio_embeds = torch.randn(2, 10, 16)
+    with torch.no_grad():
+        output = unet(sample, 500, encoder_hidden_states=audio_embeds).sample
+    assert output.shape == (1, 4, 2, 16, 16)
+    assert torch.isfinite(output).all()
+
+    unet.set_token_merging(None)
+    assert all(m.token_merge_ratio == 0.0 for m in unet.modules() if isinstance(m, BasicTransformerBlock))
+
+
+if __name__ == "__main__":
+    test_zero_ratio_is_identity()
+    test_duplicate_tokens_are_merged_losslessly()
+    test_merge_mask_protects_tokens()
+    test_unet_levels()
+    print("All token merging tests passed")
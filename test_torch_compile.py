@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Tests for compiling the UNet (latentsync.utils.torch_compile).
+Compiles a small randomly initialized UNet on CPU with a backend that runs the captured graphs eagerly and counts
+them, so no checkpoint or compiler toolchain is needed.
+"""
+
+import tempfile
+
+import torch
+
+from latentsync.models.unet import UNet3DConditionModel
+from latentsync.utils.torch_compile import compile_unet, warmup_batch_sizes, warmup_unet
+
+NUM_FRAMES = 4
+AUDIO_TOKENS = 10
+CROSS_ATTENTION_DIM = 16
+
+
+class CountingBackend:
+    def __init__(self):
+        self.num_graphs = 0
+
+    def __call__(self, graph_module, example_inputs):
+        self.num_graphs += 1
+        return graph_module.forward
+
+
+def build_unet():
+    torch.manual_seed(0)
+    unet = UNet3DConditionModel(
+        sample_size=16,
+        in_channels=13,
+        out_channels=4,
+        block_out_channels=(32, 32, 64, 64),
+        layers_per_block=1,
+        norm_num_groups=8,
+        cross_attention_dim=CROSS_ATTENTION_DIM,
+        attention_head_dim=8,
+        add_audio_layer=True,
+    )
+    return unet.eval()
+
+
+def compiled_unet(backend, batch_sizes, timestep_per_sample=False):
+    torch._dynamo.reset()
+    unet = build_unet()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        compile_unet(unet, tmpdir, dtype=torch.float32, device="cpu", backend=backend, num_graphs=len(batch_sizes))
+        warmup_unet(
+            unet,
+            batch_sizes=batch_sizes,
+            num_frames=NUM_FRAMES,
+            height=128,
+            width=128,
+            audio_embeds_shape=(AUDIO_TOKENS, CROSS_ATTENTION_DIM),
+            device="cpu",
+            dtype=torch.float32,
+            timestep_per_sample=timestep_per_sample,
+        )
+    return unet
+
+
+def run_step(unet, batch_size, timestep):
+    sample = torch.randn(batch_size, 13, NUM_FRAMES, 16, 16)
+    audio_embeds = torch.randn(batch_size * NUM_FRAMES, AUDIO_TOKENS, CROSS_ATTENTION_DIM)
+    with torch.no_grad():
+        return unet(sample, timestep, encoder_hidden_states=audio_embeds).sample
+
+
+def test_warmed_up_steps_do_not_recompile():
+    backend = CountingBackend()
+    batch_sizes = warmup_batch_sizes()
+    unet = compiled_unet(backend, batch_sizes)
+    # One graph per batch size, the forward has no graph break
+    assert backend.num_graphs == len(batch_sizes) == 2
+
+    # Guided steps, then the conditional half once guidance ends
+    for t in (900, 700, 500):
+        run_step(unet, 2, torch.tensor(t))
+    for t in (300, 100):
+        run_step(unet, 1, torch.tensor(t))
+    assert backend.num_graphs == 2
+
+
+def test_batcher_batch_sizes_are_warmed_up():
+    backend = CountingBackend()
+    batch_sizes = warmup_batch_sizes(unet_batch_size=4)
+    assert batch_sizes == [1, 2, 3, 4]
+    unet = compiled_unet(backend, batch_sizes, timestep_per_sample=True)
+    assert backend.num_graphs == 4
+
+    # UNetStepBatcher passes one timestep per sample, the jobs of a batch are at different steps
+    for batch_size in (4, 3, 2, 1, 4):
+        run_step(unet, batch_size, torch.arange(batch_size) * 100 + 100)
+    assert backend.num_graphs == 4
+
+
+def test_compiled_forward_matches_eager():
+    unet = build_unet()
+    torch.manual_seed(1)
+    sample = torch.randn(2, 13, NUM_FRAMES, 16, 16)
+    audio_embeds = torch.randn(2 * NUM_FRAMES, AUDIO_TOKENS, CROSS_ATTENTION_DIM)
+    with torch.no_grad():
+        reference = unet(sample, torch.tensor(500), encoder_hidden_states=audio_embeds).sample
+
+    torch._dynamo.reset()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        compile_unet(unet, tmpdir, dtype=torch.float32, device="cpu", backend="eager")
+    with torch.no_grad():
+        output = unet(sample, torch.tensor(500), encoder_hidden_states=audio_embeds).sample
+    torch.testing.assert_close(output, reference)
+
+
+def test_deepcache_cannot_be_compiled():
+    unet = build_unet()
+    unet.enable_deepcache(cache_interval=3, cache_branch_id=0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            compile_unet(unet, tmpdir, dtype=torch.float32, device="cpu", backend="eager")
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected a ValueError for a UNet with DeepCache enabled")
+
+
+if __name__ == "__main__":
+    test_warmed_up_steps_do_not_recompile()
+    test_batcher_batch_sizes_are_warmed_up()
+    test_compiled_forward_matches_eager()
+    test_deepcache_cannot_be_compiled()
+    print("All torch.compile tests passed")
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Parity tests between the librosa mel spectrogram used by the training datasets and its batched torch
+implementation (latentsync.utils.audio.melspectrogram_torch). Run from the repository root so that
+configs/audio.yaml is found.
+"""
+
+import numpy as np
+import pytest
+import torch
+
+from latentsync.utils.audio import melspectrogram, melspectrogram_torch
+
+SAMPLE_RATE = 16000
+
+
+def random_speech_like(num_samples, seed):
+    rng = np.random.default_rng(seed)
+    t = np.arange(num_samples) / SAMPLE_RATE
+    wav = 0.4 * np.sin(2 * np.pi * rng.uniform(100, 300) * t) * (0.5 + 0.5 * np.sin(2 * np.pi * 4.0 * t))
+    wav += 0.05 * rng.standard_normal(num_samples)
+    return wav.astype(np.float32)
+
+
+def test_single_waveform_float64():
+    wav = random_speech_like(SAMPLE_RATE * 3 + 123, seed=0)
+    expected = melspectrogram(wav)
+    result = melspectrogram_torch(torch.from_numpy(wav).double())
+    assert result.shape == expected.shape
+    assert result.dtype == torch.float64
+    np.testing.assert_allclose(result.numpy(), expected, rtol=0, atol=1e-8)
+
+
+def test_batch_with_different_lengths():
+    lengths = [SAMPLE_RATE * 2, SAMPLE_RATE * 2 + 77, SAMPLE_RATE + 1999]
+    wavs = [random_speech_like(length, seed=i) for i, length in enumerate(lengths)]
+    batch = torch.zeros(len(wavs), max(lengths), dtype=torch.float64)
+    for i, wav in enumerate(wavs):
+        batch[i, : len(wav)] = torch.from_numpy(wav)
+
+    results = melspectrogram_torch(batch, lengths=lengths)
+    assert len(results) == len(wavs)
+    for wav, result in zip(wavs, results):
+        expected = melspectrogram(wav)
+        assert result.shape == expected.shape
+        np.testing.assert_allclose(result.numpy(), expected, rtol=0, atol=1e-8)
+
+
+def test_equal_length_batch_float32():
+    wavs = np.stack([random_speech_like(SAMPLE_RATE * 2, seed=i) for i in range(4)])
+    results = melspectrogram_torch(torch.from_numpy(wavs))
+    assert results.shape[0] == 4
+    assert results.dtype == torch.float32
+    for wav, result in zip(wavs, results):
+        np.testing.assert_allclose(result.numpy(), melspectrogram(wav), rtol=0, atol=1e-3)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA not available")
+def test_cuda_matches_cpu():
+    wav = torch.from_numpy(random_speech_like(SAMPLE_RATE * 2, seed=5)).double()
+    cpu_result = melspectrogram_torch(wav)
+    cuda_result = melspectrogram_torch(wav.cuda()).cpu()
+    torch.testing.assert_close(cuda_result, cpu_result, rtol=0, atol=1e-6)
+
+
+if __name__ == "__main__":
+    test_single_waveform_float64()
+    test_batch_with_different_lengths()
+    test_equal_length_batch_float32()
+    if torch.cuda.is_available():
+        test_cuda_matches_cpu()
+    else:
+        print("CUDA not available, skipping test_cuda_matches_cpu")
+    print("All mel spectrogram parity tests passed")
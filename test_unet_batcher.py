@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Tests for batching the UNet steps of concurrent jobs (latentsync.pipelines.unet_batcher).
+A toy UNet whose output depends on every input of its sample stands in for the real one, so no checkpoint is needed.
+"""
+
+import threading
+from types import SimpleNamespace
+
+import torch
+
+from latentsync.pipelines.unet_batcher import UNetStepBatcher
+
+
+class ToyUNet:
+    def __init__(self):
+        self.batch_sizes = []
+
+    def __call__(self, sample, timestep, encoder_hidden_states=None):
+        self.batch_sizes.append(sample.shape[0])
+        timestep = timestep.reshape(-1, 1, 1, 1, 1).to(sample.dtype)
+        output = sample * timestep
+        if encoder_hidden_states is not None:
+            output = output + encoder_hidden_states.mean(dim=(1, 2)).reshape(-1, 1, 1, 1, 1)
+        return SimpleNamespace(sample=output)
+
+
+def denoise(batcher, job, num_steps, results, barrier, batch_size=2):
+    # Mirrors the denoising loop of LipsyncPipeline.__call__, every job has its own timesteps and guidance scale
+    torch.manual_seed(job)
+    latents = torch.randn(batch_size, 4, 2, 8, 8)
+    audio_embeds = torch.randn(batch_size, 10, 6)
+    guidance_scale = 1.0 + job
+    outputs = []
+    with batcher.participant():
+        # Every job is denoising before the first step
+        barrier.wait()
+        for step in range(num_steps):
+            t = torch.tensor(1000 - 100 * step - job)
+            noise_pred = batcher(latents, t, audio_embeds)
+            reference = ToyUNet()(latents, t, audio_embeds).sample
+            torch.testing.assert_close(noise_pred, reference)
+            noise_pred_uncond, noise_pred_audio = noise_pred.chunk(2)
+            outputs.append(noise_pred_uncond + guidance_scale * (noise_pred_audio - noise_pred_uncond))
+    results[job] = outputs
+
+
+def run_jobs(batcher, num_jobs, num_steps):
+    results = {}
+    barrier = threading.Barrier(num_jobs)
+    threads = [
+        threading.Thread(target=denoise, args=(batcher, job, num_steps, results, barrier)) for job in range(num_jobs)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_steps_are_batched():
+    unet = ToyUNet()
+    # A long wait, the forwards only run once every job has submitted its step
+    batcher = UNetStepBatcher(unet, max_batch_size=8, max_wait=10.0)
+    results = run_jobs(batcher, num_jobs=4, num_steps=5)
+    assert sorted(results) == [0, 1, 2, 3]
+    assert all(len(outputs) == 5 for outputs in results.values())
+
+    metrics = batcher.metrics()
+    assert metrics["requests"] == 20
+    assert metrics["forwards"] == len(unet.batch_sizes) == 5
+    assert unet.batch_sizes == [8] * 5
+    assert metrics["fill_ratio"] == 1.0
+
+
+def test_batch_size_is_capped():
+    unet = ToyUNet()
+    batcher = UNetStepBatcher(unet, max_batch_size=4, max_wait=10.0)
+    results = run_jobs(batcher, num_jobs=3, num_steps=3)
+    assert sorted(results) == [0, 1, 2]
+    assert max(unet.batch_sizes) <= 4
+    assert sum(unet.batch_sizes) == 3 * 3 * 2
+    assert batcher.metrics()["requests"] == 9
+
+
+def test_single_job_does_not_wait():
+    unet = ToyUNet()
+    batcher = UNetStepBatcher(unet, max_batch_size=8, max_wait=10.0)
+    # With a single participant every step runs at once, without waiting for max_wait
+    results = run_jobs(batcher, num_jobs=1, num_steps=3)
+    assert len(results[0]) == 3
+    assert unet.batch_sizes == [2] * 3
+
+
+def test_errors_reach_every_request():
+    def failing_unet(sample, timestep, encoder_hidden_states=None):
+        raise RuntimeError("out of memory")
+
+    batcher = UNetStepBatcher(failing_unet, max_batch_size=8, max_wait=10.0)
+    errors = []
+
+    def job():
+        with batcher.participant():
+            try:
+                batcher(torch.zeros(1, 4, 2, 8, 8), torch.tensor(1), None)
+            except RuntimeError as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=job) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3
+
+
+if __name__ == "__main__":
+    test_concurrent_steps_are_batched()
+    test_batch_size_is_capped()
+    test_single_job_does_not_wait()
+    test_errors_reach_every_request()
+    print("All UNet batcher tests passed")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Tests for running the VAE in micro-batches that fit a memory budget (LipsyncPipeline.enable_vae_micro_batching).
+Uses a small randomly initialized VAE on CPU, so no checkpoint is needed.
+"""
+
+import torch
+from diffusers import AutoencoderKL
+
+from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
+
+NUM_FRAMES = 5
+SIZE = 32
+
+
+class ToyPipeline:
+    VAE_ELEMENTS_PER_PIXEL = LipsyncPipeline.VAE_ELEMENTS_PER_PIXEL
+    enable_vae_micro_batching = LipsyncPipeline.enable_vae_micro_batching
+    disable_vae_micro_batching = LipsyncPipeline.disable_vae_micro_batching
+    get_vae_micro_batch_size = LipsyncPipeline.get_vae_micro_batch_size
+    run_vae = LipsyncPipeline.run_vae
+    vae_encode = LipsyncPipeline.vae_encode
+    vae_encode_posterior = LipsyncPipeline.vae_encode_posterior
+    sample_vae_posterior = LipsyncPipeline.sample_vae_posterior
+    vae_decode = LipsyncPipeline.vae_decode
+
+    def __init__(self):
+        torch.manual_seed(0)
+        self.vae = AutoencoderKL(
+            block_out_channels=(8, 16),
+            down_block_types=("DownEncoderBlock2D",) * 2,
+            up_block_types=("UpDecoderBlock2D",) * 2,
+            latent_channels=4,
+            norm_num_groups=4,
+            # Frames larger than this are tiled
+            sample_size=SIZE // 2,
+        ).eval()
+        self.vae_scale_factor = 2
+        self._execution_device = torch.device("cpu")
+        self.vae_micro_batching = False
+        self.vae_memory_budget = None
+
+    def frame_cost(self, size=SIZE):
+        return self.VAE_ELEMENTS_PER_PIXEL * size * size * 4
+
+
+def make_images():
+    return torch.randn(NUM_FRAMES, 3, SIZE, SIZE, generator=torch.Generator().manual_seed(1))
+
+
+def encode_decode(pipeline, images):
+    with torch.no_grad():
+        posterior = pipeline.vae_encode_posterior(images)
+        decoded = pipeline.vae_decode(posterior[:, :4])
+    return posterior, decoded
+
+
+def test_micro_batch_size_follows_the_budget():
+    pipeline = ToyPipeline()
+    assert pipeline.get_vae_micro_batch_size(SIZE, SIZE, torch.float32) is None
+    pipeline.enable_vae_micro_batching(2 * pipeline.frame_cost() + 1)
+    assert pipeline.get_vae_micro_batch_size(SIZE, SIZE, torch.float32) == 2
+    # Half precision frames take half the memory
+    assert pipeline.get_vae_micro_batch_size(SIZE, SIZE, torch.float16) == 4
+    pipeline.enable_vae_micro_batching(pipeline.frame_cost() - 1)
+    assert pipeline.get_vae_micro_batch_size(SIZE, SIZE, torch.float32) == 0
+    pipeline.disable_vae_micro_batching()
+    assert pipeline.get_vae_micro_batch_size(SIZE, SIZE, torch.float32) is None
+
+
+def test_micro_batches_match_the_full_batch():
+    pipeline = ToyPipeline()
+    images = make_images()
+    reference_posterior, reference_decoded = encode_decode(pipeline, images)
+
+    for frames_per_batch in (1, 2, 3, NUM_FRAMES):
+        pipeline.enable_vae_micro_batching(frames_per_batch * pipeline.frame_cost())
+        posterior, decoded = encode_decode(pipeline, images)
+        torch.testing.assert_close(posterior, reference_posterior, rtol=1e-5, atol=1e-5)
+        torch.testing.assert_close(decoded, reference_decoded, rtol=1e-5, atol=1e-5)
+
+
+def test_tiled_fallback_matches_tiling_each_frame():
+    pipeline = ToyPipeline()
+    images = make_images()
+    with torch.no_grad():
+        pipeline.vae.enable_tiling()
+        reference_posterior = torch.cat([pipeline.vae.encode(image[None]).latent_dist.parameters for image in images])
+        reference_latents = reference_posterior[:, :4]
+        reference_decoded = torch.cat([pipeline.vae.decode(latent[None]).sample for latent in reference_latents])
+        pipeline.vae.disable_tiling()
+        untiled_posterior, _ = encode_decode(pipeline, images)
+
+        # Not even one frame fits
+        pipeline.enable_vae_micro_batching(pipeline.frame_cost() // 2)
+        posterior, decoded = encode_decode(pipeline, images)
+
+    torch.testing.assert_close(posterior, reference_posterior, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(decoded, reference_decoded, rtol=1e-5, atol=1e-5)
+    # The frames were tiled
+    assert posterior.shape == untiled_posterior.shape
+    assert not torch.allclose(posterior, untiled_posterior, rtol=1e-5, atol=1e-5)
+    # Tiling is only enabled for the call
+    assert not pipeline.vae.use_tiling
+
+
+if __name__ == "__main__":
+    test_micro_batch_size_follows_the_budget()
+    test_micro_batches_match_the_full_batch()
+    test_tiled_fallback_matches_tiling_each_frame()
+    print("All VAE micro-batching tests passed")
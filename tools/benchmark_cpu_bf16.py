@@ -0,0 +1,193 @@
+"""Compare bf16 against fp32 on the CPU for every model of the pipeline.
+
+Example:
+    python -m tools.benchmark_cpu_bf16 --unet_config_path configs/unet/stage2_512.yaml --resolution 256
+
+The UNet (randomly initialized or loaded from --inference_ckpt_path), the VAE, the whisper encoder and
+AlignRestore are each run once in fp32 and once in bf16, as `--cpu_dtype bf16` runs them. For every
+component the script reports both timings and the relative error of the bf16 output against fp32 (the
+PSNR for the decoded frames, the mean and maximum pixel difference for the restored frame). The bf16
+speedup depends on the CPU, it is only large with AVX512-BF16 or AMX.
+
+The effect on the rendered videos is measured with the SyncNet confidence by
+    python -m eval.benchmark_inference --variants cpu_fp32 cpu_bf16 --max_conf_drop 0.5
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from diffusers import AutoencoderKL
+from omegaconf import OmegaConf
+
+from latentsync.models.unet import UNet3DConditionModel
+from latentsync.utils.affine_transform import AlignRestore
+from latentsync.utils.util import read_video
+from latentsync.whisper.audio2feature import Audio2Feature, cast_encoder_weights
+
+
+def timed(fn, repeats):
+    timings = []
+    with torch.no_grad():
+        for _ in range(repeats + 1):
+            start = time.perf_counter()
+            output = fn()
+            timings.append(time.perf_counter() - start)
+    # The first run is a warm up
+    return output, min(timings[1:])
+
+
+def relative_error(reference, candidate):
+    reference, candidate = reference.float(), candidate.float()
+    return ((candidate - reference).norm() / reference.norm().clamp_min(1e-12)).item()
+
+
+def psnr(reference, candidate):
+    # pixel values are in [-1, 1]
+    mse = (reference.float() - candidate.float()).pow(2).mean().item()
+    return float("inf") if mse == 0 else 10 * np.log10(4.0 / mse)
+
+
+def report(name, fp32_time, bf16_time, **metrics):
+    result = {"fp32_seconds": fp32_time, "bf16_seconds": bf16_time, "speedup": fp32_time / bf16_time, **metrics}
+    metrics = ", ".join(f"{key} {value:.3g}" for key, value in metrics.items())
+    print(
+        f"  {name:<14} fp32 {fp32_time * 1000:9.1f} ms, bf16 {bf16_time * 1000:9.1f} ms "
+        f"({result['speedup']:.2f}x), {metrics}"
+    )
+    return result
+
+
+def benchmark_unet(args, config):
+    unet, _ = UNet3DConditionModel.from_pretrained(
+        OmegaConf.to_container(config.model), args.inference_ckpt_path, device="cpu", dtype=torch.float32
+    )
+    unet = unet.eval()
+
+    torch.manual_seed(0)
+    batch_size = 2 if args.guidance_scale > 1 else 1
+    num_frames = config.data.num_frames
+    latent_size = args.resolution // 8
+    sample = torch.randn(batch_size, config.model.in_channels, num_frames, latent_size, latent_size)
+    audio_embeds = torch.randn(batch_size * num_frames, 50, config.model.cross_attention_dim)
+    timestep = torch.tensor(500)
+
+    def forward():
+        return unet(sample.to(unet.dtype), timestep, encoder_hidden_states=audio_embeds.to(unet.dtype)).sample
+
+    reference, fp32_time = timed(forward, args.repeats)
+    unet.to(torch.bfloat16)
+    output, bf16_time = timed(forward, args.repeats)
+    return report("UNet", fp32_time, bf16_time, relative_error=relative_error(reference, output))
+
+
+def benchmark_vae(args, config):
+    vae = AutoencoderKL.from_pretrained(args.vae_path, torch_dtype=torch.float32).eval()
+
+    # Smooth random images, closer to faces than white noise
+    torch.manual_seed(0)
+    images = torch.rand(config.data.num_frames, 3, 16, 16)
+    images = F.interpolate(images, size=(args.resolution, args.resolution), mode="bicubic").clamp(0, 1) * 2 - 1
+
+    def encode_decode():
+        latents = vae.encode(images.to(vae.dtype)).latent_dist.mean
+        return latents, vae.decode(latents).sample
+
+    (reference_latents, reference), fp32_time = timed(encode_decode, args.repeats)
+    vae.to(torch.bfloat16)
+    (latents, output), bf16_time = timed(encode_decode, args.repeats)
+    return report(
+        "VAE",
+        fp32_time,
+        bf16_time,
+        latent_relative_error=relative_error(reference_latents, latents),
+        psnr=psnr(reference, output),
+    )
+
+
+def benchmark_whisper(args):
+    audio_encoder = Audio2Feature(model_path=args.whisper_model_path, device="cpu")
+    reference, fp32_time = timed(lambda: audio_encoder._audio2feat(args.audio_path), args.repeats)
+    # What Audio2Feature(dtype=torch.bfloat16) does when the pipeline is built
+    audio_encoder.dtype = torch.bfloat16
+    cast_encoder_weights(audio_encoder.model.encoder, torch.bfloat16)
+    output, bf16_time = timed(lambda: audio_encoder._audio2feat(args.audio_path), args.repeats)
+    min_cosine_similarity = F.cosine_similarity(reference.float(), output.float(), dim=-1).min().item()
+    return report(
+        "whisper",
+        fp32_time,
+        bf16_time,
+        relative_error=relative_error(reference, output),
+        min_cosine_similarity=min_cosine_similarity,
+    )
+
+
+def benchmark_restorer(args):
+    frame = read_video(args.video_path, use_decord=False)[0]
+    height, width, _ = frame.shape
+    # Eyebrows and nose of a face in the middle of the frame, the warps are the same for any landmarks
+    size = min(height, width) / 4
+    left, right, top = width / 2 - size / 2, width / 2 + size / 2, height / 2 - size / 2
+    landmarks3 = np.round([[left, top], [right, top], [width / 2, height / 2]])
+
+    restorers = {
+        dtype: AlignRestore(resolution=args.resolution, device="cpu", dtype=dtype)
+        for dtype in (torch.float32, torch.bfloat16)
+    }
+    face, affine_matrix = restorers[torch.float32].align_warp_face(frame.copy(), landmarks3=landmarks3, smooth=False)
+    # A generated face is pasted back in [-1, 1], as the pipeline does
+    face = torch.from_numpy(face).permute(2, 0, 1).float() / 127.5 - 1
+
+    outputs = {}
+    timings = {}
+    for dtype, restorer in restorers.items():
+        outputs[dtype], timings[dtype] = timed(
+            lambda: restorer.restore_img(frame, face.to(dtype), affine_matrix), args.repeats
+        )
+    diff = np.abs(outputs[torch.float32].astype(np.int16) - outputs[torch.bfloat16].astype(np.int16))
+    return report(
+        "AlignRestore",
+        timings[torch.float32],
+        timings[torch.bfloat16],
+        mean_pixel_diff=diff.mean(),
+        max_pixel_diff=diff.max(),
+    )
+
+
+def main(args):
+    config = OmegaConf.load(args.unet_config_path)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    print(f"bf16 against fp32 on the CPU, {torch.get_num_threads()} threads, {args.resolution}x{args.resolution}")
+
+    results = {
+        "unet": benchmark_unet(args, config),
+        "vae": benchmark_vae(args, config),
+        "whisper": benchmark_whisper(args),
+        "restorer": benchmark_restorer(args),
+    }
+
+    if args.output_json is not None:
+        with open(args.output_json, "w") as f:
+            json.dump(results, f, indent=2, default=float)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--unet_config_path", type=str, default="configs/unet/stage2_512.yaml")
+    parser.add_argument("--inference_ckpt_path", type=str, default="")
+    parser.add_argument("--vae_path", type=str, default="stabilityai/sd-vae-ft-mse")
+    parser.add_argument("--whisper_model_path", type=str, default="checkpoints/whisper/tiny.pt")
+    parser.add_argument("--video_path", type=str, default="assets/demo1_video.mp4")
+    parser.add_argument("--audio_path", type=str, default="assets/demo1_audio.wav")
+    parser.add_argument("--resolution", type=int, default=256)
+    parser.add_argument("--guidance_scale", type=float, default=1.5)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--output_json", type=str, default=None)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,74 @@
+"""Benchmark the fused query/key/value projections of the UNet self-attention layers.
+
+Example:
+    python -m tools.benchmark_fused_qkv --unet_config_path configs/unet/stage2_512.yaml --resolution 256
+
+The UNet is randomly initialized (or loaded from --inference_ckpt_path) and one forward pass is
+timed with separate and with fused projections, on CPU by default. The maximum difference of
+the outputs is reported as well, it should stay at the level of float rounding.
+"""
+
+import argparse
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from latentsync.models.unet import UNet3DConditionModel
+
+
+def time_forward(unet, sample, timestep, audio_embeds, repeats):
+    timings = []
+    with torch.no_grad():
+        for _ in range(repeats):
+            if sample.device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            output = unet(sample, timestep, encoder_hidden_states=audio_embeds).sample
+            if sample.device.type == "cuda":
+                torch.cuda.synchronize()
+            timings.append(time.perf_counter() - start)
+    return output, min(timings)
+
+
+def main(args):
+    config = OmegaConf.load(args.unet_config_path)
+    unet, _ = UNet3DConditionModel.from_pretrained(
+        OmegaConf.to_container(config.model), args.inference_ckpt_path, device=args.device
+    )
+    unet = unet.eval()
+
+    torch.manual_seed(0)
+    batch_size = 2 if args.guidance_scale > 1 else 1
+    num_frames = config.data.num_frames
+    latent_size = args.resolution // 8
+    sample = torch.randn(batch_size, config.model.in_channels, num_frames, latent_size, latent_size, device=args.device)
+    audio_embeds = torch.randn(batch_size * num_frames, 50, config.model.cross_attention_dim, device=args.device)
+    timestep = torch.tensor(500, device=args.device)
+
+    # Warm up before timing
+    time_forward(unet, sample, timestep, audio_embeds, 1)
+    reference, separate_time = time_forward(unet, sample, timestep, audio_embeds, args.repeats)
+
+    unet.fuse_qkv_projections()
+    time_forward(unet, sample, timestep, audio_embeds, 1)
+    fused, fused_time = time_forward(unet, sample, timestep, audio_embeds, args.repeats)
+
+    max_diff = (fused - reference).abs().max().item()
+    print(f"UNet forward, batch {batch_size}, {num_frames} frames, {latent_size}x{latent_size} latents on {args.device}")
+    print(f"  separate q/k/v: {separate_time * 1000:8.1f} ms")
+    print(f"  fused qkv:      {fused_time * 1000:8.1f} ms ({separate_time / fused_time:.2f}x)")
+    print(f"  max abs diff:   {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--unet_config_path", type=str, default="configs/unet/stage2_512.yaml")
+    parser.add_argument("--inference_ckpt_path", type=str, default="")
+    parser.add_argument("--resolution", type=int, default=256)
+    parser.add_argument("--guidance_scale", type=float, default=1.5)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,95 @@
+"""Benchmark the temporal attention of the motion modules on strided views against the rearranged path.
+
+Example:
+    python -m tools.benchmark_temporal_attention --channels 320 --resolution 256
+
+A randomly initialized motion module (TemporalTransformer3DModel with VersatileAttention layers) is
+run on a b c f h w activation of the first UNet level. The rearranged path copies the input to
+(b f) c h w and back around the module and runs every attention layer on (b s) f c copies, as the
+motion modules did before; the strided path works on views of the existing layout. The maximum
+difference of the outputs is reported as well, it should stay at the level of float rounding.
+"""
+
+import argparse
+import time
+
+import torch
+from einops import rearrange
+
+from latentsync.models.motion_module import TemporalTransformer3DModel, VersatileAttention
+
+
+def set_strided_attention(module, enabled):
+    for attention in module.modules():
+        if isinstance(attention, VersatileAttention):
+            attention.strided_attention = enabled
+
+
+def rearranged_forward(module, hidden_states):
+    video_length = hidden_states.shape[2]
+    hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
+    set_strided_attention(module, False)
+    hidden_states = module(hidden_states, video_length=video_length)
+    set_strided_attention(module, True)
+    return rearrange(hidden_states, "(b f) c h w -> b c f h w", f=video_length)
+
+
+def time_forward(fn, hidden_states, repeats):
+    timings = []
+    with torch.no_grad():
+        for _ in range(repeats):
+            if hidden_states.device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            output = fn(hidden_states)
+            if hidden_states.device.type == "cuda":
+                torch.cuda.synchronize()
+            timings.append(time.perf_counter() - start)
+    return output, min(timings)
+
+
+def main(args):
+    dtype = torch.float16 if args.device == "cuda" else torch.float32
+    torch.manual_seed(0)
+    module = TemporalTransformer3DModel(
+        in_channels=args.channels,
+        num_attention_heads=8,
+        attention_head_dim=args.channels // 8,
+        num_layers=1,
+        temporal_position_encoding=True,
+    )
+    module = module.to(args.device, dtype=dtype).eval()
+
+    batch_size = 2 if args.guidance_scale > 1 else 1
+    latent_size = args.resolution // 8
+    hidden_states = torch.randn(
+        batch_size, args.channels, args.num_frames, latent_size, latent_size, device=args.device, dtype=dtype
+    )
+
+    # Warm up before timing
+    time_forward(lambda x: rearranged_forward(module, x), hidden_states, 1)
+    reference, rearranged_time = time_forward(lambda x: rearranged_forward(module, x), hidden_states, args.repeats)
+    time_forward(module, hidden_states, 1)
+    output, strided_time = time_forward(module, hidden_states, args.repeats)
+
+    max_diff = (output - reference).abs().max().item()
+    print(
+        f"Motion module, batch {batch_size}, {args.channels} channels, {args.num_frames} frames, "
+        f"{latent_size}x{latent_size} latents on {args.device}"
+    )
+    print(f"  rearranged:    {rearranged_time * 1000:8.1f} ms")
+    print(f"  strided views: {strided_time * 1000:8.1f} ms ({rearranged_time / strided_time:.2f}x)")
+    print(f"  max abs diff:  {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=320)
+    parser.add_argument("--resolution", type=int, default=256)
+    parser.add_argument("--num_frames", type=int, default=16)
+    parser.add_argument("--guidance_scale", type=float, default=1.5)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    main(args)
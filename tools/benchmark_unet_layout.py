@@ -0,0 +1,100 @@
+"""Benchmark the flattened (b f) c h w layout and the channels_last memory format of the UNet.
+
+Example:
+    python -m tools.benchmark_unet_layout --unet_config_path configs/unet/stage2_512.yaml --resolution 256
+
+The UNet is randomly initialized (or loaded from --inference_ckpt_path) and one forward pass is
+timed in the default b c f h w layout, in the flattened layout and in the flattened layout with
+channels_last, on CPU and also on the GPU when CUDA is available (in float16 there). The maximum
+difference to the default layout is reported as well, it should stay at the level of float rounding.
+"""
+
+import argparse
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from latentsync.models.unet import UNet3DConditionModel
+
+LAYOUTS = {
+    "b c f h w": None,
+    "(b f) c h w": False,
+    "(b f) c h w, channels_last": True,
+}
+
+
+def time_forward(unet, sample, timestep, audio_embeds, repeats):
+    timings = []
+    with torch.no_grad():
+        for _ in range(repeats):
+            if sample.device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            output = unet(sample, timestep, encoder_hidden_states=audio_embeds).sample
+            if sample.device.type == "cuda":
+                torch.cuda.synchronize()
+            timings.append(time.perf_counter() - start)
+    return output, min(timings)
+
+
+def benchmark_device(args, config, device, dtype):
+    unet, _ = UNet3DConditionModel.from_pretrained(
+        OmegaConf.to_container(config.model), args.inference_ckpt_path, device=device, dtype=dtype
+    )
+    unet = unet.eval()
+
+    torch.manual_seed(0)
+    batch_size = 2 if args.guidance_scale > 1 else 1
+    num_frames = config.data.num_frames
+    latent_size = args.resolution // 8
+    sample = torch.randn(batch_size, config.model.in_channels, num_frames, latent_size, latent_size, device=device)
+    audio_embeds = torch.randn(batch_size * num_frames, 50, config.model.cross_attention_dim, device=device)
+    sample, audio_embeds = sample.to(dtype), audio_embeds.to(dtype)
+    timestep = torch.tensor(500, device=device)
+
+    print(f"UNet forward, batch {batch_size}, {num_frames} frames, {latent_size}x{latent_size} latents on {device}, {dtype}")
+    reference = baseline_time = None
+    for name, channels_last in LAYOUTS.items():
+        if channels_last is None:
+            unet.disable_flat_layout()
+        else:
+            unet.enable_flat_layout(channels_last=channels_last)
+
+        # Warm up before timing
+        time_forward(unet, sample, timestep, audio_embeds, 1)
+        output, forward_time = time_forward(unet, sample, timestep, audio_embeds, args.repeats)
+
+        if reference is None:
+            reference, baseline_time = output, forward_time
+            print(f"  {name:<28} {forward_time * 1000:8.1f} ms")
+        else:
+            max_diff = (output - reference).abs().max().item()
+            print(
+                f"  {name:<28} {forward_time * 1000:8.1f} ms ({baseline_time / forward_time:.2f}x), "
+                f"max abs diff {max_diff:.2e}"
+            )
+
+    del unet
+    if device == "cuda":
+        torch.cuda.empty_cache()
+
+
+def main(args):
+    config = OmegaConf.load(args.unet_config_path)
+    benchmark_device(args, config, "cpu", torch.float32)
+    if torch.cuda.is_available() and not args.cpu_only:
+        benchmark_device(args, config, "cuda", torch.float16)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--unet_config_path", type=str, default="configs/unet/stage2_512.yaml")
+    parser.add_argument("--inference_ckpt_path", type=str, default="")
+    parser.add_argument("--resolution", type=int, default=256)
+    parser.add_argument("--guidance_scale", type=float, default=1.5)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--cpu_only", action="store_true")
+    args = parser.parse_args()
+
+    main(args)
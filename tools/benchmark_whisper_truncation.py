@@ -0,0 +1,111 @@
+"""Compare padded and truncated-context whisper encoding on short clips.
+
+Example:
+    python -m tools.benchmark_whisper_truncation --audio_path assets/demo1_audio.wav --clip_seconds 3 5 10
+
+For every clip length and context margin it reports the encoding time and how far the
+truncated embeddings drift from the padded ones (per encoder layer), so a margin can be
+picked that keeps the features within tolerance.
+"""
+
+import argparse
+import json
+import time
+
+import torch
+
+from latentsync.whisper.audio2feature import Audio2Feature
+from latentsync.whisper.whisper.audio import SAMPLE_RATE, load_audio
+
+
+def encode(audio_encoder, waveform, truncate_context, context_margin, repeats):
+    audio_encoder.truncate_context = truncate_context
+    audio_encoder.context_margin = context_margin
+    timings = []
+    for _ in range(repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        feature_array = audio_encoder._audio2feat(waveform)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    return feature_array.float(), min(timings)
+
+
+def compare(reference, candidate):
+    # feature arrays have shape (num_positions, num_layers, embedding_dim)
+    stats = []
+    for layer in range(reference.shape[1]):
+        ref = reference[:, layer]
+        cand = candidate[:, layer]
+        diff = (ref - cand).abs()
+        stats.append(
+            {
+                "layer": layer,
+                "max_abs_diff": diff.max().item(),
+                "mean_abs_diff": diff.mean().item(),
+                "relative_error": ((ref - cand).norm() / ref.norm().clamp_min(1e-12)).item(),
+                "min_cosine_similarity": torch.nn.functional.cosine_similarity(ref, cand, dim=-1).min().item(),
+            }
+        )
+    return stats
+
+
+def main(args):
+    audio_encoder = Audio2Feature(model_path=args.whisper_model_path, device=args.device)
+    waveform = load_audio(args.audio_path)
+
+    results = []
+    for clip_seconds in args.clip_seconds:
+        clip = waveform[: int(clip_seconds * SAMPLE_RATE)]
+        # Warm up kernels before timing
+        encode(audio_encoder, clip, False, 0, 1)
+        reference, padded_time = encode(audio_encoder, clip, False, 0, args.repeats)
+        print(f"\nClip {clip_seconds:.1f} s: padded encoding {padded_time * 1000:.1f} ms")
+
+        for context_margin in args.context_margins:
+            candidate, truncated_time = encode(audio_encoder, clip, True, context_margin, args.repeats)
+            stats = compare(reference, candidate)
+            worst_cosine = min(s["min_cosine_similarity"] for s in stats)
+            worst_relative = max(s["relative_error"] for s in stats)
+            print(
+                f"  margin {context_margin:4d} frames: {truncated_time * 1000:8.1f} ms "
+                f"({padded_time / truncated_time:5.1f}x), worst relative error {worst_relative:.4f}, "
+                f"worst cosine similarity {worst_cosine:.5f}"
+            )
+            if args.verbose:
+                for s in stats:
+                    print(
+                        f"    layer {s['layer']}: max abs {s['max_abs_diff']:.4f}, mean abs {s['mean_abs_diff']:.5f}, "
+                        f"relative {s['relative_error']:.4f}, min cosine {s['min_cosine_similarity']:.5f}"
+                    )
+            results.append(
+                {
+                    "clip_seconds": clip_seconds,
+                    "context_margin": context_margin,
+                    "padded_ms": padded_time * 1000,
+                    "truncated_ms": truncated_time * 1000,
+                    "layers": stats,
+                }
+            )
+
+    if args.output_json is not None:
+        with open(args.output_json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults saved to {args.output_json}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--whisper_model_path", type=str, default="checkpoints/whisper/tiny.pt")
+    parser.add_argument("--audio_path", type=str, default="assets/demo1_audio.wav")
+    parser.add_argument("--clip_seconds", type=float, nargs="+", default=[2.0, 5.0, 10.0])
+    parser.add_argument("--context_margins", type=int, nargs="+", default=[0, 50, 100, 200])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--output_json", type=str, default=None)
+    parser.add_argument("--verbose", action="store_true", help="Print the per-layer statistics")
+    args = parser.parse_args()
+
+    main(args)
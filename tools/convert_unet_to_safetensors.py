@@ -0,0 +1,43 @@
+"""Convert a LatentSync UNet checkpoint (.pt) to safetensors for faster loading.
+
+Example:
+    python -m tools.convert_unet_to_safetensors --ckpt_path checkpoints/latentsync_unet.pt
+
+The output can be passed anywhere a UNet checkpoint path is expected, e.g.
+--inference_ckpt_path checkpoints/latentsync_unet.safetensors. Floating point tensors are
+stored in fp16 by default, which is the dtype used for inference on GPU.
+"""
+
+import argparse
+import os
+
+import torch
+from safetensors.torch import save_file
+
+DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+
+
+def main(args):
+    output_path = args.output_path or os.path.splitext(args.ckpt_path)[0] + ".safetensors"
+
+    ckpt = torch.load(args.ckpt_path, map_location="cpu", weights_only=True)
+    dtype = DTYPES[args.dtype]
+    state_dict = {
+        key: (value.to(dtype) if value.is_floating_point() else value).contiguous()
+        for key, value in ckpt["state_dict"].items()
+    }
+    metadata = {"global_step": str(ckpt.get("global_step", 0)), "dtype": args.dtype}
+
+    save_file(state_dict, output_path, metadata=metadata)
+    size_mb = os.path.getsize(output_path) / 1024**2
+    print(f"Saved {len(state_dict)} tensors ({args.dtype}, {size_mb:.1f} MB) to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_path", type=str, default="checkpoints/latentsync_unet.pt")
+    parser.add_argument("--output_path", type=str, default=None)
+    parser.add_argument("--dtype", type=str, default="fp16", choices=list(DTYPES))
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,127 @@
+"""Validate batch renders of one video with several audios against single-audio renders.
+
+Example:
+    python -m tools.validate_multi_audio --audio_paths assets/demo1_audio.wav assets/demo2_audio.wav --max_audios 1 4
+
+Every audio is rendered alone with `scripts.inference.main`, then all of them at once with `main_batch`, once per
+`--max_audios` (the most audios per UNet forward). The script reports the time of each and, for every output, the
+largest pixel difference and the PSNR of its frames against the single-audio render with the same seed. With one
+audio per forward the outputs are expected to be identical; batched UNet forwards may round differently.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from latentsync.utils.util import read_video
+from scripts.inference import get_parser, main, main_batch
+
+
+def timed(fn):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    output = fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return output, time.perf_counter() - start
+
+
+def compare_videos(reference_path, candidate_path):
+    reference = read_video(reference_path, change_fps=False, use_decord=False).astype(np.float64)
+    candidate = read_video(candidate_path, change_fps=False, use_decord=False).astype(np.float64)
+    if reference.shape != candidate.shape:
+        return {"identical": False, "shape": [list(reference.shape), list(candidate.shape)]}
+    mse = np.mean((reference - candidate) ** 2)
+    return {
+        "identical": bool(mse == 0),
+        "max_abs_diff": float(np.abs(reference - candidate).max()),
+        "psnr": float("inf") if mse == 0 else float(10 * np.log10(255**2 / mse)),
+    }
+
+
+def make_args(args, audio_path, video_out_path, temp_dir):
+    return get_parser().parse_args(
+        [
+            "--unet_config_path",
+            args.unet_config_path,
+            "--inference_ckpt_path",
+            args.inference_ckpt_path,
+            "--video_path",
+            args.video_path,
+            "--audio_path",
+            audio_path,
+            "--video_out_path",
+            video_out_path,
+            "--inference_steps",
+            str(args.inference_steps),
+            "--guidance_scale",
+            str(args.guidance_scale),
+            "--seed",
+            str(args.seed),
+            "--temp_dir",
+            temp_dir,
+        ]
+    )
+
+
+def main_validate(args):
+    config = OmegaConf.load(args.unet_config_path)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    single_paths = []
+    single_seconds = 0.0
+    for index, audio_path in enumerate(args.audio_paths):
+        video_out_path = os.path.join(args.output_dir, f"single_{index}.mp4")
+        _, seconds = timed(
+            lambda: main(config, make_args(args, audio_path, video_out_path, os.path.join(args.output_dir, "temp")))
+        )
+        single_paths.append(video_out_path)
+        single_seconds += seconds
+    print(f"{len(args.audio_paths)} single-audio renders: {single_seconds:.1f} s")
+
+    results = {"single_seconds": single_seconds, "batches": []}
+    for max_audios in args.max_audios:
+        batch_paths = [
+            os.path.join(args.output_dir, f"batch{max_audios}_{index}.mp4") for index in range(len(args.audio_paths))
+        ]
+        batch_args = make_args(args, args.audio_paths[0], batch_paths[0], os.path.join(args.output_dir, "temp"))
+        batch_args.batch_max_audios = max_audios
+        _, seconds = timed(lambda: main_batch(config, batch_args, args.audio_paths, batch_paths))
+        outputs = [compare_videos(single, batch) for single, batch in zip(single_paths, batch_paths)]
+        results["batches"].append({"max_audios": max_audios, "seconds": seconds, "outputs": outputs})
+        print(f"  batch of {len(args.audio_paths)}, {max_audios} per forward: {seconds:.1f} s")
+        for index, output in enumerate(outputs):
+            if "psnr" in output:
+                print(
+                    f"    audio {index}: identical {output['identical']}, max abs diff {output['max_abs_diff']:.0f}, "
+                    f"PSNR {output['psnr']:.1f} dB"
+                )
+            else:
+                print(f"    audio {index}: frame shapes differ {output['shape']}")
+
+    if args.output_json is not None:
+        with open(args.output_json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--video_path", type=str, default="assets/demo1_video.mp4")
+    parser.add_argument("--audio_paths", type=str, nargs="+", required=True)
+    parser.add_argument("--unet_config_path", type=str, default="configs/unet/stage2_512.yaml")
+    parser.add_argument("--inference_ckpt_path", type=str, default="checkpoints/latentsync_unet.pt")
+    parser.add_argument("--inference_steps", type=int, default=20)
+    parser.add_argument("--guidance_scale", type=float, default=1.5)
+    parser.add_argument("--seed", type=int, default=1247)
+    parser.add_argument("--max_audios", type=int, nargs="+", default=[1, 8], help="Audios per UNet forward")
+    parser.add_argument("--output_dir", type=str, default="temp/validate_multi_audio")
+    parser.add_argument("--output_json", type=str, default=None)
+    args = parser.parse_args()
+
+    main_validate(args)
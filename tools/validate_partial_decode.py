@@ -0,0 +1,131 @@
+"""Validate the partial VAE decode of the mouth region against the full decode.
+
+Example:
+    python -m tools.validate_partial_decode --video_path assets/demo1_video.mp4 --margins 0 2 4 8
+
+The aligned faces of the first frames are encoded with the VAE and decoded once in full and once
+per margin with `LipsyncPipeline.decode_latents_partial`. Both are blended into the reference
+frames with the mask as in the pipeline. For every margin the script reports the decode time, the
+PSNR of the blended frames against the full decode, and the seam error: the mean absolute
+difference in a band along the border of the decoded crop, where the missing context of the VAE
+decoder shows first.
+"""
+
+import argparse
+import json
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from latentsync.utils.image_processor import ImageProcessor, load_fixed_mask
+from latentsync.utils.util import read_video
+from scripts.inference import get_device_and_dtype, get_parser, get_pipeline
+
+
+def timed(fn, device, repeats):
+    timings = []
+    for _ in range(repeats):
+        if device == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        output = fn()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    return output, min(timings)
+
+
+def psnr(reference, candidate):
+    # pixel values are in [-1, 1]
+    mse = (reference.float() - candidate.float()).pow(2).mean().item()
+    return float("inf") if mse == 0 else 10 * torch.log10(torch.tensor(4.0 / mse)).item()
+
+
+def seam_error(reference, candidate, generated, region, scale, band):
+    # Mean absolute difference in the band along the inner border of the decoded crop, inside the generated region
+    top, bottom, left, right = (value * scale for value in region)
+    border = torch.zeros_like(generated, dtype=torch.bool)
+    border[..., top:bottom, left:right] = True
+    border[..., top + band : bottom - band, left + band : right - band] = False
+    weights = (generated * border).float()
+    if weights.sum() == 0:
+        return 0.0
+    diff = (reference.float() - candidate.float()).abs().mean(dim=1, keepdim=True)
+    return (diff * weights).sum().item() / weights.sum().item()
+
+
+def main(args):
+    config = OmegaConf.load(args.unet_config_path)
+    inference_args = get_parser().parse_args(
+        [
+            "--unet_config_path",
+            args.unet_config_path,
+            "--inference_ckpt_path",
+            args.inference_ckpt_path,
+            "--video_path",
+            args.video_path,
+            "--audio_path",
+            "",
+            "--video_out_path",
+            "",
+        ]
+    )
+    device, dtype = get_device_and_dtype(inference_args.cpu_dtype)
+    pipeline = get_pipeline(config, inference_args, dtype, device)
+
+    resolution = config.data.resolution
+    mask_image = load_fixed_mask(resolution, config.data.mask_image_path)
+    pipeline.image_processor = ImageProcessor(resolution, device=device, mask_image=mask_image, detect_faces=True)
+
+    video_frames = read_video(args.video_path, use_decord=False)[: args.num_frames]
+    faces, _, _ = pipeline.affine_transform_video(video_frames)
+    ref_pixel_values, _, masks = pipeline.image_processor.prepare_masks_and_masked_images(faces)
+
+    with torch.no_grad():
+        latents = pipeline.prepare_image_latents(ref_pixel_values, device, dtype, None, False)
+        full, full_time = timed(lambda: pipeline.decode_latents(latents), device, args.repeats)
+        full = pipeline.paste_surrounding_pixels_back(full, ref_pixel_values, 1 - masks, device, dtype)
+        generated = (masks < 1).to(device)
+
+        results = []
+        print(f"{len(faces)} frames at {resolution}x{resolution} on {device}, full decode {full_time * 1000:.1f} ms")
+        for margin in args.margins:
+            region = pipeline.get_decode_region(masks, margin)
+            partial, partial_time = timed(
+                lambda: pipeline.decode_latents_partial(latents, ref_pixel_values, masks, margin), device, args.repeats
+            )
+            partial = pipeline.paste_surrounding_pixels_back(partial, ref_pixel_values, 1 - masks, device, dtype)
+            result = {
+                "margin": margin,
+                "region": region,
+                "seconds": partial_time,
+                "speedup": full_time / partial_time,
+                "psnr": psnr(full, partial),
+                "max_abs_diff": (full.float() - partial.float()).abs().max().item(),
+                "seam_error": seam_error(full, partial, generated, region, pipeline.vae_scale_factor, args.band),
+            }
+            results.append(result)
+            print(
+                f"  margin {margin:>2}: crop {region}, {partial_time * 1000:8.1f} ms ({result['speedup']:.2f}x), "
+                f"PSNR {result['psnr']:.1f} dB, seam error {result['seam_error']:.4f}"
+            )
+
+    if args.output_json is not None:
+        with open(args.output_json, "w") as f:
+            json.dump({"full_seconds": full_time, "margins": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--video_path", type=str, default="assets/demo1_video.mp4")
+    parser.add_argument("--unet_config_path", type=str, default="configs/unet/stage2_512.yaml")
+    parser.add_argument("--inference_ckpt_path", type=str, default="checkpoints/latentsync_unet.pt")
+    parser.add_argument("--num_frames", type=int, default=16)
+    parser.add_argument("--margins", type=int, nargs="+", default=[0, 2, 4, 8])
+    parser.add_argument("--band", type=int, default=8, help="Width in pixels of the seam band")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output_json", type=str, default=None)
+    args = parser.parse_args()
+
+    main(args)